@@ -0,0 +1,213 @@
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted; the server answers 503 with Retry-After."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class EndpointLimit():
+    """
+    Admission settings of one endpoint. Lower priority values are admitted
+    first when requests of several endpoints are waiting for a slot.
+    """
+
+    def __init__(self, max_concurrent=4, max_queue=8, priority=1, timeout=30.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.priority = priority
+        self.timeout = timeout
+
+
+# Interactive calls (priority 0) go ahead of the long pipelines.
+DEFAULT_LIMITS = {
+    "ask_question": EndpointLimit(max_concurrent=8, max_queue=16, priority=0, timeout=15.0),
+    "transcribe_audio": EndpointLimit(max_concurrent=8, max_queue=16, priority=0, timeout=15.0),
+    "detect_private_answer": EndpointLimit(max_concurrent=8, max_queue=16, priority=0, timeout=15.0),
+    "speak": EndpointLimit(max_concurrent=4, max_queue=8, priority=1, timeout=30.0),
+    "speak_stream": EndpointLimit(max_concurrent=4, max_queue=8, priority=1, timeout=30.0),
+    "detect_private": EndpointLimit(max_concurrent=2, max_queue=4, priority=2, timeout=30.0),
+}
+
+
+class Ticket():
+    """An admitted request. Call release() (once) when its response has been fully sent."""
+
+    def __init__(self, controller, endpoint, wait):
+        self.controller = controller
+        self.endpoint = endpoint
+        self.wait = wait
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController():
+    """
+    Bounds how many requests run at once, per endpoint and in total. Requests
+    over the limit wait in a priority queue of bounded depth; a full queue or
+    a wait longer than the endpoint's timeout raises Overloaded right away.
+    """
+
+    def __init__(self, capacity=16, limits=None):
+        self.capacity = capacity
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.cond = threading.Condition()
+        self.active = 0
+        self.running = {}
+        self.queued = {}
+        self.rejected = {}
+        self.avg_seconds = {}
+        self.waiting = []  # heap of (priority, seq, endpoint)
+        self.seq = itertools.count()
+        self.wait_executor = None
+
+    def limit_for(self, endpoint):
+        return self.limits.get(endpoint) or self.limits.setdefault(endpoint, EndpointLimit())
+
+    def _has_room(self, endpoint):
+        return self.active < self.capacity and self.running.get(endpoint, 0) < self.limit_for(endpoint).max_concurrent
+
+    def _can_start(self, entry):
+        # Only entries ahead of us that could start now block us; an entry held back
+        # by its own endpoint limit must not stall other endpoints.
+        if not self._has_room(entry[2]):
+            return False
+        return not any(other < entry and self._has_room(other[2]) for other in self.waiting)
+
+    def _retry_after(self, endpoint):
+        limit = self.limit_for(endpoint)
+        backlog = self.queued.get(endpoint, 0) + self.running.get(endpoint, 0)
+        estimate = self.avg_seconds.get(endpoint, 1.0) * backlog / max(limit.max_concurrent, 1)
+        return max(1, math.ceil(estimate))
+
+    def _reject(self, endpoint, reason):
+        self.rejected[endpoint] = self.rejected.get(endpoint, 0) + 1
+        raise Overloaded(f"Server busy ({endpoint}: {reason}), please retry", self._retry_after(endpoint))
+
+    def acquire(self, endpoint):
+        """Waits for a slot and returns a Ticket. Raises Overloaded when the endpoint is saturated."""
+        limit = self.limit_for(endpoint)
+        start = time.monotonic()
+        with self.cond:
+            entry = (limit.priority, next(self.seq), endpoint)
+            if self._can_start(entry):
+                self._start(endpoint)
+                return Ticket(self, endpoint, 0.0)
+            if self.queued.get(endpoint, 0) >= limit.max_queue:
+                self._reject(endpoint, "queue full")
+
+            heapq.heappush(self.waiting, entry)
+            self.queued[endpoint] = self.queued.get(endpoint, 0) + 1
+            try:
+                deadline = start + limit.timeout
+                while not self._can_start(entry):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(endpoint, "queue timeout")
+                    self.cond.wait(remaining)
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.queued[endpoint] -= 1
+                # Our departure may unblock whoever was behind us
+                self.cond.notify_all()
+            self._start(endpoint)
+        return Ticket(self, endpoint, time.monotonic() - start)
+
+    async def acquire_async(self, endpoint):
+        """
+        Awaitable acquire for the ASGI app. Waits block one of the controller's own
+        threads (one per queue slot), never the threadpool running admitted requests.
+        """
+        with self.cond:
+            if self.wait_executor is None:
+                workers = self.capacity + sum(limit.max_queue for limit in self.limits.values())
+                self.wait_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="admission")
+        future = asyncio.get_running_loop().run_in_executor(self.wait_executor, self.acquire, endpoint)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The client left while queued: give the slot back as soon as the wait ends
+            future.add_done_callback(_release_admitted)
+            raise
+
+    def _start(self, endpoint):
+        self.active += 1
+        self.running[endpoint] = self.running.get(endpoint, 0) + 1
+
+    def _release(self, ticket):
+        elapsed = time.monotonic() - ticket.started
+        with self.cond:
+            self.active -= 1
+            self.running[ticket.endpoint] -= 1
+            previous = self.avg_seconds.get(ticket.endpoint)
+            self.avg_seconds[ticket.endpoint] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+            self.cond.notify_all()
+
+    @contextmanager
+    def admit(self, endpoint):
+        """Holds a slot for the enclosed block. Yields the Ticket."""
+        ticket = self.acquire(endpoint)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def limited(self, endpoint):
+        """Decorator that runs a view inside admit(endpoint)."""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                with self.admit(endpoint):
+                    return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self.cond:
+            return {
+                'active': self.active,
+                'capacity': self.capacity,
+                **{endpoint: {
+                    'running': self.running.get(endpoint, 0),
+                    'queued': self.queued.get(endpoint, 0),
+                    'rejected': self.rejected.get(endpoint, 0),
+                } for endpoint in self.limits},
+            }
+
+
+def _release_admitted(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().release()
+
+
+def create_admission_controller():
+    """
+    Builds the controller from ADMISSION_CAPACITY and ADMISSION_LIMITS, a JSON
+    object of per-endpoint overrides such as {"detect_private": {"max_concurrent": 1}}.
+    """
+    limits = {endpoint: EndpointLimit(**vars(limit)) for endpoint, limit in DEFAULT_LIMITS.items()}
+    overrides = os.environ.get("ADMISSION_LIMITS")
+    if overrides:
+        for endpoint, values in json.loads(overrides).items():
+            settings = vars(limits[endpoint]) if endpoint in limits else {}
+            limits[endpoint] = EndpointLimit(**{**settings, **values})
+    return AdmissionController(int(os.environ.get("ADMISSION_CAPACITY", "16")), limits)
@@ -0,0 +1,426 @@
+import io
+import os
+import json
+import subprocess
+import threading
+import wave
+
+import numpy as np
+import speech_recognition as sr
+
+from agents.metrics import span
+
+SAMPLE_RATE = 16000
+
+
+def resample(samples, orig_rate, target_rate=SAMPLE_RATE):
+    """Resamples float samples by linear interpolation, box-filtering first when downsampling."""
+    if orig_rate == target_rate or len(samples) == 0:
+        return samples.astype(np.float32)
+    if orig_rate > target_rate:
+        width = int(round(orig_rate / target_rate))
+        if width > 1:
+            samples = np.convolve(samples, np.ones(width, dtype=np.float32) / width, mode='same')
+    duration = len(samples) / orig_rate
+    target_len = int(round(duration * target_rate))
+    positions = np.arange(target_len) * (orig_rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def pcm16_to_float(data, channels=1):
+    """Converts little-endian 16-bit PCM bytes to mono float32 samples in [-1, 1]."""
+    samples = np.frombuffer(data[:len(data) - len(data) % (2 * channels)], dtype='<i2').astype(np.float32) / 32768.0
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+def float_to_pcm16(samples):
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+
+def _decode_wav(data):
+    with wave.open(io.BytesIO(data), 'rb') as wav:
+        channels, width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    if width == 2:
+        samples = pcm16_to_float(frames, channels)
+    else:
+        if width == 1:
+            samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128.0
+        elif width == 3:
+            # Little-endian 24-bit: shift each triple into the top of an int32 to keep the sign
+            triples = np.frombuffer(frames[:len(frames) - len(frames) % 3], dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            samples = ((triples[:, 0] << 8 | triples[:, 1] << 16 | triples[:, 2] << 24) >> 8).astype(np.float32) / 8388608.0
+        elif width == 4:
+            samples = np.frombuffer(frames, dtype='<i4').astype(np.float32) / 2147483648.0
+        else:
+            raise ValueError(f"Unsupported WAV sample width {width}")
+        if channels > 1:
+            samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return resample(samples, rate)
+
+
+def _decode_ffmpeg(data, sample_rate):
+    pcm = subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"],
+        input=data, check=True, capture_output=True,
+    ).stdout
+    return pcm16_to_float(pcm)
+
+
+def decode_audio(data, sample_rate=SAMPLE_RATE):
+    """
+    Decodes an uploaded recording to mono float32 samples at sample_rate,
+    entirely in memory. 8/16/24/32-bit PCM WAV is parsed directly; other
+    WAV encodings and compressed containers (webm/ogg/mp4) go through an
+    ffmpeg pipe.
+    """
+    with span("audio_decode"):
+        if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+            try:
+                return resample(_decode_wav(data), SAMPLE_RATE, sample_rate)
+            except (wave.Error, ValueError) as e:
+                print(f"WAV not decoded directly ({e}), using ffmpeg")
+        return _decode_ffmpeg(data, sample_rate)
+
+
+def frame_rms(samples, sample_rate=SAMPLE_RATE, frame_ms=30):
+    """RMS energy of consecutive frame_ms frames."""
+    frame = int(sample_rate * frame_ms / 1000)
+    count = len(samples) // frame
+    if count == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = samples[:count * frame].reshape(count, frame)
+    return np.sqrt(np.mean(frames ** 2, axis=1))
+
+
+def speech_frames(rms, min_rms=0.01):
+    """Marks frames louder than both min_rms and a few times the recording's noise floor."""
+    if len(rms) == 0:
+        return np.zeros(0, dtype=bool)
+    threshold = max(min_rms, 3.0 * float(np.percentile(rms, 10)))
+    return rms > threshold
+
+
+def pause_frame(rms, first=0, min_pause=0.4, frame_ms=30):
+    """
+    Returns the frame index in the middle of the last pause of at least
+    min_pause seconds that follows speech at or after frame first, or None.
+    """
+    speech = speech_frames(rms)[first:]
+    spoken = np.flatnonzero(speech)
+    if len(spoken) == 0:
+        return None
+    # Silent run after each speech frame: from spoken[k] + 1 up to the next speech frame (or the end).
+    run_ends = np.append(spoken[1:], len(speech))
+    long_runs = np.flatnonzero(run_ends - spoken - 1 >= max(1, int(min_pause * 1000 / frame_ms)))
+    if len(long_runs) == 0:
+        return None
+    k = long_runs[-1]
+    return first + (spoken[k] + 1 + run_ends[k]) // 2
+
+
+def last_pause(samples, start=0, sample_rate=SAMPLE_RATE, min_pause=0.4, frame_ms=30):
+    """
+    Returns the sample index in the middle of the last pause of at least
+    min_pause seconds that follows speech after start, or None.
+    """
+    frame = int(sample_rate * frame_ms / 1000)
+    index = pause_frame(frame_rms(samples, sample_rate, frame_ms), start // frame, min_pause, frame_ms)
+    return None if index is None else index * frame
+
+
+def trim_silence(samples, sample_rate=SAMPLE_RATE, padding=0.25, frame_ms=30):
+    """
+    Energy VAD: cuts leading and trailing silence, keeping padding seconds
+    around the speech. Returns an empty array when there is no speech at all.
+    """
+    frame = int(sample_rate * frame_ms / 1000)
+    spoken = np.flatnonzero(speech_frames(frame_rms(samples, sample_rate, frame_ms)))
+    if len(spoken) == 0:
+        return samples[:0]
+    pad = int(padding * sample_rate)
+    start = max(0, spoken[0] * frame - pad)
+    end = min(len(samples), (spoken[-1] + 1) * frame + pad)
+    return samples[start:end]
+
+
+class GoogleRecognizer():
+    """Google Web Speech API through speech_recognition. Needs network access."""
+
+    name = "google"
+
+    def __init__(self, language='en-US'):
+        self.language = language
+
+    def recognize(self, audio):
+        return sr.Recognizer().recognize_google(audio, language=self.language)
+
+
+class SphinxRecognizer():
+    """Offline CMU Sphinx. Needs the pocketsphinx package."""
+
+    name = "sphinx"
+
+    def recognize(self, audio):
+        return sr.Recognizer().recognize_sphinx(audio)
+
+
+class VoskRecognizer():
+    """Offline Kaldi models through vosk. The model directory comes from VOSK_MODEL_PATH."""
+
+    name = "vosk"
+
+    def __init__(self, model_path=None):
+        self.model_path = model_path or os.environ.get("VOSK_MODEL_PATH")
+        self.model = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        with self.lock:
+            if self.model is None:
+                try:
+                    from vosk import Model
+                except ImportError as e:
+                    raise sr.RequestError(f"vosk is not installed: {e}")
+                self.model = Model(self.model_path) if self.model_path else Model(lang="en-us")
+        return self.model
+
+    def recognize(self, audio):
+        from vosk import KaldiRecognizer
+        recognizer = KaldiRecognizer(self._load(), audio.sample_rate)
+        recognizer.AcceptWaveform(audio.get_raw_data(convert_width=2))
+        text = json.loads(recognizer.FinalResult()).get("text", "")
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+
+ASR_BACKENDS = {
+    GoogleRecognizer.name: GoogleRecognizer,
+    SphinxRecognizer.name: SphinxRecognizer,
+    VoskRecognizer.name: VoskRecognizer,
+}
+
+
+class RecognizerChain():
+    """
+    Tries each recognizer in turn. A recognizer that cannot be reached
+    (sr.RequestError) hands over to the next one; sr.UnknownValueError is final.
+    """
+
+    def __init__(self, recognizers):
+        self.recognizers = recognizers
+        self.name = ",".join(recognizer.name for recognizer in recognizers)
+
+    def recognize(self, audio):
+        error = None
+        for recognizer in self.recognizers:
+            try:
+                return recognizer.recognize(audio)
+            except sr.RequestError as e:
+                print(f"ASR backend {recognizer.name} unavailable: {e}")
+                error = e
+        raise error
+
+
+def create_recognizer():
+    """Builds the recognizer chain listed in ASR_BACKEND, e.g. 'google,sphinx' or 'vosk'."""
+    names = [name.strip() for name in os.environ.get("ASR_BACKEND", "google,sphinx").split(",") if name.strip()]
+    unknown = [name for name in names if name not in ASR_BACKENDS]
+    if unknown or not names:
+        raise ValueError(f"Unknown ASR_BACKEND {unknown}, expected names from {sorted(ASR_BACKENDS)}")
+    return RecognizerChain([ASR_BACKENDS[name]() for name in names])
+
+
+def transcribe_samples(recognizer, samples, sample_rate=SAMPLE_RATE):
+    """Runs the recognizer on float samples. Raises sr.UnknownValueError / sr.RequestError."""
+    if len(samples) == 0:
+        raise sr.UnknownValueError()
+    audio = sr.AudioData(float_to_pcm16(samples), sample_rate, 2)
+    with span("asr"):
+        return recognizer.recognize(audio)
+
+
+class TranscriptionStream():
+    """
+    Transcribes a recording while it is still being uploaded. Chunks of the
+    same container stream are appended as they arrive; advance() transcribes
+    every phrase that is already followed by a pause, and finish() only has
+    the remaining tail left to do once the last chunk is in. With pcm_rate
+    set, chunks are raw 16-bit mono PCM at that rate instead of a container.
+
+    Each chunk is decoded once: PCM directly, containers through one ffmpeg
+    process that is fed as chunks arrive. Frame energies are kept alongside
+    the samples, so advance() neither re-decodes nor re-measures older audio.
+    """
+
+    frame_ms = 30
+
+    def __init__(self, recognizer, sample_rate=SAMPLE_RATE, pcm_rate=None):
+        self.recognizer = recognizer
+        self.sample_rate = sample_rate
+        self.pcm_rate = pcm_rate
+        # Rate of the decoded samples; segments are resampled to sample_rate for the recognizer
+        self.rate = pcm_rate or sample_rate
+        self.frame = int(self.rate * self.frame_ms / 1000)
+        self.data = bytearray()
+        self.data_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.samples = np.zeros(0, dtype=np.float32)
+        self.length = 0
+        self.rms = []
+        self.pending = b""
+        self.feed_lock = threading.Lock()
+        self.decoder = None
+        self.decoder_failed = False
+        self.reader = None
+        self.closed = False
+        self.committed = 0
+        self.segments = []
+
+    def _extend(self, samples):
+        """Appends decoded samples (under data_lock), doubling the buffer when it is full."""
+        needed = self.length + len(samples)
+        if needed > len(self.samples):
+            grown = np.zeros(max(needed, 2 * len(self.samples)), dtype=np.float32)
+            grown[:self.length] = self.samples[:self.length]
+            self.samples = grown
+        self.samples[self.length:needed] = samples
+        done = len(self.rms) * self.frame
+        self.length = needed
+        self.rms.extend(frame_rms(self.samples[done:needed], self.rate, self.frame_ms))
+
+    def _extend_pcm(self, data):
+        data = self.pending + data
+        usable = len(data) - len(data) % 2
+        self.pending = data[usable:]
+        self._extend(pcm16_to_float(data[:usable]))
+
+    def _start_decoder(self):
+        try:
+            self.decoder = subprocess.Popen(
+                ["ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-f", "s16le", "-ac", "1", "-ar", str(self.sample_rate), "pipe:1"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            )
+        except OSError as e:
+            print(f"Incremental decoding unavailable: {e}")
+            self.decoder = False
+            return
+        self.reader = threading.Thread(target=self._read_decoder, daemon=True)
+        self.reader.start()
+
+    def _read_decoder(self):
+        while True:
+            block = self.decoder.stdout.read1(65536)
+            if not block:
+                return
+            with self.data_lock:
+                self._extend_pcm(block)
+
+    def append(self, chunk):
+        # feed_lock keeps chunks in order on the way into ffmpeg; data_lock is not held while
+        # writing, so the reader thread can keep draining the decoder's output meanwhile.
+        with self.feed_lock:
+            with self.data_lock:
+                self.data.extend(chunk)
+                if self.pcm_rate:
+                    self._extend_pcm(chunk)
+                    return
+            if self.closed:
+                return
+            if self.decoder is None:
+                self._start_decoder()
+            if not self.decoder or self.decoder_failed:
+                return
+            try:
+                self.decoder.stdin.write(chunk)
+                self.decoder.stdin.flush()
+            except OSError as e:
+                # ffmpeg gave up on the stream; finish() decodes the whole upload instead
+                print(f"Incremental decoding stopped: {e}")
+                self.decoder_failed = True
+
+    def _close_decoder(self):
+        """Waits for the streaming decoder to drain. Returns False if the samples are incomplete."""
+        if self.pcm_rate:
+            return True
+        with self.feed_lock:
+            if not self.decoder:
+                return False
+            try:
+                self.decoder.stdin.close()
+            except OSError:
+                pass
+            self.reader.join()
+            self.decoder.stdout.close()
+            return self.decoder.wait() == 0 and not self.decoder_failed
+
+    def close(self):
+        """Stops the streaming decoder of a recording that will not be finished, e.g. one that expired."""
+        self.closed = True
+        decoder = self.decoder
+        if decoder:
+            # Unblocks an append() that is stuck writing to ffmpeg
+            decoder.kill()
+        with self.feed_lock:
+            if not self.decoder:
+                return
+            self.decoder.kill()
+            try:
+                self.decoder.stdin.close()
+            except OSError:
+                pass
+            self.decoder.wait()
+            self.reader.join()
+            self.decoder.stdout.close()
+            self.decoder_failed = True
+
+    def _transcribe_segment(self, segment):
+        segment = trim_silence(resample(segment, self.rate, self.sample_rate), self.sample_rate)
+        if len(segment) == 0:
+            return
+        try:
+            self.segments.append(transcribe_samples(self.recognizer, segment, self.sample_rate))
+        except sr.UnknownValueError:
+            pass
+
+    @property
+    def text(self):
+        return " ".join(self.segments)
+
+    def advance(self):
+        """Transcribes finished phrases. Returns immediately if another call is already working."""
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            with self.data_lock:
+                rms = np.asarray(self.rms, dtype=np.float32)
+                samples = self.samples
+            index = pause_frame(rms, self.committed // self.frame, frame_ms=self.frame_ms)
+            if index is None or index * self.frame <= self.committed:
+                return
+            end = index * self.frame
+            self._transcribe_segment(samples[self.committed:end])
+            self.committed = end
+        except sr.RequestError as e:
+            # A backend may be busy; finish() retries.
+            print(f"Incremental transcription skipped: {e}")
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        """Transcribes what is left and returns the full text. Raises like transcribe_samples."""
+        with self.lock:
+            if not self._close_decoder():
+                with self.data_lock:
+                    data = bytes(self.data)
+                    self.samples, self.length, self.rms = np.zeros(0, dtype=np.float32), 0, []
+                    if data:
+                        self._extend(decode_audio(data, self.sample_rate))
+            self._transcribe_segment(self.samples[self.committed:self.length])
+            self.committed = self.length
+            if not self.segments:
+                raise sr.UnknownValueError()
+            return self.text
@@ -0,0 +1,280 @@
+import hashlib
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def hash_bytes(data):
+    """Returns the hex sha256 digest of bytes or str data."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def default_sizeof(value):
+    """Approximate size in bytes of a cached value. Counts PIL image pixels and dict contents."""
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    if hasattr(value, 'getbands'):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(default_sizeof(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(default_sizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache():
+    """
+    Thread-safe in-memory cache with LRU eviction, an optional TTL and
+    optional entry-count and byte-size bounds. Keeps hit/miss/eviction counters.
+    on_evict, if given, is called with each value that is dropped without being
+    handed back to a caller (evicted, expired, replaced or cleared), after the
+    lock is released.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=None, sizeof=default_sizeof, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()  # key -> (value, size, expires_at)
+        self.dropped = []  # values waiting for on_evict
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expired(self, expires_at):
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def _remove(self, key, dropped=True):
+        value, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+        if dropped and self.on_evict is not None:
+            self.dropped.append(value)
+
+    def _notify(self):
+        if self.on_evict is None:
+            return
+        with self.lock:
+            dropped, self.dropped = self.dropped, []
+        for value in dropped:
+            self.on_evict(value)
+
+    def _evict(self):
+        while self.entries and (
+            (self.max_entries is not None and len(self.entries) > self.max_entries)
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            key = next(iter(self.entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        try:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None or self._expired(entry[2]):
+                    if entry is not None:
+                        self._remove(key)
+                    self.misses += 1
+                    return default
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        finally:
+            self._notify()
+
+    def set(self, key, value, ttl=None):
+        size = self.sizeof(value)
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        try:
+            with self.lock:
+                if key in self.entries:
+                    self._remove(key, dropped=self.entries[key][0] is not value)
+                if self.max_bytes is not None and size > self.max_bytes:
+                    return
+                self.entries[key] = (value, size, expires_at)
+                self.total_bytes += size
+                self._evict()
+        finally:
+            self._notify()
+
+    def remeasure(self, key):
+        """Updates the size of an entry whose value grew or shrank in place, evicting past max_bytes."""
+        try:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    return
+                value, size, expires_at = entry
+                new_size = self.sizeof(value)
+                self.entries[key] = (value, new_size, expires_at)
+                self.total_bytes += new_size - size
+                self._evict()
+        finally:
+            self._notify()
+
+    def pop(self, key, default=None):
+        try:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    return default
+                expired = self._expired(entry[2])
+                self._remove(key, dropped=expired)
+                return default if expired else entry[0]
+        finally:
+            self._notify()
+
+    def purge_expired(self):
+        """Drops every expired entry. Returns the number removed."""
+        try:
+            with self.lock:
+                expired = [key for key, (_, _, expires_at) in self.entries.items() if self._expired(expires_at)]
+                for key in expired:
+                    self._remove(key)
+                return len(expired)
+        finally:
+            self._notify()
+
+    def clear(self):
+        try:
+            with self.lock:
+                for key in list(self.entries):
+                    self._remove(key)
+        finally:
+            self._notify()
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and not self._expired(entry[2])
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SqliteCache():
+    """
+    On-disk cache backed by sqlite, so entries survive restarts and can be
+    shared by several worker processes. Entries older than ttl seconds are
+    treated as missing. Values are stored as-is unless pickled=True. Every
+    set drops the expired rows and, past max_entries, the oldest ones.
+    """
+
+    def __init__(self, path, ttl=None, pickled=False, max_entries=None):
+        self.ttl = ttl
+        self.pickled = pickled
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl is not None and row[1] + self.ttl <= time.time()):
+                self.misses += 1
+                return default
+            self.hits += 1
+            return pickle.loads(row[0]) if self.pickled else row[0]
+
+    def set(self, key, value):
+        if self.pickled:
+            value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)",
+                (key, value, now),
+            )
+            if self.ttl is not None:
+                self.evictions += self.conn.execute("DELETE FROM cache WHERE created <= ?", (now - self.ttl,)).rowcount
+            if self.max_entries is not None:
+                self.evictions += self.conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        return value
+
+    def __contains__(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT created FROM cache WHERE key = ?", (key,)).fetchone()
+            return row is not None and (self.ttl is None or row[0] + self.ttl > time.time())
+
+    def purge_expired(self):
+        if self.ttl is None:
+            return 0
+        with self.lock, self.conn:
+            return self.conn.execute("DELETE FROM cache WHERE created <= ?", (time.time() - self.ttl,)).rowcount
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            return {'entries': entries, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class TieredCache():
+    """In-memory LRU in front of an optional persistent tier. Disk hits are promoted to memory."""
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+                return value
+        return default
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def stats(self):
+        stats = {'memory': self.memory.stats()}
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
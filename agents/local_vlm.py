@@ -0,0 +1,417 @@
+import asyncio
+import base64
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image
+
+from agents.cache import LRUCache, hash_bytes
+from agents.transport import VLMUnavailable
+
+# Local vision-language model used when VLM_BACKEND=local.
+LOCAL_MODEL = "Qwen/Qwen2.5-VL-3B-Instruct"
+
+
+def completion(content):
+    """Chat completion shaped like InferenceClient's, so callers read choices[0].message.content."""
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason="stop")])
+
+
+def completion_chunk(content):
+    """Streamed chunk shaped like InferenceClient's, read as choices[0].delta.content."""
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=None)])
+
+
+def parse_messages(messages):
+    """Returns (prompt text, PIL image or None, image hash or None) of a single user message in the OpenAI format."""
+    content = messages[-1]["content"]
+    if isinstance(content, str):
+        return content, None, None
+    texts = []
+    image = None
+    image_hash = None
+    for part in content:
+        if part.get("type") == "text":
+            texts.append(part["text"])
+        elif part.get("type") == "image_url":
+            url = part["image_url"]["url"]
+            image = Image.open(BytesIO(base64.b64decode(url.split(",", 1)[1]))).convert("RGB")
+            image_hash = hash_bytes(url)
+    return "\n".join(texts), image, image_hash
+
+
+class LocalRequest():
+    """One queued prompt. Tokens are pushed as they are generated; stream readers get the decoded text deltas."""
+
+    def __init__(self, prompt, image, max_tokens, stream, image_hash=None):
+        self.prompt = prompt
+        self.image = image
+        self.image_hash = image_hash
+        self.max_tokens = max_tokens
+        self.future = Future()
+        self.chunks = queue.Queue() if stream else None
+        # Set by async readers to be woken without holding a thread
+        self.notify = None
+        self.tokens = []
+        self.sent = ""
+        self.enqueued = time.monotonic()
+
+    def _put(self, item):
+        self.chunks.put(item)
+        if self.notify is not None:
+            self.notify()
+
+    def push(self, token_id, tokenizer):
+        if len(self.tokens) >= self.max_tokens:
+            return
+        self.tokens.append(token_id)
+        if self.chunks is not None:
+            text = tokenizer.decode(self.tokens, skip_special_tokens=True)
+            # Hold back incomplete multi-byte characters until the next token
+            if len(text) > len(self.sent) and not text.endswith("\ufffd"):
+                self._put(text[len(self.sent):])
+                self.sent = text
+
+    def finish(self, text):
+        if self.chunks is not None:
+            if text.startswith(self.sent) and len(text) > len(self.sent):
+                self._put(text[len(self.sent):])
+            self._put(None)
+        # A caller that timed out has cancelled the future
+        if not self.future.done():
+            self.future.set_result(text)
+
+    def fail(self, error):
+        if self.chunks is not None:
+            self._put(error)
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class BatchStreamer():
+    """
+    generate() streamer for a whole batch: hands the token generated for each
+    row at every step to that row's LocalRequest.
+    """
+
+    def __init__(self, requests, tokenizer):
+        self.requests = requests
+        self.tokenizer = tokenizer
+        self.prompt_seen = False
+
+    def put(self, value):
+        # The first call carries the prompt ids
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for request, token_id in zip(self.requests, value.reshape(-1).tolist()):
+            request.push(token_id, self.tokenizer)
+
+    def end(self):
+        pass
+
+
+class ImagePrefix():
+    """
+    Key/value cache of a prompt prefix that ends with an image: the chat
+    template up to the vision end token, with the vision encoder output
+    already run through every decoder layer.
+    """
+
+    def __init__(self, input_ids, past_key_values, rope_delta):
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values  # tuple of (key, value) per layer, batch size 1
+        self.rope_delta = rope_delta
+        self.nbytes = sum(key.nbytes + value.nbytes for key, value in past_key_values)
+
+    def __len__(self):
+        return self.input_ids.shape[0]
+
+
+class LocalVLMBackend():
+    """
+    Runs a vision-language model through transformers in this process. A
+    scheduler thread collects the prompts of concurrent requests for up to
+    batch_wait seconds (or max_batch prompts) and answers them with one
+    batched generate() call; prompts arriving meanwhile form the next batch.
+    Exposes the same chat()/achat()/stats() interface as VLMTransport, so
+    call_qwen_vision_api and its streaming variant work unchanged.
+
+    For Qwen2-VL style models the image prefix of each prompt is cached per
+    image hash in prefix_cache, so follow-up prompts about the same image
+    skip the vision encoder and only prefill their text tokens.
+    """
+
+    def __init__(self, model_id=LOCAL_MODEL, device=None, max_batch=4, batch_wait=0.02, timeout=300.0,
+                 prefix_cache=None):
+        self.model_id = model_id
+        self.device = device
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.model = None
+        self.processor = None
+        self.batches = 0
+        self.requests = 0
+        self.batched_requests = 0
+        self.queue_seconds = 0.0
+        self.prefix_cache = prefix_cache
+        self.reused_prefix_tokens = 0
+
+    def _load(self):
+        if self.model is None:
+            import torch
+            from transformers import AutoProcessor
+            try:
+                from transformers import AutoModelForImageTextToText as AutoModel
+            except ImportError:
+                from transformers import AutoModelForVision2Seq as AutoModel
+
+            device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+            print(f"Loading local VLM {self.model_id} on {device}")
+            processor = AutoProcessor.from_pretrained(self.model_id)
+            # Batched prompts are padded on the left so every row ends where generation starts
+            processor.tokenizer.padding_side = "left"
+            model = AutoModel.from_pretrained(self.model_id, torch_dtype=torch.float32 if device == "cpu" else "auto")
+            self.processor = processor
+            self.model = model.to(device).eval()
+            self.device = device
+        return self.model, self.processor
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="local-vlm", daemon=True)
+                self.thread.start()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=max(remaining, 0)) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [request for request in self._next_batch() if not request.future.cancelled()]
+            # Prompts with and without an image cannot share a processor call
+            for group in (
+                [request for request in batch if request.image is not None],
+                [request for request in batch if request.image is None],
+            ):
+                if group:
+                    self._generate(group)
+
+    def _chat_text(self, processor, request):
+        content = ([{"type": "image"}] if request.image is not None else []) + [{"type": "text", "text": request.prompt}]
+        return processor.apply_chat_template([{"role": "user", "content": content}], add_generation_prompt=True)
+
+    def _uses_prefix_cache(self, model, batch):
+        # Needs a vision end token to split prompts on and the rope_deltas of mRoPE models
+        return (self.prefix_cache is not None and batch[0].image is not None
+                and getattr(model.config, "vision_end_token_id", None) is not None and hasattr(model, "rope_deltas"))
+
+    def _generate(self, batch):
+        try:
+            model, processor = self._load()
+            start = time.monotonic()
+            self.batches += 1
+            self.requests += len(batch)
+            self.batched_requests += len(batch) if len(batch) > 1 else 0
+            self.queue_seconds += sum(start - request.enqueued for request in batch)
+
+            if self._uses_prefix_cache(model, batch):
+                inputs = self._prefixed_inputs(model, processor, batch)
+            else:
+                texts = [self._chat_text(processor, request) for request in batch]
+                images = [request.image for request in batch] if batch[0].image is not None else None
+                inputs = processor(text=texts, images=images, padding=True, return_tensors="pt").to(self.device)
+            self._run_generate(model, processor, batch, inputs)
+        except Exception as e:
+            print(f"Local VLM batch of {len(batch)} failed: {e}")
+            for request in batch:
+                request.fail(e)
+
+    def _run_generate(self, model, processor, batch, inputs):
+        import torch
+        with torch.inference_mode():
+            output = model.generate(
+                **inputs,
+                max_new_tokens=max(request.max_tokens for request in batch),
+                do_sample=False,
+                streamer=BatchStreamer(batch, processor.tokenizer),
+            )
+        prompt_length = inputs["input_ids"].shape[1]
+        for request, row in zip(batch, output[:, prompt_length:]):
+            request.finish(processor.tokenizer.decode(row[:request.max_tokens], skip_special_tokens=True))
+
+    def _image_prefix(self, model, processor, request, prefix_text):
+        """Returns the cached ImagePrefix of the request's image, computing it on a miss."""
+        import torch
+        key = hash_bytes(request.image_hash + prefix_text)
+        prefix = self.prefix_cache.get(key)
+        if prefix is not None:
+            self.reused_prefix_tokens += len(prefix)
+            return prefix
+        inputs = processor(text=[prefix_text], images=[request.image], return_tensors="pt").to(self.device)
+        with torch.inference_mode():
+            output = model(**inputs, use_cache=True)
+        past_key_values = output.past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        prefix = ImagePrefix(inputs["input_ids"][0], tuple(past_key_values), int(output.rope_deltas.reshape(-1)[0]))
+        self.prefix_cache.set(key, prefix)
+        return prefix
+
+    def _prefixed_inputs(self, model, processor, batch):
+        """
+        generate() inputs for a batch whose image prefixes come from the cache.
+        Each row is laid out as [padding, prefix, padding, text], with the
+        prefixes ending at the same column so their key/values form one cache
+        tensor; per-row rope deltas keep the positions of the text tokens
+        identical to an unpadded prompt.
+        """
+        import torch
+        from transformers import DynamicCache
+
+        tokenizer = processor.tokenizer
+        vision_end = tokenizer.convert_ids_to_tokens(model.config.vision_end_token_id)
+        rows = []
+        for request in batch:
+            before, _, text = self._chat_text(processor, request).rpartition(vision_end)
+            prefix = self._image_prefix(model, processor, request, before + vision_end)
+            rows.append((prefix, torch.tensor(tokenizer(text, add_special_tokens=False)["input_ids"], dtype=torch.long)))
+
+        prefix_length = max(len(prefix) for prefix, _ in rows)
+        total_length = prefix_length + max(len(text_ids) for _, text_ids in rows)
+        input_ids = torch.full((len(rows), total_length), tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), total_length), dtype=torch.long)
+        rope_deltas = torch.zeros((len(rows), 1), dtype=torch.long)
+        layers = []
+        for key, value in rows[0][0].past_key_values:
+            layers.append((key.new_zeros((len(rows), key.shape[1], prefix_length, key.shape[3])),
+                           value.new_zeros((len(rows), value.shape[1], prefix_length, value.shape[3]))))
+        for row, (prefix, text_ids) in enumerate(rows):
+            length = len(prefix)
+            input_ids[row, prefix_length - length:prefix_length] = prefix.input_ids
+            attention_mask[row, prefix_length - length:prefix_length] = 1
+            input_ids[row, total_length - len(text_ids):] = text_ids
+            attention_mask[row, total_length - len(text_ids):] = 1
+            rope_deltas[row, 0] = prefix.rope_delta + length + len(text_ids) - total_length
+            for (key, value), (cached_key, cached_value) in zip(layers, prefix.past_key_values):
+                key[row, :, prefix_length - length:] = cached_key[0]
+                value[row, :, prefix_length - length:] = cached_value[0]
+
+        # Read by the model instead of recomputing positions, since the prefill is skipped
+        model.rope_deltas = rope_deltas.to(self.device)
+        return {
+            "input_ids": input_ids.to(self.device),
+            "attention_mask": attention_mask.to(self.device),
+            "past_key_values": DynamicCache.from_legacy_cache(tuple(layers)),
+        }
+
+    def submit(self, messages, max_tokens, stream=False):
+        prompt, image, image_hash = parse_messages(messages)
+        request = LocalRequest(prompt, image, max_tokens, stream, image_hash)
+        self._start()
+        self.queue.put(request)
+        return request
+
+    def _stream(self, request):
+        while True:
+            try:
+                item = request.chunks.get(timeout=self.timeout)
+            except queue.Empty:
+                request.future.cancel()
+                raise VLMUnavailable("Local VLM timed out")
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield completion_chunk(item)
+
+    def chat(self, messages, max_tokens, model=None, kind=None, stream=False):
+        """Queues the prompt for the next batch. model and kind are accepted for VLMTransport compatibility."""
+        request = self.submit(messages, max_tokens, stream)
+        if stream:
+            return self._stream(request)
+        try:
+            return completion(request.future.result(timeout=self.timeout))
+        except FutureTimeout:
+            request.future.cancel()
+            raise VLMUnavailable("Local VLM timed out")
+
+    async def _astream(self, request):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        request.notify = lambda: loop.call_soon_threadsafe(ready.set)
+        while True:
+            try:
+                item = request.chunks.get_nowait()
+            except queue.Empty:
+                # A chunk pushed from now on sets ready once this coroutine yields
+                ready.clear()
+                try:
+                    await asyncio.wait_for(ready.wait(), self.timeout)
+                except asyncio.TimeoutError:
+                    request.future.cancel()
+                    raise VLMUnavailable("Local VLM timed out")
+                continue
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield completion_chunk(item)
+
+    async def achat(self, messages, max_tokens, model=None, kind=None, stream=False):
+        request = self.submit(messages, max_tokens, stream)
+        if stream:
+            return self._astream(request)
+        try:
+            return completion(await asyncio.wait_for(asyncio.wrap_future(request.future), self.timeout))
+        except asyncio.TimeoutError:
+            raise VLMUnavailable("Local VLM timed out")
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'batched_requests': self.batched_requests,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'mean_queue_seconds': self.queue_seconds / self.requests if self.requests else 0.0,
+            'queued': self.queue.qsize(),
+            'reused_prefix_tokens': self.reused_prefix_tokens,
+            'prefix_cache': self.prefix_cache.stats() if self.prefix_cache is not None else {},
+        }
+
+
+def create_local_backend():
+    """
+    Builds the local backend from VLM_LOCAL_MODEL, VLM_LOCAL_DEVICE, VLM_LOCAL_BATCH,
+    VLM_LOCAL_BATCH_WAIT, VLM_LOCAL_TIMEOUT and the VLM_PREFIX_CACHE_* bounds
+    (VLM_PREFIX_CACHE_MB=0 disables prefix reuse).
+    """
+    prefix_cache_mb = int(os.environ.get("VLM_PREFIX_CACHE_MB", "512"))
+    return LocalVLMBackend(
+        model_id=os.environ.get("VLM_LOCAL_MODEL", LOCAL_MODEL),
+        device=os.environ.get("VLM_LOCAL_DEVICE") or None,
+        max_batch=int(os.environ.get("VLM_LOCAL_BATCH", "4")),
+        batch_wait=float(os.environ.get("VLM_LOCAL_BATCH_WAIT", "0.02")),
+        timeout=float(os.environ.get("VLM_LOCAL_TIMEOUT", "300")),
+        prefix_cache=LRUCache(
+            max_entries=int(os.environ.get("VLM_PREFIX_CACHE_ENTRIES", "16")),
+            max_bytes=prefix_cache_mb * 1024 * 1024,
+        ) if prefix_cache_mb > 0 else None,
+    )
@@ -0,0 +1,227 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Histogram():
+    """Cumulative-bucket latency histogram with labels, rendered in Prometheus text format."""
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}  # labels -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class Gauge():
+    """Labelled gauge, rendered in Prometheus text format."""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Registry():
+    """Holds the app's metrics and renders them for the /metrics endpoint."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help):
+        metric = Gauge(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, name, stats_fn, **labels):
+        """Exposes the numeric entries of stats_fn() (e.g. cache stats) as gauges named <name>_<key>."""
+        self.collectors.append((name, stats_fn, labels))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for name, stats_fn, labels in self.collectors:
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                print(f"Metrics collector {name} failed: {e}")
+                continue
+            lines.extend(_render_stats(name, stats, tuple(sorted(labels.items()))))
+        return "\n".join(lines) + "\n"
+
+
+def _render_stats(name, stats, labels):
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            lines.extend(_render_stats(name, value, labels + (("tier", key),)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{name}_{key}{_format_labels(labels)} {value}")
+    return lines
+
+
+registry = Registry()
+stage_seconds = registry.histogram("app_stage_seconds", "Time spent in each VLM, TTS, ASR, SAM3, OCR and image stage.")
+stages_in_flight = registry.gauge("app_stages_in_flight", "Stages currently running.")
+request_seconds = registry.histogram("app_request_seconds", "End-to-end request time per endpoint, including streaming.")
+requests_in_flight = registry.gauge("app_requests_in_flight", "Requests currently being processed per endpoint.")
+
+# Per-request stage totals; propagated into worker threads by submit_with_context.
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def request_timings():
+    """Returns {stage: seconds} accumulated so far by the current request, rounded for reporting."""
+    timings = _request_timings.get()
+    if timings is None:
+        return {}
+    return {stage: round(elapsed, 4) for stage, elapsed in dict(timings).items()}
+
+
+def observe_stage(stage, elapsed):
+    """Records an already measured stage duration."""
+    stage_seconds.observe(elapsed, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def span(stage):
+    """Times the enclosed block as one occurrence of stage."""
+    stages_in_flight.inc(stage=stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages_in_flight.dec(stage=stage)
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """executor.submit that runs fn in a copy of the caller's context, so spans reach the request's timings."""
+    ctx = contextvars.copy_context()
+    return executor.submit(ctx.run, fn, *args, **kwargs)
+
+
+@contextmanager
+def track_request(endpoint):
+    """Times a whole request and collects its stage timings. Yields the timings dict."""
+    timings = {}
+    token = _request_timings.set(timings)
+    requests_in_flight.inc(endpoint=endpoint)
+    start = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        requests_in_flight.dec(endpoint=endpoint)
+        request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+        _request_timings.reset(token)
+
+
+def tracked(endpoint):
+    """Decorator that wraps a view in track_request."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with track_request(endpoint):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def track_stream(endpoint, events):
+    """
+    Wraps an SSE generator so the request is timed until the last event.
+    Each step runs in the same private context, whichever thread pulls it.
+    """
+    ctx = contextvars.copy_context()
+    ctx.run(_request_timings.set, {})
+    requests_in_flight.inc(endpoint=endpoint)
+    start = time.perf_counter()
+    try:
+        while True:
+            try:
+                event = ctx.run(next, events)
+            except StopIteration:
+                return
+            yield event
+    finally:
+        events.close()
+        requests_in_flight.dec(endpoint=endpoint)
+        request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+
+
+async def async_track_stream(endpoint, events):
+    """Async counterpart of track_stream. The events run in the request's task, whose context holds the timings."""
+    _request_timings.set({})
+    requests_in_flight.inc(endpoint=endpoint)
+    start = time.perf_counter()
+    try:
+        async for event in events:
+            yield event
+    finally:
+        await events.aclose()
+        requests_in_flight.dec(endpoint=endpoint)
+        request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
@@ -1,14 +1,17 @@
-import os
 import sys
+import threading
 
 import cv2
 import tools.infer.utility as utility
 import numpy as np
 import time
+from PIL import Image
 from ppocr.utils.logging import get_logger
-from ppocr.utils.utility import get_image_file_list, check_and_read
+from ppocr.utils.utility import check_and_read
 from ppocr.data import create_operators, transform
 from ppocr.postprocess import build_post_process
+from utils import pil_to_opencv
+from agents.metrics import span, observe_stage
 
 class OCR_AGENT():
 
@@ -81,7 +84,7 @@ class OCR_AGENT():
         data = transform(data, self.preprocess_op)
         img, shape_list = data
         if img is None:
-            return None, 0
+            return None, [], 0
         img = np.expand_dims(img, axis=0)
         shape_list = np.expand_dims(shape_list, axis=0)
         img = img.copy()
@@ -120,35 +123,77 @@ class OCR_AGENT():
         return dt_boxes, strs, elapse
     
 
-def pladdleOCR():
+def ocr_args():
+    """Builds the PGNet inference arguments used by the app. Does not read sys.argv."""
     args = utility.parse_args()
 
     args.e2e_algorithm="PGNet"
-    # args.image_dir='/content/cropped_image.png'
-    args.image_dir="rotated_image.jpg"
     args.e2e_model_dir="e2e_server_pgnetA_infer"
     args.use_gpu=False
     args.e2e_pgnet_valid_set="totaltext"
     args.rec_char_dict_path = "ppocr/utils/ppocr_keys_v1.txt"
     args.e2e_char_dict_path = "ppocr/utils/ic15_dict.txt"
-
-    image_file_list = get_image_file_list(args.image_dir)
-    text_detector = OCR_AGENT(args)
-    # count = 0
-    # total_time = 0
-    draw_img_save = "./inference_results"
-    if not os.path.exists(draw_img_save):
-        os.makedirs(draw_img_save)
-    for image_file in image_file_list:
-        img, flag, _ = check_and_read(image_file)
+    return args
+
+
+class OCREngine():
+    """
+    Process-resident PGNet engine. The predictor, operators and character
+    dictionary are built once; calls are serialized because a Paddle
+    predictor is not safe to run from several threads at once.
+    """
+
+    def __init__(self, args=None, warmup=False):
+        self.agent = OCR_AGENT(args if args is not None else ocr_args())
+        self.logger = self.agent.logger
+        self.lock = threading.Lock()
+        if warmup:
+            self.warmup()
+
+    def warmup(self, size=640):
+        """Runs one pass on a blank page so the first request does not pay for lazy initialization."""
+        img = np.full((size, size, 3), 255, dtype=np.uint8)
+        _, _, elapse = self.recognize(img)
+        self.logger.info("ocr warmup done in {:.3f}s".format(elapse))
+
+    def recognize(self, img):
+        """Runs PGNet on a BGR ndarray. Returns (points, strs, elapse)."""
+        with span("ocr"):
+            with self.lock:
+                points, strs, elapse = self.agent(img)
+        observe_stage("ocr_inference", elapse)
+        return points, strs, elapse
+
+
+_ocr_engine = None
+_ocr_engine_lock = threading.Lock()
+
+def get_ocr_engine(warmup=False):
+    """Returns the shared OCREngine, building it on first use."""
+    global _ocr_engine
+    if _ocr_engine is None:
+        with _ocr_engine_lock:
+            if _ocr_engine is None:
+                _ocr_engine = OCREngine(warmup=warmup)
+    return _ocr_engine
+
+
+def pladdleOCR(image):
+    """
+    Runs the shared PGNet engine on an in-memory image. Accepts a BGR ndarray,
+    a PIL Image, or (for debugging) a path to an image file.
+    """
+    text_detector = get_ocr_engine()
+
+    if isinstance(image, Image.Image):
+        image = pil_to_opencv(image.convert("RGB"))
+    elif isinstance(image, str):
+        img, flag, _ = check_and_read(image)
         if not flag:
-            img = cv2.imread(image_file)
+            img = cv2.imread(image)
         if img is None:
-            text_detector.logger.info("error in loading image:{}".format(image_file))
-            continue
-        points, strs, elapse = text_detector(img)
-
-    return points, strs, elapse
-
-
+            text_detector.logger.info("error in loading image:{}".format(image))
+            return None, [], 0
+        image = img
 
+    return text_detector.recognize(image)
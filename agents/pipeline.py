@@ -0,0 +1,84 @@
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+
+from agents.metrics import submit_with_context
+
+
+class StageGraph():
+    """
+    Small DAG executor. Each stage is submitted to the executor as soon as the
+    stages it depends on have finished, so independent stages run concurrently.
+    A stage receives its dependencies' results as positional arguments. If a
+    dependency failed the stage fails with the same exception, and if a
+    dependency produced None the stage is skipped and produces None too.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.futures = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+        self.cancelled = False
+
+    def add(self, name, fn, *deps):
+        """Registers a stage and returns its Future."""
+        future = Future()
+        dep_futures = [self.futures[dep] for dep in deps]
+        self.futures[name] = future
+        remaining = [len(dep_futures)]
+
+        def run(args):
+            start = time.perf_counter()
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                self.timings[name] = time.perf_counter() - start
+
+        def launch():
+            if not future.set_running_or_notify_cancel():
+                return
+            if self.cancelled:
+                future.set_exception(CancelledError(f"stage {name} cancelled"))
+                return
+            args = []
+            for dep in dep_futures:
+                error = CancelledError(f"dependency of {name} cancelled") if dep.cancelled() else dep.exception()
+                if error is not None:
+                    future.set_exception(error)
+                    return
+                args.append(dep.result())
+            if any(arg is None for arg in args):
+                future.set_result(None)
+                return
+            try:
+                submit_with_context(self.executor, run, args)
+            except RuntimeError as e:
+                future.set_exception(e)
+
+        def on_dep_done(_):
+            with self.lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                launch()
+
+        if not dep_futures:
+            launch()
+        for dep in dep_futures:
+            dep.add_done_callback(on_dep_done)
+        return future
+
+    def result(self, name, timeout=None):
+        """Waits for a stage and returns its result (re-raising its exception)."""
+        return self.futures[name].result(timeout=timeout)
+
+    def cancel(self):
+        """Cancels every stage that has not started. Running stages finish but are ignored."""
+        self.cancelled = True
+        for future in self.futures.values():
+            future.cancel()
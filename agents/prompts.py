@@ -0,0 +1,153 @@
+import asyncio
+import json
+
+from agents.metrics import submit_with_context
+from agents.vlm import async_call_qwen_vision_api, call_qwen_vision_api, prepare_image, vlm_executor
+from utils import JSONObjectStream
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+def validate(value, schema):
+    """
+    Checks value against a small JSON Schema subset: type (a name or a list of
+    names), enum, minLength, items, minItems, maxItems, properties and required.
+    """
+    types = schema.get("type")
+    if types is not None:
+        types = [types] if isinstance(types, str) else types
+        # bool is an int in Python but not a JSON number
+        if not any(isinstance(value, _TYPES[t]) and not (isinstance(value, bool) and t in ("number", "integer"))
+                   for t in types):
+            return False
+    if "enum" in schema and value not in schema["enum"]:
+        return False
+    if isinstance(value, str) and len(value.strip()) < schema.get("minLength", 0):
+        return False
+    if isinstance(value, list):
+        if not schema.get("minItems", 0) <= len(value) <= schema.get("maxItems", len(value)):
+            return False
+        if "items" in schema and not all(validate(item, schema["items"]) for item in value):
+            return False
+    if isinstance(value, dict):
+        if any(key not in value for key in schema.get("required", ())):
+            return False
+        for key, subschema in schema.get("properties", {}).items():
+            if key in value and not validate(value[key], subschema):
+                return False
+    return True
+
+
+class Question():
+    """
+    One question that can be fused with others about the same image. The fused
+    answer is read from the key entry of a JSON object and must match schema
+    (after coerce, if given); otherwise the question is asked on its own with
+    prompt, and parse turns that standalone answer into a value.
+    """
+
+    def __init__(self, key, instruction, schema, prompt, parse, coerce=None, max_tokens=64):
+        self.key = key
+        self.instruction = instruction
+        self.schema = schema
+        self.prompt = prompt
+        self.parse = parse
+        self.coerce = coerce
+        self.max_tokens = max_tokens
+
+
+def fused_prompt(questions):
+    """One prompt asking for every answer as a key of a single JSON object."""
+    lines = "\n".join(f'- "{question.key}": {question.instruction}' for question in questions)
+    return ("Answer these questions about the image. Output a single JSON object with exactly these keys, in JSON format:\n"
+            f"{lines}")
+
+
+def parse_fused(data, questions):
+    """Returns {key: value} for every question whose answer in data matches its schema."""
+    objects = JSONObjectStream().feed(data or "")
+    if objects:
+        answer = objects[0]
+    else:
+        # Some answers come without the ```json fence
+        try:
+            answer = json.loads(data[data.index("{"):data.rindex("}") + 1])
+        except (TypeError, ValueError):
+            return {}
+    if not isinstance(answer, dict):
+        return {}
+
+    answers = {}
+    for question in questions:
+        if question.key not in answer:
+            continue
+        value = answer[question.key]
+        if question.coerce is not None:
+            value = question.coerce(value)
+        if validate(value, question.schema):
+            answers[question.key] = value
+    return answers
+
+
+# Calls sent by ask_questions, for the /metrics endpoint
+fusion_stats = {'fused_calls': 0, 'fused_answers': 0, 'split_calls': 0}
+
+
+def _ask_single(img_b64, question, mime_type, kind):
+    return question.parse(call_qwen_vision_api(img_b64, question.prompt, max_tokens=question.max_tokens, mime_type=mime_type, kind=kind))
+
+
+def ask_questions(image, questions, kind):
+    """
+    Asks all questions in one VLM call with a fused prompt. Questions whose
+    answer is missing or does not match its schema are asked again on their
+    own, concurrently through the VLM pool. Returns ({key: value}, scale of
+    the encoded image as in prepare_image, raw fused answer).
+    """
+    img_b64, mime_type, scale = prepare_image(image, kind)
+    max_tokens = sum(question.max_tokens for question in questions) + 32
+    fusion_stats['fused_calls'] += 1
+    raw = call_qwen_vision_api(img_b64, fused_prompt(questions), max_tokens=max_tokens, mime_type=mime_type, kind=kind)
+    answers = parse_fused(raw, questions)
+    fusion_stats['fused_answers'] += len(answers)
+
+    missing = [question for question in questions if question.key not in answers]
+    if missing:
+        print(f"Fused answer incomplete, asking {[question.key for question in missing]} separately")
+        fusion_stats['split_calls'] += len(missing)
+        futures = {question.key: submit_with_context(vlm_executor, _ask_single, img_b64, question, mime_type, kind)
+                   for question in missing}
+        for key, future in futures.items():
+            answers[key] = future.result()
+    return answers, scale, raw
+
+
+async def _async_ask_single(img_b64, question, mime_type, kind):
+    return question.parse(await async_call_qwen_vision_api(img_b64, question.prompt, max_tokens=question.max_tokens, mime_type=mime_type, kind=kind))
+
+
+async def async_ask_questions(image, questions, kind):
+    """Awaitable variant of ask_questions. Encoding runs in the VLM pool."""
+    loop = asyncio.get_running_loop()
+    img_b64, mime_type, scale = await loop.run_in_executor(vlm_executor, prepare_image, image, kind)
+    max_tokens = sum(question.max_tokens for question in questions) + 32
+    fusion_stats['fused_calls'] += 1
+    raw = await async_call_qwen_vision_api(img_b64, fused_prompt(questions), max_tokens=max_tokens, mime_type=mime_type, kind=kind)
+    answers = parse_fused(raw, questions)
+    fusion_stats['fused_answers'] += len(answers)
+
+    missing = [question for question in questions if question.key not in answers]
+    if missing:
+        print(f"Fused answer incomplete, asking {[question.key for question in missing]} separately")
+        fusion_stats['split_calls'] += len(missing)
+        values = await asyncio.gather(*(_async_ask_single(img_b64, question, mime_type, kind) for question in missing))
+        answers.update((question.key, value) for question, value in zip(missing, values))
+    return answers, scale, raw
@@ -1,27 +1,191 @@
-from gradio_client import Client, handle_file
 import numpy as np
+import tempfile
+import threading
+import time
 import cv2
+import os
 
-sam3 = Client("akhaliq/sam3")
+from utils import opencv_to_pil, pil_to_opencv, downscale_max_side
+from agents.cache import LRUCache, hash_bytes
+from agents.metrics import span
 
-def get_mask():
 
+class SAM3Backend():
+    """
+    SAM3 on the akhaliq/sam3 Hugging Face Space. The gradio client is only
+    created on first use, and after a failure the Space is skipped for
+    retry_after seconds so requests go straight to the next backend.
+    """
 
-    result = sam3.predict(
-        image=handle_file('cropped_image.jpg'),
-        text="document",
-        threshold=0.3,
-        mask_threshold=0.5,
-        api_name="/segment"
+    name = "sam3"
+
+    def __init__(self, space="akhaliq/sam3", retry_after=60.0):
+        self.space = space
+        self.retry_after = retry_after
+        self.client = None
+        self.unavailable_until = 0.0
+        self.lock = threading.Lock()
+
+    def _client(self):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    from gradio_client import Client
+                    self.client = Client(self.space)
+        return self.client
+
+    def segment(self, image):
+        """Returns a boolean mask, or None when SAM3 finds no document."""
+        if time.monotonic() < self.unavailable_until:
+            raise RuntimeError("SAM3 Space marked unavailable")
+        from gradio_client import handle_file
+
+        # The Space only accepts file uploads, so the image goes through a
+        # per-call temporary file that is removed as soon as the upload is done.
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as temp_image:
+            image.save(temp_image, format="JPEG")
+            temp_image_path = temp_image.name
+
+        try:
+            with span("sam3"):
+                result = self._client().predict(
+                    image=handle_file(temp_image_path),
+                    text="document",
+                    threshold=0.3,
+                    mask_threshold=0.5,
+                    api_name="/segment"
+                )
+        except Exception:
+            self.unavailable_until = time.monotonic() + self.retry_after
+            raise
+        finally:
+            os.unlink(temp_image_path)
+
+        if len(result[0]['annotations']) == 0:
+            return None
+        pred_mask = cv2.imread(result[0]['annotations'][0]['image'], cv2.IMREAD_GRAYSCALE)
+        if pred_mask.shape != (image.height, image.width):
+            pred_mask = cv2.resize(pred_mask, (image.width, image.height), interpolation=cv2.INTER_NEAREST)
+        return pred_mask > 0
+
+
+class OpenCVBackend():
+    """
+    Classical CPU fallback. Looks for the largest four-sided contour (the
+    paper's outline) and falls back to GrabCut seeded with a centered
+    rectangle. Works on a copy downscaled to max_side, so it takes milliseconds.
+    """
+
+    name = "opencv"
+
+    def __init__(self, max_side=512, min_area=0.2, grabcut_iterations=3):
+        self.max_side = max_side
+        self.min_area = min_area
+        self.grabcut_iterations = grabcut_iterations
+
+    def _document_quad(self, bgr):
+        gray = cv2.GaussianBlur(cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        edges = cv2.dilate(cv2.Canny(gray, 50, 150), np.ones((3, 3), np.uint8))
+        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        min_area = self.min_area * bgr.shape[0] * bgr.shape[1]
+        for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+            if cv2.contourArea(contour) < min_area:
+                break
+            quad = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+            if len(quad) == 4 and cv2.isContourConvex(quad):
+                return quad
+        return None
+
+    def _grabcut(self, bgr):
+        h, w = bgr.shape[:2]
+        mask = np.zeros((h, w), np.uint8)
+        rect = (max(1, w // 20), max(1, h // 20), w - 2 * max(1, w // 20), h - 2 * max(1, h // 20))
+        cv2.grabCut(bgr, mask, rect, np.zeros((1, 65), np.float64), np.zeros((1, 65), np.float64),
+                    self.grabcut_iterations, cv2.GC_INIT_WITH_RECT)
+        foreground = (mask == cv2.GC_FGD) | (mask == cv2.GC_PR_FGD)
+        return foreground if foreground.mean() >= self.min_area else None
+
+    def segment(self, image):
+        small = downscale_max_side(image, self.max_side)
+        bgr = pil_to_opencv(small)
+        with span("segment_opencv"):
+            quad = self._document_quad(bgr)
+            if quad is not None:
+                mask = np.zeros(bgr.shape[:2], np.uint8)
+                cv2.fillPoly(mask, [quad], 1)
+            else:
+                foreground = self._grabcut(bgr)
+                if foreground is None:
+                    return None
+                mask = foreground.astype(np.uint8)
+        if small.size != image.size:
+            mask = cv2.resize(mask, image.size, interpolation=cv2.INTER_NEAREST)
+        return mask > 0
+
+
+SEGMENTATION_BACKENDS = {
+    SAM3Backend.name: SAM3Backend,
+    OpenCVBackend.name: OpenCVBackend,
+}
+
+
+class SegmentationService():
+    """
+    Tries each backend in order until one answers. A backend that fails hands
+    over to the next one; one that finds no document is final, and the image
+    is kept whole. Masks are cached by a hash of the image pixels.
+    """
+
+    def __init__(self, backends, max_entries=32, max_bytes=64 * 1024 * 1024):
+        self.backends = backends
+        self.cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    def get_mask(self, image):
+        if isinstance(image, np.ndarray):
+            image = opencv_to_pil(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        key = hash_bytes(f"{image.size}".encode() + image.tobytes())
+        mask = self.cache.get(key)
+        if mask is not None:
+            return mask
+
+        mask = None
+        for backend in self.backends:
+            try:
+                mask = backend.segment(image)
+            except Exception as e:
+                print(f"Segmentation backend {backend.name} failed: {e}")
+                continue
+            break
+        if mask is None:
+            mask = np.ones((image.height, image.width), dtype=bool)
+        self.cache.set(key, mask)
+        return mask
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def create_segmentation_service():
+    """Builds the backend chain listed in SEGMENTATION_BACKEND, e.g. 'sam3,opencv' or 'opencv'."""
+    names = [name.strip() for name in os.environ.get("SEGMENTATION_BACKEND", "sam3,opencv").split(",") if name.strip()]
+    unknown = [name for name in names if name not in SEGMENTATION_BACKENDS]
+    if unknown:
+        raise ValueError(f"Unknown SEGMENTATION_BACKEND {unknown}, expected names from {sorted(SEGMENTATION_BACKENDS)}")
+    return SegmentationService(
+        [SEGMENTATION_BACKENDS[name]() for name in names],
+        max_entries=int(os.environ.get("SEGMENTATION_CACHE_ENTRIES", "32")),
     )
 
-    if len(result[0]['annotations']) == 0:
-        img = cv2.imread(result[0]['image'])
-        rows, cols, _ = img.shape
-        pred_mask = np.ones((rows, cols), dtype=bool)
-    else:
-        img = cv2.imread(result[0]['annotations'][0]['image'])
-        pred_mask = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        pred_mask = pred_mask > 0
 
-    return pred_mask
+segmentation = create_segmentation_service()
+
+
+def get_mask(image):
+    """
+    Segments the document in an in-memory image (PIL Image or BGR ndarray).
+    Returns a boolean mask with the image's height and width.
+    """
+    return segmentation.get_mask(image)
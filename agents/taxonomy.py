@@ -0,0 +1,90 @@
+import difflib
+import json
+import re
+from types import MappingProxyType
+
+# Labels every field can fall back to; they are never masked.
+GENERIC_LABELS = ("other", "none")
+
+
+def normalize_label(text):
+    """Lowercases a free-text label and strips quotes, punctuation, articles and extra spaces."""
+    text = re.sub(r"[^a-z0-9/ ]+", " ", str(text).lower())
+    text = re.sub(r"^(?:(?:it is|this is|the category is|category)\s+)?(?:a|an|the)\s+", "", text.strip())
+    return " ".join(text.split())
+
+
+class Taxonomy():
+    """
+    Read-only index over label2item_list.json: metacategory names and their
+    synonyms resolve to a canonical metacategory, which maps to the field
+    labels used to classify its text regions. The field tuples and the
+    category string embedded in classification prompts are built once.
+    """
+
+    def __init__(self, entries, fuzzy_cutoff=0.9):
+        fields = {}
+        names = {}
+        synonyms = {}
+        for name, entry in entries.items():
+            contained = tuple(dict.fromkeys(entry.get("contained_info", [])))
+            fields[name] = contained + tuple(label for label in GENERIC_LABELS if label not in contained)
+            names.setdefault(normalize_label(name), name)
+            for synonym in entry.get("synonym", []):
+                synonyms.setdefault(normalize_label(synonym), name)
+        aliases = dict(synonyms)
+        aliases.update(names)
+
+        union = dict.fromkeys(label for labels in fields.values() for label in labels if label not in GENERIC_LABELS)
+        self.fallback_fields = tuple(union) + GENERIC_LABELS
+        self.fields = MappingProxyType(fields)
+        self.names = MappingProxyType(names)
+        self.aliases = MappingProxyType(aliases)
+        self.prompts = MappingProxyType({name: str(list(labels)) for name, labels in fields.items()})
+        self.fallback_prompt = str(list(self.fallback_fields))
+        self.fuzzy_cutoff = fuzzy_cutoff
+        # Longest first, so "pregnancy test box" wins over "pregnancy test"
+        self._names_by_length = tuple(sorted(names, key=len, reverse=True))
+        self._aliases_by_length = tuple(sorted(aliases, key=len, reverse=True))
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path, 'r') as file:
+            return cls(json.load(file), **kwargs)
+
+    def resolve(self, answer):
+        """
+        Maps a free-text VLM answer to a canonical metacategory. Names win over
+        synonyms: exact name, a name containing or contained in the answer,
+        exact synonym, a synonym inside the answer, then the closest alias.
+        Returns None when nothing is close enough.
+        """
+        if not answer:
+            return None
+        text = normalize_label(answer)
+        if not text:
+            return None
+        if text in self.names:
+            return self.names[text]
+        padded = f" {text} "
+        for name in self._names_by_length:
+            if f" {name} " in padded:
+                return self.names[name]
+        for name in reversed(self._names_by_length):
+            if padded in f" {name} ":
+                return self.names[name]
+        if text in self.aliases:
+            return self.aliases[text]
+        for alias in self._aliases_by_length:
+            if f" {alias} " in padded:
+                return self.aliases[alias]
+        close = difflib.get_close_matches(text, self.aliases.keys(), n=1, cutoff=self.fuzzy_cutoff)
+        return self.aliases[close[0]] if close else None
+
+    def fields_for(self, metacategory):
+        """Field labels of a canonical metacategory; every known field for None or unknown names."""
+        return self.fields.get(metacategory, self.fallback_fields)
+
+    def categories_prompt(self, metacategory):
+        """The field labels formatted for classification prompts."""
+        return self.prompts.get(metacategory, self.fallback_prompt)
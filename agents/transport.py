@@ -0,0 +1,365 @@
+import asyncio
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+# huggingface_hub 1.x moved to httpx and dropped configure_http_backend; requirements.txt pins < 1.0.
+from huggingface_hub import InferenceClient, AsyncInferenceClient, InferenceTimeoutError, configure_http_backend
+
+# Upstream answers worth retrying: timeouts, rate limiting and server-side failures.
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class VLMUnavailable(Exception):
+    """The VLM could not answer within the call's deadline and retry budget."""
+
+
+class CircuitOpen(VLMUnavailable):
+    """Raised without calling upstream while the circuit breaker is open."""
+
+
+def is_retryable(e):
+    status = getattr(getattr(e, "response", None), "status_code", None) or getattr(e, "status", None)
+    if isinstance(status, int):
+        return status in RETRY_STATUSES
+    return isinstance(e, (TimeoutError, asyncio.TimeoutError, InferenceTimeoutError, OSError))
+
+
+class CircuitBreaker():
+    """
+    Opens after failure_threshold consecutive upstream failures and rejects
+    calls for reset_after seconds; then lets a single probe through
+    (half-open) and closes again if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_after=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+    def allow(self):
+        """Raises CircuitOpen when calls are rejected. Returns True if the caller is the half-open probe."""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            self.rejected += 1
+        raise CircuitOpen("VLM upstream unavailable (circuit open)")
+
+    def end_probe(self):
+        """Lets another probe through after one that ended without a recorded outcome."""
+        with self.lock:
+            self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class LatencyTracker():
+    """Sliding window of recent successful call latencies, for hedging thresholds."""
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        with self.lock:
+            if not self.samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(math.ceil(p / 100 * len(ordered))) - 1)]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+def configure_connection_pool(pool_size):
+    """Gives huggingface_hub's per-thread requests sessions a keep-alive pool sized for the VLM workers."""
+    def backend_factory():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    configure_http_backend(backend_factory=backend_factory)
+
+
+class VLMTransport():
+    """
+    Calls chat completions through InferenceClient with a per-call deadline,
+    exponential backoff with full jitter, a shared circuit breaker and,
+    optionally, a hedged duplicate request once a call has been running
+    longer than the hedge_percentile of recent latencies. Timeouts come from
+    timeouts[kind] (default_timeout otherwise) and bound the whole call,
+    retries included; each HTTP attempt only gets the time that is left.
+    """
+
+    def __init__(self, api_key=None, base_url=None, timeouts=None, default_timeout=60.0, retries=2,
+                 backoff=0.5, backoff_max=8.0, hedge_percentile=None, hedge_min_samples=20,
+                 breaker=None, max_workers=8):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyTracker()
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.async_clients = {}
+        self.hedge_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vlm-hedge") if hedge_percentile else None
+        self.calls = 0
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        configure_connection_pool(max_workers)
+
+    def _client_kwargs(self, timeout):
+        kwargs = {"api_key": self.api_key, "timeout": timeout}
+        if self.base_url:
+            kwargs["base_url"] = self.base_url
+        return kwargs
+
+    def client(self, timeout):
+        """InferenceClient for an HTTP timeout, rounded up to whole seconds so few clients are built."""
+        timeout = max(1, math.ceil(timeout))
+        with self.lock:
+            if timeout not in self.clients:
+                self.clients[timeout] = InferenceClient(**self._client_kwargs(timeout))
+            return self.clients[timeout]
+
+    def async_client(self, timeout):
+        timeout = max(1, math.ceil(timeout))
+        with self.lock:
+            if timeout not in self.async_clients:
+                self.async_clients[timeout] = AsyncInferenceClient(**self._client_kwargs(timeout))
+            return self.async_clients[timeout]
+
+    def timeout_for(self, kind):
+        return self.timeouts.get(kind, self.default_timeout)
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def _hedge_delay(self):
+        if not self.hedge_percentile or len(self.latency) < self.hedge_min_samples:
+            return None
+        return self.latency.percentile(self.hedge_percentile)
+
+    def _attempt(self, request, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise VLMUnavailable("VLM deadline exceeded")
+        return self.client(remaining).chat.completions.create(**request)
+
+    def _hedged(self, request, deadline, hedge_delay):
+        primary = self.hedge_executor.submit(self._attempt, request, deadline)
+        done, _ = wait([primary], timeout=min(hedge_delay, max(0, deadline - time.monotonic())))
+        if done:
+            return primary.result()
+        self.hedged += 1
+        backup = self.hedge_executor.submit(self._attempt, request, deadline)
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        self.hedge_wins += 1
+                    # The slower request cannot be aborted mid-flight; its result is dropped.
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def chat(self, messages, max_tokens, model, kind=None, stream=False):
+        """Returns the completion (or the opened stream). Raises VLMUnavailable when the budget runs out."""
+        request = {"model": model, "messages": messages, "max_tokens": max_tokens}
+        if stream:
+            request["stream"] = True
+        deadline = time.monotonic() + self.timeout_for(kind)
+        self.calls += 1
+        attempt = 0
+        while True:
+            probe = self.breaker.allow()
+            start = time.monotonic()
+            try:
+                hedge_delay = None if stream else self._hedge_delay()
+                if hedge_delay is not None:
+                    response = self._hedged(request, deadline, hedge_delay)
+                else:
+                    response = self._attempt(request, deadline)
+            except VLMUnavailable:
+                self.breaker.record_failure()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self.breaker.record_failure()
+                delay = self._delay(attempt)
+                if attempt >= self.retries or time.monotonic() + delay >= deadline:
+                    raise VLMUnavailable(f"VLM request failed after {attempt + 1} attempt(s): {e}") from e
+                attempt += 1
+                self.retried += 1
+                print(f"VLM request failed ({str(e).splitlines()[0]}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            else:
+                self.breaker.record_success()
+                if not stream:
+                    self.latency.record(time.monotonic() - start)
+                return response
+            finally:
+                # A non-retryable error (e.g. 400) or a cancellation says nothing about the upstream
+                if probe:
+                    self.breaker.end_probe()
+
+    async def _async_attempt(self, request, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise VLMUnavailable("VLM deadline exceeded")
+        return await asyncio.wait_for(self.async_client(remaining).chat.completions.create(**request), remaining)
+
+    async def _async_hedged(self, request, deadline, hedge_delay):
+        primary = asyncio.ensure_future(self._async_attempt(request, deadline))
+        done, _ = await asyncio.wait([primary], timeout=min(hedge_delay, max(0, deadline - time.monotonic())))
+        if done:
+            return primary.result()
+        self.hedged += 1
+        backup = asyncio.ensure_future(self._async_attempt(request, deadline))
+        pending = {primary, backup}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def achat(self, messages, max_tokens, model, kind=None, stream=False):
+        """Awaitable chat() for the ASGI serving mode; the losing hedge is cancelled. A stream is an async iterator."""
+        request = {"model": model, "messages": messages, "max_tokens": max_tokens}
+        if stream:
+            request["stream"] = True
+        deadline = time.monotonic() + self.timeout_for(kind)
+        self.calls += 1
+        attempt = 0
+        while True:
+            probe = self.breaker.allow()
+            start = time.monotonic()
+            try:
+                hedge_delay = None if stream else self._hedge_delay()
+                if hedge_delay is not None:
+                    response = await self._async_hedged(request, deadline, hedge_delay)
+                else:
+                    response = await self._async_attempt(request, deadline)
+            except VLMUnavailable:
+                self.breaker.record_failure()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self.breaker.record_failure()
+                delay = self._delay(attempt)
+                if attempt >= self.retries or time.monotonic() + delay >= deadline:
+                    raise VLMUnavailable(f"VLM request failed after {attempt + 1} attempt(s): {e}") from e
+                attempt += 1
+                self.retried += 1
+                await asyncio.sleep(delay)
+                continue
+            else:
+                self.breaker.record_success()
+                if not stream:
+                    self.latency.record(time.monotonic() - start)
+                return response
+            finally:
+                if probe:
+                    self.breaker.end_probe()
+
+    def stats(self):
+        p50, p95 = self.latency.percentile(50), self.latency.percentile(95)
+        return {
+            'calls': self.calls,
+            'retried': self.retried,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'breaker_open': int(self.breaker.state != "closed"),
+            'breaker_rejected': self.breaker.rejected,
+            'latency_p50': p50 or 0.0,
+            'latency_p95': p95 or 0.0,
+        }
+
+
+# Whole-call deadlines per prompt type, in seconds. Override with VLM_TIMEOUTS, e.g. '{"classify": 15}'.
+DEFAULT_TIMEOUTS = {
+    "describe": 45.0,
+    "question": 30.0,
+    "locate": 30.0,
+    "ocr": 60.0,
+    "classify": 30.0,
+}
+
+
+def create_transport(api_key=None, max_workers=8):
+    """Builds the transport from VLM_BASE_URL, VLM_TIMEOUTS, VLM_RETRIES, VLM_HEDGE_PERCENTILE and VLM_BREAKER_* settings."""
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    timeouts.update(json.loads(os.environ.get("VLM_TIMEOUTS", "{}")))
+    hedge = os.environ.get("VLM_HEDGE_PERCENTILE")
+    return VLMTransport(
+        api_key=api_key,
+        base_url=os.environ.get("VLM_BASE_URL") or None,
+        timeouts=timeouts,
+        default_timeout=float(os.environ.get("VLM_TIMEOUT", "60")),
+        retries=int(os.environ.get("VLM_RETRIES", "2")),
+        hedge_percentile=float(hedge) if hedge else None,
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.environ.get("VLM_BREAKER_FAILURES", "5")),
+            reset_after=float(os.environ.get("VLM_BREAKER_RESET", "30")),
+        ),
+        max_workers=max_workers,
+    )
@@ -0,0 +1,152 @@
+import os
+import json
+import base64
+import shutil
+import subprocess
+import threading
+from io import BytesIO
+
+from agents.cache import LRUCache
+from agents.metrics import span
+
+
+class GTTSBackend():
+    """Google Text-to-Speech. Needs network access."""
+
+    name = "gtts"
+
+    def __init__(self, lang='en'):
+        self.lang = lang
+
+    def synthesize(self, text):
+        """Returns MP3 bytes for text."""
+        from gtts import gTTS
+        tts = gTTS(text=text, lang=self.lang, slow=False)
+        audio_fp = BytesIO()
+        tts.write_to_fp(audio_fp)
+        return audio_fp.getvalue()
+
+
+class EspeakBackend():
+    """Offline synthesis with espeak-ng, encoded to MP3 through an ffmpeg pipe."""
+
+    name = "espeak"
+
+    def __init__(self, voice='en', executable=None):
+        self.voice = voice
+        self.executable = executable or shutil.which("espeak-ng") or shutil.which("espeak") or "espeak-ng"
+
+    def synthesize(self, text):
+        """Returns MP3 bytes for text."""
+        wav = subprocess.run(
+            [self.executable, "-v", self.voice, "--stdout", text],
+            check=True, capture_output=True,
+        ).stdout
+        return subprocess.run(
+            ["ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-f", "mp3", "pipe:1"],
+            input=wav, check=True, capture_output=True,
+        ).stdout
+
+
+TTS_BACKENDS = {
+    GTTSBackend.name: GTTSBackend,
+    EspeakBackend.name: EspeakBackend,
+}
+
+
+class TTSService():
+    """
+    Front-end over a TTS backend. Fixed status phrases are synthesized once
+    and persisted to a JSON file; other phrases go through an in-memory LRU.
+    Results are base64-encoded MP3 strings.
+    """
+
+    def __init__(self, backend, phrase_cache_path=None, max_entries=256):
+        self.backend = backend
+        self.phrase_cache_path = phrase_cache_path
+        self.phrases = {}
+        self.dynamic = LRUCache(max_entries=max_entries)
+        self.lock = threading.Lock()
+
+    def _synthesize(self, text):
+        with span("tts"):
+            return base64.b64encode(self.backend.synthesize(text)).decode('utf-8')
+
+    def set_backend(self, backend):
+        """Swaps the backend (e.g. for a test stand-in) and drops audio made by the old one."""
+        with self.lock:
+            self.backend = backend
+            self.phrases = {}
+        self.dynamic.clear()
+
+    def load_phrases(self):
+        """Loads persisted phrase audio made by the current backend."""
+        if not self.phrase_cache_path or not os.path.exists(self.phrase_cache_path):
+            return
+        try:
+            with open(self.phrase_cache_path, 'r') as file:
+                stored = json.load(file)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Could not read TTS phrase cache: {e}")
+            return
+        with self.lock:
+            self.phrases.update(stored.get(self.backend.name, {}))
+
+    def save_phrases(self):
+        if not self.phrase_cache_path:
+            return
+        stored = {}
+        if os.path.exists(self.phrase_cache_path):
+            try:
+                with open(self.phrase_cache_path, 'r') as file:
+                    stored = json.load(file)
+            except (OSError, json.JSONDecodeError):
+                stored = {}
+        with self.lock:
+            stored[self.backend.name] = dict(self.phrases)
+        tmp_path = self.phrase_cache_path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(stored, file)
+        os.replace(tmp_path, self.phrase_cache_path)
+
+    def preload(self, phrases):
+        """Loads the persisted phrase cache and synthesizes any phrase that is missing from it."""
+        self.load_phrases()
+        missing = [text for text in phrases if text not in self.phrases]
+        for text in missing:
+            try:
+                audio = self._synthesize(text)
+            except Exception as e:
+                print(f"Could not precompute audio for '{text}': {e}")
+                continue
+            with self.lock:
+                self.phrases[text] = audio
+        if missing:
+            self.save_phrases()
+
+    def synthesize_base64(self, text):
+        """Returns base64 MP3 audio for text, from cache when possible."""
+        audio = self.phrases.get(text)
+        if audio is not None:
+            return audio
+        audio = self.dynamic.get(text)
+        if audio is not None:
+            return audio
+        audio = self._synthesize(text)
+        self.dynamic.set(text, audio)
+        return audio
+
+    def stats(self):
+        return {'phrases': len(self.phrases), 'dynamic': self.dynamic.stats()}
+
+
+def create_tts_service():
+    """Builds the TTS service selected by the TTS_BACKEND environment variable."""
+    backend_name = os.environ.get("TTS_BACKEND", GTTSBackend.name)
+    if backend_name not in TTS_BACKENDS:
+        raise ValueError(f"Unknown TTS_BACKEND '{backend_name}', expected one of {sorted(TTS_BACKENDS)}")
+    return TTSService(
+        TTS_BACKENDS[backend_name](),
+        phrase_cache_path=os.environ.get("TTS_PHRASE_CACHE", "tts_phrases.json"),
+        max_entries=int(os.environ.get("TTS_CACHE_ENTRIES", "256")),
+    )
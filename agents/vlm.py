@@ -1,93 +1,487 @@
-import requests
+import asyncio
 import os
 import re
 import json
-from huggingface_hub import InferenceClient
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from agents.cache import LRUCache, SqliteCache, TieredCache, hash_bytes
+from agents.metrics import span, submit_with_context
+from agents.transport import VLMUnavailable, create_transport
+from utils import JSONObjectStream, encode_image
 
 HF_API_KEY = os.environ.get("HUGGINGFACE_API_KEY")
-client = InferenceClient(api_key=HF_API_KEY)
 
-def call_qwen_vision_api(img_b64, prompt):
+QWEN_MODEL = "Qwen/Qwen2.5-VL-7B-Instruct"
+
+# Bounded pool for fanning out independent VLM requests.
+VLM_MAX_WORKERS = int(os.environ.get("VLM_MAX_WORKERS", "8"))
+# Number of text regions folded into one classification prompt (0 disables batching).
+VLM_CLASSIFY_BATCH = int(os.environ.get("VLM_CLASSIFY_BATCH", "10"))
+
+vlm_executor = ThreadPoolExecutor(max_workers=VLM_MAX_WORKERS, thread_name_prefix="vlm")
+
+# "remote" (Hugging Face inference) or "local" (transformers in this process, see agents/local_vlm.py).
+VLM_BACKEND = os.environ.get("VLM_BACKEND", "remote")
+
+if VLM_BACKEND == "local":
+    from agents.local_vlm import create_local_backend
+    transport = create_local_backend()
+    # Keeps cached answers of the two backends apart
+    QWEN_MODEL = transport.model_id
+elif VLM_BACKEND == "remote":
+    # Pooled, retrying InferenceClient wrapper with per-kind deadlines and a circuit breaker.
+    # Set VLM_BASE_URL to point it at another endpoint, e.g. mock_vlm_server.py.
+    transport = create_transport(api_key=HF_API_KEY, max_workers=VLM_MAX_WORKERS)
+else:
+    raise ValueError(f"Unknown VLM_BACKEND {VLM_BACKEND!r}, expected 'remote' or 'local'")
+
+# Response cache for identical (model, prompt, image, max_tokens) queries.
+# Set VLM_CACHE_DB to a sqlite path to keep responses across restarts.
+VLM_CACHE_TTL = float(os.environ.get("VLM_CACHE_TTL", "3600"))
+VLM_CACHE_DB = os.environ.get("VLM_CACHE_DB")
+
+vlm_cache = TieredCache(
+    LRUCache(
+        max_entries=int(os.environ.get("VLM_CACHE_ENTRIES", "1024")),
+        max_bytes=int(os.environ.get("VLM_CACHE_MB", "16")) * 1024 * 1024,
+        ttl=VLM_CACHE_TTL,
+    ),
+    SqliteCache(
+        VLM_CACHE_DB,
+        ttl=VLM_CACHE_TTL,
+        max_entries=int(os.environ.get("VLM_CACHE_DB_ENTRIES", "100000")),
+    ) if VLM_CACHE_DB else None,
+)
+
+def vlm_cache_key(model, prompt, img_b64, max_tokens):
+    """Content-addressed cache key for a VLM query."""
+    return hash_bytes(json.dumps([model, prompt, hash_bytes(img_b64), max_tokens]))
+
+def vision_messages(img_b64, prompt, mime_type):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": prompt
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:{mime_type};base64,{img_b64}"}
+                }
+            ]
+        }
+    ]
+
+def call_qwen_vision_api(img_b64, prompt, max_tokens=256, mime_type="image/jpeg", kind=None):
+    """
+    Make API request to Qwen vision model. Identical queries are answered from vlm_cache.
+    kind selects the transport deadline (see VLM_TIMEOUTS).
+    """
+    key = vlm_cache_key(QWEN_MODEL, prompt, img_b64, max_tokens)
+    cached = vlm_cache.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        with span("vlm"):
+            response = transport.chat(vision_messages(img_b64, prompt, mime_type), max_tokens, QWEN_MODEL, kind=kind)
+    except VLMUnavailable as e:
+        raise Exception(f"API request failed: {str(e)}")
+
+    content = response.choices[0].message.content
+    if content:
+        vlm_cache.set(key, content)
+    return content
+
+def call_qwen_vision_api_stream(img_b64, prompt, max_tokens=512, mime_type="image/jpeg", kind=None):
+    """
+    Stream responses from Qwen vision model. Retries only cover opening the stream.
+    """
+    try:
+        with span("vlm_stream_open"):
+            return transport.chat(vision_messages(img_b64, prompt, mime_type), max_tokens, QWEN_MODEL, kind=kind, stream=True)
+    except VLMUnavailable as e:
+        raise Exception(f"API request failed: {str(e)}")
+
+
+async def async_call_qwen_vision_api(img_b64, prompt, max_tokens=256, mime_type="image/jpeg", kind=None):
     """
-    Make API request to Qwen vision model
+    Awaitable variant of call_qwen_vision_api for the ASGI serving mode. Shares vlm_cache.
     """
+    key = vlm_cache_key(QWEN_MODEL, prompt, img_b64, max_tokens)
+    cached = vlm_cache.get(key)
+    if cached is not None:
+        return cached
+
     try:
-        response = client.chat.completions.create(
-            model="Qwen/Qwen2.5-VL-7B-Instruct",
-            messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}
-                    }
-                ]
-            }
-            ],
-            max_tokens=256,
-        )
-    
-        return response.choices[0].message.content
-    
-    except requests.exceptions.Timeout:
-        raise Exception("API request timed out")
-    except requests.exceptions.RequestException as e:
+        with span("vlm"):
+            response = await transport.achat(vision_messages(img_b64, prompt, mime_type), max_tokens, QWEN_MODEL, kind=kind)
+    except VLMUnavailable as e:
         raise Exception(f"API request failed: {str(e)}")
 
-def call_qwen_vision_api_stream(img_b64, prompt):
+    content = response.choices[0].message.content
+    if content:
+        vlm_cache.set(key, content)
+    return content
+
+async def async_call_qwen_vision_api_stream(img_b64, prompt, max_tokens=512, mime_type="image/jpeg", kind=None):
     """
-    Stream responses from Qwen vision model
+    Awaitable variant of call_qwen_vision_api_stream. Returns an async iterator of chunks.
     """
     try:
-        stream = client.chat.completions.create(
-            model="Qwen/Qwen2.5-VL-7B-Instruct",
-            messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}
-                    }
-                ]
-            }
-            ],
-            max_tokens=512,
-            stream=True  # Enable streaming
-        )
-    
-        return stream
-    
-    except requests.exceptions.Timeout:
-        raise Exception("API request timed out")
-    except requests.exceptions.RequestException as e:
+        with span("vlm_stream_open"):
+            return await transport.achat(vision_messages(img_b64, prompt, mime_type), max_tokens, QWEN_MODEL, kind=kind, stream=True)
+    except VLMUnavailable as e:
         raise Exception(f"API request failed: {str(e)}")
 
 
 def extract_bbox(data):
-    match = re.search(r'```json\n(.*?)\n```', data, re.DOTALL)
+    """Returns the bbox_2d of the first object in a fenced JSON answer, or None."""
+    objects = JSONObjectStream().feed(data)
+    if objects and isinstance(objects[0], dict) and "bbox_2d" in objects[0]:
+        return objects[0]["bbox_2d"]
+    return None
+
+
+
+class ImageBudget():
+    """How an image is downscaled and encoded before it is sent with a given kind of prompt."""
+
+    def __init__(self, max_side=None, max_pixels=None, format="JPEG", quality=85):
+        self.max_side = max_side
+        self.max_pixels = max_pixels
+        self.format = format.upper()
+        self.quality = quality
+
+    @property
+    def mime_type(self):
+        return f"image/{self.format.lower()}"
+
+
+# Per prompt type image budgets. Override with VLM_IMAGE_BUDGETS, e.g.
+# '{"classify": {"max_side": 768, "quality": 80}, "ocr": {"format": "WEBP"}}'.
+IMAGE_BUDGETS = {
+    "describe": ImageBudget(max_side=1024, max_pixels=1024 * 768, quality=85),
+    "question": ImageBudget(max_side=1280, max_pixels=1280 * 960, quality=88),
+    "locate": ImageBudget(max_side=1024, max_pixels=1024 * 768, quality=85),
+    "ocr": ImageBudget(max_side=1600, max_pixels=1600 * 1200, quality=92),
+    "classify": ImageBudget(max_side=1024, max_pixels=1024 * 768, quality=85),
+}
+
+for _kind, _overrides in json.loads(os.environ.get("VLM_IMAGE_BUDGETS", "{}")).items():
+    _budget = IMAGE_BUDGETS.get(_kind, ImageBudget())
+    IMAGE_BUDGETS[_kind] = ImageBudget(**{**vars(_budget), **_overrides})
+
+def prepare_image(image, kind):
+    """
+    Downscales and encodes an image (PIL Image or RequestImage) with the budget of
+    the given prompt kind. Returns (base64, mime type, (scale_x, scale_y)) where the
+    scales map coordinates on the encoded image back to the original.
+    """
+    budget = IMAGE_BUDGETS[kind]
+    args = (budget.max_side, budget.max_pixels, budget.format, budget.quality)
+    if hasattr(image, "encoded"):
+        img_b64, size = image.encoded(*args)
+        original_size = image.image.size
+    else:
+        img_b64, size = encode_image(image, *args)
+        original_size = image.size
+    scale = (original_size[0] / size[0], original_size[1] / size[1])
+    return img_b64, budget.mime_type, scale
+
+def scale_bbox(bbox, scale):
+    """Maps an (x1, y1, x2, y2) bbox from the encoded image back to original coordinates."""
+    sx, sy = scale
+    x1, y1, x2, y2 = bbox
+    return [int(round(x1 * sx)), int(round(y1 * sy)), int(round(x2 * sx)), int(round(y2 * sy))]
 
-    if match:
+def ask_vlm(image, prompt, kind, max_tokens=256):
+    """Asks the VLM about an image, encoded with the budget of the given prompt kind."""
+    img_b64, mime_type, _ = prepare_image(image, kind)
+    return call_qwen_vision_api(img_b64, prompt, max_tokens=max_tokens, mime_type=mime_type, kind=kind)
+
+def ask_vlm_stream(image, prompt, kind):
+    """Streaming variant of ask_vlm."""
+    img_b64, mime_type, _ = prepare_image(image, kind)
+    return call_qwen_vision_api_stream(img_b64, prompt, mime_type=mime_type, kind=kind)
+
+async def async_ask_vlm(image, prompt, kind, max_tokens=256):
+    """Awaitable variant of ask_vlm. Encoding runs in the VLM pool."""
+    loop = asyncio.get_running_loop()
+    img_b64, mime_type, _ = await loop.run_in_executor(vlm_executor, prepare_image, image, kind)
+    return await async_call_qwen_vision_api(img_b64, prompt, max_tokens=max_tokens, mime_type=mime_type, kind=kind)
+
+async def async_ask_vlm_stream(image, prompt, kind):
+    """Awaitable variant of ask_vlm_stream. Encoding runs in the VLM pool."""
+    loop = asyncio.get_running_loop()
+    img_b64, mime_type, _ = await loop.run_in_executor(vlm_executor, prepare_image, image, kind)
+    return await async_call_qwen_vision_api_stream(img_b64, prompt, mime_type=mime_type, kind=kind)
+
+def stream_chunks(stream):
+    """Yields the text content of each chunk of a streamed chat completion."""
+    for chunk in stream:
+        if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+            delta = chunk.choices[0].delta
+            if hasattr(delta, 'content') and delta.content:
+                yield delta.content
+
+def stream_text_regions(image, prompt, kind="ocr", max_tokens=256):
+    """
+    Asks for all text regions. The request is sent right away; the returned
+    iterator yields each {bbox_2d, text_content} region, in
+    original image coordinates, as soon as its closing brace arrives. Shares
+    vlm_cache with call_qwen_vision_api for the same prompt and max_tokens.
+    """
+    img_b64, mime_type, scale = prepare_image(image, kind)
+    key = vlm_cache_key(QWEN_MODEL, prompt, img_b64, max_tokens)
+    cached = vlm_cache.get(key)
+    if cached is not None:
+        return _parse_regions([cached], scale, None)
+    stream = call_qwen_vision_api_stream(img_b64, prompt, mime_type=mime_type, max_tokens=max_tokens, kind=kind)
+    return _parse_regions(stream_chunks(stream), scale, key)
+
+async def async_stream_chunks(stream):
+    """Async variant of stream_chunks."""
+    async for chunk in stream:
+        if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+            delta = chunk.choices[0].delta
+            if hasattr(delta, 'content') and delta.content:
+                yield delta.content
+
+async def async_stream_text_regions(image, prompt, kind="ocr", max_tokens=256):
+    """Awaitable variant of stream_text_regions. Returns an async iterator of regions."""
+    loop = asyncio.get_running_loop()
+    img_b64, mime_type, scale = await loop.run_in_executor(vlm_executor, prepare_image, image, kind)
+    key = vlm_cache_key(QWEN_MODEL, prompt, img_b64, max_tokens)
+    cached = vlm_cache.get(key)
+    if cached is not None:
+        return _async_parse_regions(_async_iter([cached]), scale, None)
+    stream = await async_call_qwen_vision_api_stream(img_b64, prompt, mime_type=mime_type, max_tokens=max_tokens, kind=kind)
+    return _async_parse_regions(async_stream_chunks(stream), scale, key)
+
+def _complete_regions(parser, text, scale):
+    regions = []
+    for region in parser.feed(text):
+        if isinstance(region, dict) and "bbox_2d" in region and "text_content" in region:
+            region["bbox_2d"] = scale_bbox(region["bbox_2d"], scale)
+            regions.append(region)
+    return regions
+
+def _parse_regions(chunks, scale, cache_key):
+    parser = JSONObjectStream()
+    parts = []
+    for text in chunks:
+        parts.append(text)
+        yield from _complete_regions(parser, text, scale)
+    if cache_key is not None:
+        vlm_cache.set(cache_key, "".join(parts))
+
+async def _async_parse_regions(chunks, scale, cache_key):
+    parser = JSONObjectStream()
+    parts = []
+    async for text in chunks:
+        parts.append(text)
+        for region in _complete_regions(parser, text, scale):
+            yield region
+    if cache_key is not None:
+        vlm_cache.set(cache_key, "".join(parts))
+
+async def _async_iter(items):
+    for item in items:
+        yield item
+
+def classification_prompt(text, categories):
+    """Builds the single-field classification prompt. categories is a list or an already formatted string."""
+    return f"Based on the image, classify this text: '{text}' using these categories: {categories}. Output only one category."
+
+def batch_classification_prompt(texts, categories):
+    """Builds one prompt asking for the category of every numbered text."""
+    lines = "\n".join(f"{i}. '{text}'" for i, text in enumerate(texts))
+    return (f"Based on the image, classify each of these numbered texts using these categories: {categories}.\n"
+            f"{lines}\n"
+            "Output only a JSON object mapping each number to one category.")
+
+def parse_batch_labels(data, count):
+    """
+    Parses the JSON object returned for a batch prompt.
+    Returns a dict {position: label} with the positions that could be read.
+    """
+    match = re.search(r'\{.*\}', data, re.DOTALL)
+    if not match:
+        return {}
+    try:
+        json_data = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(json_data, dict):
+        return {}
+
+    labels = {}
+    for key, value in json_data.items():
         try:
-            json_data = json.loads(match.group(1).strip())
+            position = int(key)
+        except (TypeError, ValueError):
+            continue
+        if 0 <= position < count and isinstance(value, str):
+            labels[position] = value.strip()
+    return labels
 
-            if isinstance(json_data, list) and json_data and "bbox_2d" in json_data[0]:
-                return json_data[0]["bbox_2d"]
+def _classify_batch(img_b64, indexed_texts, categories, mime_type):
+    texts = [text for _, text in indexed_texts]
+    prompt = batch_classification_prompt(texts, categories)
+    result = call_qwen_vision_api(img_b64, prompt, max_tokens=16 * len(texts) + 32, mime_type=mime_type, kind="classify")
+    labels = parse_batch_labels(result, len(texts))
+    return [(idx, labels.get(position)) for position, (idx, _) in enumerate(indexed_texts)]
 
-            if isinstance(json_data, dict) and "bbox_2d" in json_data:
-                return json_data["bbox_2d"]
+def _classify_single(img_b64, indexed_texts, categories, mime_type):
+    (idx, text), = indexed_texts
+    return [(idx, call_qwen_vision_api(img_b64, classification_prompt(text, categories), mime_type=mime_type, kind="classify"))]
 
-        except json.JSONDecodeError:
-            return None
+async def _async_classify_batch(img_b64, indexed_texts, categories, mime_type):
+    texts = [text for _, text in indexed_texts]
+    prompt = batch_classification_prompt(texts, categories)
+    result = await async_call_qwen_vision_api(img_b64, prompt, max_tokens=16 * len(texts) + 32, mime_type=mime_type, kind="classify")
+    labels = parse_batch_labels(result, len(texts))
+    return [(idx, labels.get(position)) for position, (idx, _) in enumerate(indexed_texts)]
 
-    return None
+async def _async_classify_single(img_b64, indexed_texts, categories, mime_type):
+    (idx, text), = indexed_texts
+    return [(idx, await async_call_qwen_vision_api(img_b64, classification_prompt(text, categories), mime_type=mime_type, kind="classify"))]
+
+def classify_texts(img_b64, texts, categories, batch_size=None, mime_type="image/jpeg"):
+    """
+    Classifies every text region against the given categories.
+    Regions are folded into batched prompts and the requests are dispatched
+    through the shared VLM pool; any region a batch fails to label is retried
+    once on its own, and labelled "other" if that fails too. texts may be any
+    iterable, e.g. regions still being streamed: a batch is sent as soon as
+    it is full. Yields (index, label) pairs as results arrive.
+    """
+    if batch_size is None:
+        batch_size = VLM_CLASSIFY_BATCH
+
+    def submit(indexed_texts):
+        worker = _classify_batch if len(indexed_texts) > 1 else _classify_single
+        return submit_with_context(vlm_executor, worker, img_b64, indexed_texts, categories, mime_type)
+
+    source = enumerate(texts)
+    step = max(batch_size, 1)
+    pending = {}
+    chunk = []
+    exhausted = False
+
+    try:
+        while not exhausted or pending:
+            if not exhausted:
+                item = next(source, None)
+                if item is None:
+                    exhausted = True
+                else:
+                    chunk.append(item)
+                if chunk and (exhausted or len(chunk) >= step):
+                    pending[submit(chunk)] = chunk
+                    chunk = []
+                if not pending:
+                    continue
+            # While the source is still producing, only collect results that are already in
+            done, _ = wait(pending, timeout=None if exhausted else 0, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    if len(batch) == 1:
+                        raise
+                    print(f"Batched classification failed, splitting: {e}")
+                    results = [(idx, None) for idx, _ in batch]
+                batch_texts = dict(batch)
+                for idx, label in results:
+                    if label is None and len(batch) > 1:
+                        retry = [(idx, batch_texts[idx])]
+                        pending[submit(retry)] = retry
+                    elif label is None:
+                        # A region is asked on its own only once
+                        print(f"No label for text region {idx}, using 'other'")
+                        yield idx, "other"
+                    else:
+                        yield idx, label
+    finally:
+        for future in pending:
+            future.cancel()
 
+async def async_classify_texts(img_b64, texts, categories, batch_size=None, mime_type="image/jpeg"):
+    """
+    Async variant of classify_texts: texts is an async iterable, and at most
+    VLM_MAX_WORKERS requests of this call are awaited at once.
+    """
+    if batch_size is None:
+        batch_size = VLM_CLASSIFY_BATCH
+    step = max(batch_size, 1)
+    limit = asyncio.Semaphore(VLM_MAX_WORKERS)
+    # (batch, results, error) per finished request; None once every text is submitted
+    finished = asyncio.Queue()
+    tasks = []
+
+    async def run(batch):
+        worker = _async_classify_batch if len(batch) > 1 else _async_classify_single
+        try:
+            async with limit:
+                results = await worker(img_b64, batch, categories, mime_type)
+        except Exception as e:
+            await finished.put((batch, None, e))
+        else:
+            await finished.put((batch, results, None))
+
+    def submit(batch):
+        tasks.append(asyncio.ensure_future(run(batch)))
+
+    async def feed():
+        chunk = []
+        try:
+            idx = 0
+            async for text in texts:
+                chunk.append((idx, text))
+                idx += 1
+                if len(chunk) >= step:
+                    submit(chunk)
+                    chunk = []
+            if chunk:
+                submit(chunk)
+            await finished.put(None)
+        except Exception as e:
+            await finished.put(e)
+
+    feeder = asyncio.ensure_future(feed())
+    fed = False
+    handled = 0
+    try:
+        while not fed or handled < len(tasks):
+            item = await finished.get()
+            if item is None:
+                fed = True
+                continue
+            if isinstance(item, Exception):
+                raise item
+            handled += 1
+            batch, results, error = item
+            if error is not None:
+                if len(batch) == 1:
+                    raise error
+                print(f"Batched classification failed, splitting: {error}")
+                results = [(idx, None) for idx, _ in batch]
+            batch_texts = dict(batch)
+            for idx, label in results:
+                if label is None and len(batch) > 1:
+                    submit([(idx, batch_texts[idx])])
+                elif label is None:
+                    # A region is asked on its own only once
+                    print(f"No label for text region {idx}, using 'other'")
+                    yield idx, "other"
+                else:
+                    yield idx, label
+    finally:
+        feeder.cancel()
+        for task in tasks:
+            task.cancel()
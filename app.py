@@ -1,20 +1,30 @@
 from flask import Flask, render_template, request, jsonify, Response, stream_with_context
-from gradio_client import Client, handle_file
 
-import re
 import requests
 import json
 import os
 import base64
 import time
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import matplotlib.pyplot as plt
 from io import BytesIO
 from PIL import Image
 
-from agents.ocr import OCR_AGENT, pladdleOCR
+from agents.ocr import OCR_AGENT, get_ocr_engine, pladdleOCR
 from agents.vlm import *
 from agents.segmentation import *
+from agents.tts import create_tts_service
+from agents.asr import TranscriptionStream, create_recognizer, decode_audio, transcribe_samples, trim_silence
+from agents.cache import LRUCache, SqliteCache
+from agents.pipeline import StageGraph
+from agents.taxonomy import Taxonomy
+from agents.prompts import Question, ask_questions, fusion_stats, validate
+from agents.admission import Overloaded, create_admission_controller
+from agents.metrics import observe_stage, registry, request_timings, span, submit_with_context, track_stream, tracked
 
 from utils import *
 
@@ -27,9 +37,15 @@ app = Flask(__name__)
 
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1)
 
+# Build the PGNet predictor once so it stays out of the request path.
+ocr_engine = get_ocr_engine(warmup=os.environ.get("OCR_WARMUP", "1") == "1")
+
+# Bounds concurrent requests per endpoint; interactive calls are admitted before long pipelines.
+admission = create_admission_controller()
+registry.register_collector("app_admission", admission.stats)
+
 import speech_recognition as sr
-from pydub import AudioSegment
-import tempfile
+import uuid
 
 import subprocess
 
@@ -39,9 +55,77 @@ def debug_ffmpeg():
     out = subprocess.check_output(["ffmpeg", "-version"]).decode()
     return f"<pre>{out}</pre>"
 
+recognizer = create_recognizer()
+asr_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("ASR_MAX_WORKERS", "4")))
+# Recordings being uploaded chunk by chunk, keyed by stream_id. Streams that
+# expire or are evicted before their final chunk get their decoder stopped.
+transcription_streams = LRUCache(
+    max_entries=64,
+    ttl=int(os.environ.get("ASR_STREAM_TTL", "120")),
+    on_evict=TranscriptionStream.close,
+)
+
+def transcription_response(transcribe):
+    """Runs transcribe() and maps recognizer errors to the (response dict, status code) the client expects."""
+    try:
+        text = transcribe()
+    except sr.UnknownValueError:
+        return {
+            "status": "error",
+            "message": "Could not understand the audio. Please speak clearly and try again."
+        }, 400
+    except sr.RequestError as e:
+        return {
+            "status": "error",
+            "message": f"Speech recognition service unavailable: {str(e)}"
+        }, 500
+    return {
+        "status": "success",
+        "text": text
+    }, 200
+
+def transcribe_audio_data(audio_bytes):
+    """Decodes recorded audio in memory, trims silence and transcribes it with the configured recognizer chain. Returns (response dict, status code)."""
+    samples = trim_silence(decode_audio(audio_bytes))
+    return transcription_response(lambda: transcribe_samples(recognizer, samples))
+
+def transcribe_chunk_data(stream_id, chunk, final, pcm_rate=None):
+    """
+    Appends one chunk of a recording that is still in progress. Finished phrases
+    are transcribed in the background; the final call returns the whole text.
+    pcm_rate marks a new stream as raw 16-bit PCM.
+    """
+    if stream_id:
+        stream = transcription_streams.get(stream_id)
+        if stream is None:
+            return {
+                "status": "error",
+                "message": "Transcription stream expired",
+                "stream_expired": True
+            }, 410
+    else:
+        stream_id = uuid.uuid4().hex
+        transcription_streams.purge_expired()
+        stream = TranscriptionStream(recognizer, pcm_rate=pcm_rate)
+        transcription_streams.set(stream_id, stream)
+
+    if chunk:
+        stream.append(chunk)
+
+    if final:
+        transcription_streams.pop(stream_id)
+        result, status = transcription_response(stream.finish)
+    else:
+        submit_with_context(asr_executor, stream.advance)
+        result, status = {"status": "ok", "text": stream.text}, 200
+    result["stream_id"] = stream_id
+    return result, status
+
 @app.route("/transcribe_audio", methods=["POST"])
+@tracked("transcribe_audio")
+@admission.limited("transcribe_audio")
 def transcribe_audio():
-    """Transcribes audio file to text using Google Speech Recognition. Falls back to Sphinx if Google API unavailable."""
+    """Transcribes audio file to text with the configured recognizers (Google, falling back to Sphinx, by default)."""
     try:
         if 'audio' not in request.files:
             return jsonify({
@@ -49,62 +133,59 @@ def transcribe_audio():
                 "message": "No audio file provided"
             }), 400
 
-        audio_file = request.files['audio']
-
-        with tempfile.NamedTemporaryFile(suffix='.webm', delete=False) as temp_audio:
-            audio_file.save(temp_audio.name)
-            temp_audio_path = temp_audio.name
-
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_wav:
-            temp_wav_path = temp_wav.name
-
-        try:
-            audio = AudioSegment.from_file(temp_audio_path)
-            audio.export(temp_wav_path, format='wav')
-        except Exception as e:
-            print(f"Audio conversion warning: {e}")
-            temp_wav_path = temp_audio_path
+        result, status = transcribe_audio_data(request.files['audio'].read())
+        return jsonify(result), status
 
-        recognizer = sr.Recognizer()
-
-        with sr.AudioFile(temp_wav_path) as source:
-            recognizer.adjust_for_ambient_noise(source, duration=0.5)
-            audio_data = recognizer.record(source)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            "status": "error",
+            "message": f"Transcription failed: {str(e)}"
+        }), 500
 
-            try:
-                text = recognizer.recognize_google(audio_data)
+@app.route("/transcribe_audio/chunk", methods=["POST"])
+@tracked("transcribe_audio_chunk")
+def transcribe_audio_chunk():
+    """Chunked transcription while the user is still speaking. Form fields: stream_id (after the first chunk), audio, final."""
+    try:
+        chunk = request.files['audio'].read() if 'audio' in request.files else b''
+        final = request.form.get('final') in ('1', 'true')
+        result, status = transcribe_chunk_data(request.form.get('stream_id'), chunk, final)
+        return jsonify(result), status
 
-                try:
-                    os.unlink(temp_audio_path)
-                    if temp_wav_path != temp_audio_path:
-                        os.unlink(temp_wav_path)
-                except:
-                    pass
-
-                return jsonify({
-                    "status": "success",
-                    "text": text
-                })
-
-            except sr.UnknownValueError:
-                return jsonify({
-                    "status": "error",
-                    "message": "Could not understand the audio. Please speak clearly and try again."
-                }), 400
-
-            except sr.RequestError as e:
-                try:
-                    text = recognizer.recognize_sphinx(audio_data)
-                    return jsonify({
-                        "status": "success",
-                        "text": text
-                    })
-                except:
-                    return jsonify({
-                        "status": "error",
-                        "message": f"Speech recognition service unavailable: {str(e)}"
-                    }), 500
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({
+            "status": "error",
+            "message": f"Transcription failed: {str(e)}"
+        }), 500
 
+def pcm_rate_param(params):
+    """Sample rate of a raw PCM upload, from the 'rate' parameter."""
+    rate = int(params.get('rate', 16000))
+    if not 8000 <= rate <= 96000:
+        raise ValueError(f"Unsupported PCM sample rate {rate}")
+    return rate
+
+@app.route("/transcribe_audio/pcm", methods=["POST"])
+@tracked("transcribe_audio_pcm")
+def transcribe_audio_pcm():
+    """
+    Compact upload path: the body is 16-bit little-endian mono PCM (audio/l16),
+    already trimmed by the client's VAD. Query parameters: rate, stream_id, final.
+    A single request with final=1 transcribes a whole recording.
+    """
+    try:
+        params = request.args
+        result, status = transcribe_chunk_data(
+            params.get('stream_id'), request.get_data(), params.get('final') in ('1', 'true'), pcm_rate_param(params)
+        )
+        return jsonify(result), status
+
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -113,14 +194,30 @@ def transcribe_audio():
             "message": f"Transcription failed: {str(e)}"
         }), 500
 
+# Constant status messages; their audio is precomputed at startup.
+STATUS_PHRASES = [
+    "Scanning for private information",
+    "Private document detected. Analyzing content.",
+    "Classifying text regions",
+    "Classification complete.",
+    "Do you want to proceed with regular masking? Say yes or no.",
+    "Proceeding with regular masking of all sensitive fields",
+    "Masking specified fields",
+    "No sensitive information was masked. Processing complete.",
+    "No private document detected in the image.",
+    "I did not understand the question. Can you repeat it",
+]
+
+tts = create_tts_service()
+
 def text_to_audio_base64(text):
-    """Converts text to base64-encoded MP3 audio using Google TTS. Returns base64 string."""
-    from gtts import gTTS
-    tts = gTTS(text=text, lang='en', slow=False)
-    audio_fp = BytesIO()
-    tts.write_to_fp(audio_fp)
-    audio_fp.seek(0)
-    return base64.b64encode(audio_fp.read()).decode('utf-8')
+    """Converts text to base64-encoded MP3 audio using the configured TTS backend. Returns base64 string."""
+    return tts.synthesize_base64(text)
+
+
+# Synthesizes sentences while the VLM keeps streaming tokens.
+tts_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("TTS_MAX_WORKERS", "4")), thread_name_prefix="tts")
+tts_executor.submit(tts.preload, STATUS_PHRASES)
 
 
 def convert_to_bytes(image):
@@ -130,6 +227,95 @@ def convert_to_bytes(image):
     image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
     return image_base64
 
+def request_params():
+    """Returns the non-file request fields, whether sent as JSON, multipart form or query string."""
+    if request.is_json:
+        return request.get_json() or {}
+    params = request.args.to_dict()
+    params.update(request.form.to_dict())
+    return params
+
+# Photos uploaded once through /upload, referenced afterwards by image_id.
+image_store = LRUCache(
+    max_entries=int(os.environ.get("IMAGE_STORE_ENTRIES", "64")),
+    max_bytes=int(os.environ.get("IMAGE_STORE_MB", "512")) * 1024 * 1024,
+    ttl=float(os.environ.get("IMAGE_STORE_TTL", "1800")),
+)
+
+class ImageNotFound(Exception):
+    """Raised when a request references an image_id that is no longer stored."""
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    response = jsonify({
+        "status": "error",
+        "message": str(e),
+        "retry_after": e.retry_after
+    })
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 503
+
+def admitted_stream(ticket, events):
+    """Reports the request's queue wait as the first SSE event and frees its admission slot when the stream ends."""
+    try:
+        observe_stage("queue_wait", ticket.wait)
+        yield f"data: {json.dumps({'stage': 'admitted', 'queue_wait': round(ticket.wait, 3)})}\n\n"
+        yield from events
+    finally:
+        ticket.release()
+
+def admitted_response(endpoint, events):
+    """SSE response for a stream admitted as endpoint. The slot is also freed if the client leaves before the first event."""
+    ticket = admission.acquire(endpoint)
+    response = Response(stream_with_context(track_stream(endpoint, admitted_stream(ticket, events))), mimetype='text/event-stream')
+    response.call_on_close(ticket.release)
+    return response
+
+@app.errorhandler(ImageNotFound)
+def image_not_found(e):
+    return jsonify({
+        "status": "error",
+        "message": str(e),
+        "image_expired": True
+    }), 410
+
+@app.errorhandler(InvalidImage)
+def invalid_image(e):
+    return jsonify({
+        "status": "error",
+        "message": str(e)
+    }), 400
+
+def request_image(required=True):
+    """
+    Reads the request photo once. Resolves an 'image_id' from the image store, or
+    accepts a multipart 'image' file, a raw image/* body or a JSON data URL.
+    """
+    image_id = request_params().get("image_id")
+    if image_id:
+        image = image_store.get(image_id)
+        if image is None:
+            raise ImageNotFound(f"Image {image_id} expired, please upload it again")
+        return image
+    if 'image' in request.files:
+        return RequestImage(request.files['image'].read())
+    if request.mimetype and request.mimetype.startswith('image/'):
+        return RequestImage(request.get_data())
+    data = (request.get_json(silent=True) or {}).get("image")
+    if data:
+        try:
+            return RequestImage.from_data_url(data)
+        except ValueError as e:
+            raise InvalidImage(f"Invalid image data: {e}")
+    if required:
+        raise InvalidImage("No image provided")
+    return None
+
+@app.route("/metrics")
+def metrics():
+    """Exposes stage and endpoint latency histograms, in-flight gauges and cache statistics in Prometheus text format."""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route("/health")
 def health():
     """Serves the main web interface. Renders index.html template."""
@@ -141,116 +327,115 @@ def index():
     return render_template("index.html")
 
 @app.route("/upload", methods=["POST"])
+@tracked("upload")
 def upload():
-    """Saves uploaded base64 image to server disk. Writes to photo.jpg file."""
+    """Stores an uploaded image so later calls can reference it by image_id. Writes it to DEBUG_IMAGE_DIR only in debug mode."""
 
     try:
-        data = request.json["image"]
-        image_data = data.split(",")[1]
-        binary = base64.b64decode(image_data)
-        
-        filepath = "photo.jpg"
-        with open(filepath, "wb") as f:
-            f.write(binary)
+        photo = request_image()
+        image = photo.image
+
+        save_debug_image(image, "photo.png")
+        # Encodings made by later requests count against IMAGE_STORE_MB
+        photo.on_resize = partial(image_store.remeasure, photo.hash)
+        image_store.set(photo.hash, photo)
         
-        return {"status": "ok", "message": "Image saved successfully"}
+        return {
+            "status": "ok",
+            "message": "Image received successfully",
+            "image_id": photo.hash,
+            "width": image.width,
+            "height": image.height
+        }
     except Exception as e:
         return {"status": "error", "message": str(e)}, 400
 
 @app.route("/speak", methods=["POST"])
+@tracked("speak")
+@admission.limited("speak")
 def speak():
     """Generates complete audio description of image in one chunk. Returns base64 audio data."""
+    image = request_image()
     try:
-        from gtts import gTTS
-        
-        data = request.json["image"]
-        image_base64 = data.split(",")[1]
-        text = call_qwen_vision_api(image_base64, "describe this image in detail")
-        
-        tts = gTTS(text=text, lang='en', slow=False)
+        text = ask_vlm(image, "describe this image in detail", "describe")
         
-        audio_fp = BytesIO()
-        tts.write_to_fp(audio_fp)
-        audio_fp.seek(0)
-        
-        audio_base64 = base64.b64encode(audio_fp.read()).decode('utf-8')
+        audio_base64 = text_to_audio_base64(text)
         
         return jsonify({
             "status": "success",
             "audio": f"data:audio/mp3;base64,{audio_base64}"
         })
         
+    except (ImageNotFound, InvalidImage):
+        raise
     except Exception as e:
         return jsonify({
             "status": "error",
             "message": f"Speech generation failed: {str(e)}"
         }), 500
 
+def speak_stream_events(image):
+    """Yields SSE events describing the image sentence by sentence. Audio for each sentence is synthesized in the TTS pool."""
+    try:
+        stream = ask_vlm_stream(image, "Describe this image in detail. Use short, clear sentences.", "describe")
+        
+        buffer = ""
+        pending = deque()
+
+        def completed_audio(wait=False):
+            # Emit clips in sentence order; stop at the first one still being synthesized.
+            while pending and (wait or pending[0][1].done()):
+                sentence, future = pending.popleft()
+                try:
+                    audio_base64 = future.result()
+                except Exception as audio_error:
+                    print(f"Audio generation error: {audio_error}")
+                    continue
+                yield f"data: {json.dumps({'audio': audio_base64, 'text': sentence})}\n\n"
+        
+        for chunk in stream:
+            if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+                delta = chunk.choices[0].delta
+                if hasattr(delta, 'content') and delta.content:
+                    text_chunk = delta.content
+                    sentences, buffer = split_sentences(buffer + text_chunk)
+
+                    for sentence in sentences:
+                        print(f"Generating audio for: {sentence}")
+                        pending.append((sentence, submit_with_context(tts_executor, text_to_audio_base64, sentence)))
+
+            yield from completed_audio()
+        
+        if buffer.strip():
+            print(f"Generating audio for final: {buffer}")
+            pending.append((buffer.strip(), submit_with_context(tts_executor, text_to_audio_base64, buffer.strip())))
+
+        yield from completed_audio(wait=True)
+        
+        yield f"data: {json.dumps({'done': True, 'timings': request_timings()})}\n\n"
+        
+    except Exception as e:
+        print(f'Exception: {str(e)}')
+        import traceback
+        traceback.print_exc()
+        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+
 @app.route("/speak_stream", methods=["POST"])
 def speak_stream():
     """Streams image description as real-time audio chunks. Splits text into sentences and converts each to audio immediately."""
-    def generate():
-        try:
-            data = request.json["image"]
-            image_base64 = data.split(",")[1]
-            
-            stream = call_qwen_vision_api_stream(image_base64, "Describe this image in detail. Use short, clear sentences.")
-            
-            buffer = ""
-            sentence_endings = re.compile(r'[.!?]+')
-            
-            for chunk in stream:
-                if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                    delta = chunk.choices[0].delta
-                    if hasattr(delta, 'content') and delta.content:
-                        text_chunk = delta.content
-                        buffer += text_chunk
-                        
-                        sentences = sentence_endings.split(buffer)
-                        
-                        for i in range(len(sentences) - 1):
-                            sentence = sentences[i].strip()
-                            if sentence:
-                                sentence += buffer[buffer.find(sentence) + len(sentence)]
-                                
-                                print(f"Generating audio for: {sentence}")
-                                
-                                try:
-                                    audio_base64 = text_to_audio_base64(sentence)
-                                    yield f"data: {json.dumps({'audio': audio_base64, 'text': sentence})}\n\n"
-                                except Exception as audio_error:
-                                    print(f"Audio generation error: {audio_error}")
-                                    continue
-                        
-                        buffer = sentences[-1] if sentences else ""
-            
-            if buffer.strip():
-                print(f"Generating audio for final: {buffer}")
-                try:
-                    audio_base64 = text_to_audio_base64(buffer.strip())
-                    yield f"data: {json.dumps({'audio': audio_base64, 'text': buffer.strip()})}\n\n"
-                except Exception as audio_error:
-                    print(f"Final audio generation error: {audio_error}")
-            
-            yield f"data: {json.dumps({'done': True})}\n\n"
-            
-        except Exception as e:
-            print(f'Exception: {str(e)}')
-            import traceback
-            traceback.print_exc()
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
-    
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    image = request_image()
+    return admitted_response("speak_stream", speak_stream_events(image))
 
 
 @app.route("/ask_question", methods=["POST"])
+@tracked("ask_question")
+@admission.limited("ask_question")
 def ask_question():
     """Answers voice question about image using vision API. Returns audio response."""
     try:
-        from gtts import gTTS
-        
-        data = request.json["image"]
-        question = request.json.get("question", "")
+        params = request_params()
+        question = params.get("question", "")
 
         if not question:
             return jsonify({
@@ -262,18 +447,12 @@ def ask_question():
             answer = f"I did not understand the question. Can you repeat it"
 
         else:
-            image_base64 = data.split(",")[1]
+            image = request_image()
         
             prompt = f"Answer this question about the image: {question}"
-            answer = call_qwen_vision_api(image_base64, prompt)
+            answer = ask_vlm(image, prompt, "question")
         
-        tts = gTTS(text=answer, lang='en', slow=False)
-        
-        audio_fp = BytesIO()
-        tts.write_to_fp(audio_fp)
-        audio_fp.seek(0)
-        
-        audio_base64 = base64.b64encode(audio_fp.read()).decode('utf-8')
+        audio_base64 = text_to_audio_base64(answer)
         
         return jsonify({
             "status": "success",
@@ -281,270 +460,410 @@ def ask_question():
             "answer": answer
         })
         
+    except (ImageNotFound, InvalidImage):
+        raise
     except Exception as e:
         return jsonify({
             "status": "error",
             "message": f"Question processing failed: {str(e)}"
         }), 500
 
-detection_cache = {}
-@app.route("/detect_private", methods=["POST"])
-def detect_private():
-    """Detects and masks private information in documents using multi-stage OCR, qwen classification pipeline and SAM3. Implements interactive masking workflow with user prompts."""
-    def generate():
-        try:
-            data = request.json["image"]
-            user_response = request.json.get("user_response", None)
-            custom_fields = request.json.get("custom_fields", None)
-            session_id = request.json.get("session_id", None)
-            image_base64 = data.split(",")[1]
+def create_session_store():
+    """
+    Builds the store for masking-dialog sessions. Sessions live in a bounded,
+    expiring in-process LRU, or in a sqlite file shared by all workers when
+    SESSION_STORE_DB is set.
+    """
+    ttl = float(os.environ.get("SESSION_STORE_TTL", "600"))
+    db_path = os.environ.get("SESSION_STORE_DB")
+    if db_path:
+        return SqliteCache(db_path, ttl=ttl, pickled=True)
+    return LRUCache(
+        max_entries=int(os.environ.get("SESSION_STORE_ENTRIES", "32")),
+        max_bytes=int(os.environ.get("SESSION_STORE_MB", "512")) * 1024 * 1024,
+        ttl=ttl,
+    )
+
+detection_cache = create_session_store()
+
+registry.register_collector("app_vlm_cache", vlm_cache.stats)
+registry.register_collector("app_vlm_transport", transport.stats)
+registry.register_collector("app_vlm_fusion", fusion_stats.copy)
+registry.register_collector("app_tts_cache", tts.stats)
+registry.register_collector("app_image_store", image_store.stats)
+registry.register_collector("app_session_store", detection_cache.stats)
+registry.register_collector("app_segmentation_cache", segmentation.stats)
+
+# Longest side of the downscaled copy used to estimate the document orientation.
+# PGNet resizes its input to 768 px anyway, so the default loses no detail.
+ORIENTATION_MAX_SIDE = int(os.environ.get("ORIENTATION_MAX_SIDE", "768"))
+
+def estimate_document_angle(document, base_angle=90, max_orientation_polygons=10):
+    """
+    Estimates the rotation that makes the document text horizontal from a single PGNet pass
+    on a downscaled copy rotated by base_angle. Returns the total angle for document.rotate.
+    """
+    small = downscale_max_side(document, ORIENTATION_MAX_SIDE)
+
+    base_rotated = small.rotate(base_angle, resample=Image.BICUBIC, expand=True, fillcolor=(255,255,255))
+    if base_rotated.mode == "RGBA":
+        base_rotated = base_rotated.convert("RGB")
+
+    points, strs, elapse = pladdleOCR(base_rotated)
+    if points is None:
+        points = []
+
+    angles = [polygon_orientation(pol) for pol in points[:max_orientation_polygons]]
+    mean_angle = float(np.mean(angles)) if angles else 0.0
+    return base_angle + mean_angle
+
+# Metacategory -> field labels, loaded once and shared read-only by all requests.
+taxonomy = Taxonomy.from_file('label2item_list.json')
+
+META_CATEGORIES = ["bank statement", "letter with address", "credit or debit card", "bills or receipt", "preganancy test", "pregnancy test box", "mortage or investment report", "doctor prescription", "empty pill bottle", "condom with plastic bag", "tattoo sleeve", "transcript", "business card", "condom box", "local newspaper", "medical record document", "email", "phone", "id card",]
+
+METACATEGORY_PROMPT = f"From this list of categories: {' ,'.join(META_CATEGORIES)}, which one is related to this image. Only output the category"
+
+LOCATE_DOCUMENT_PROMPT = 'Locate paper document in the image, and output in JSON format.'
+
+# The document bbox and the metacategory are asked about the full photo in one
+# fused call; a question whose fused answer is unusable falls back to its own prompt.
+DOCUMENT_QUESTION = Question(
+    "document",
+    "the bbox_2d [x1, y1, x2, y2] of the paper document in the image, or null if there is none",
+    {"type": ["array", "null"], "items": {"type": "number"}, "minItems": 4, "maxItems": 4},
+    LOCATE_DOCUMENT_PROMPT,
+    extract_bbox,
+    coerce=lambda value: value.get("bbox_2d") if isinstance(value, dict) else value,
+    max_tokens=256,
+)
+CATEGORY_QUESTION = Question(
+    "category",
+    f"from this list of categories: {' ,'.join(META_CATEGORIES)}, the one related to this image",
+    {"type": "string", "minLength": 1},
+    METACATEGORY_PROMPT,
+    lambda answer: answer or "",
+    max_tokens=32,
+)
+
+def locate_document(request_photo):
+    """
+    Fused document localization and metacategory. Returns ((bbox in original
+    coordinates or None, raw response), metacategory answer).
+    """
+    answers, scale, raw = ask_questions(request_photo, [DOCUMENT_QUESTION, CATEGORY_QUESTION], "locate")
+    bbox = answers["document"]
+    return (scale_bbox(bbox, scale) if bbox is not None else None, raw), answers["category"]
+
+def text_regions_prompt(categories):
+    """Text localization prompt that also asks for the field label of every region."""
+    return ("Locate all text (bbox coordinates). Include all readable and blury text. "
+            f"Also give each text a \"label\" from these categories: {categories}. Output in JSON format.")
+
+def region_label(region, labels):
+    """The label streamed with a text region, if it is one of labels."""
+    label = region.get("label")
+    if not isinstance(label, str):
+        return None
+    label = label.strip().lower()
+    return label if validate(label, {"type": "string", "enum": labels}) else None
+
+# Runs the independent /detect_private stages side by side.
+pipeline_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("PIPELINE_MAX_WORKERS", "8")), thread_name_prefix="pipeline")
+
+def crop_located_document(request_photo, located):
+    """Crops the located document and blanks everything the segmentation backend does not see as document. Returns None when no document was found."""
+    bbox, _ = located
+    if bbox is None:
+        return None
+
+    cropped_image = request_photo.image.crop(bbox)
+
+    if cropped_image.mode == "RGBA":
+        cropped_image = cropped_image.convert("RGB")
+
+    save_debug_image(cropped_image, "cropped_image.jpg")
+
+    pred_mask = get_mask(cropped_image)
+    cropped_image_tmp = set_zero_outside_mask(pil_to_opencv(cropped_image), pred_mask, copy=False)
+    return opencv_to_pil(cropped_image_tmp)
+
+def deskew_document(document):
+    """Rotates the cropped document so its text is horizontal. Returns (total_angle, rotated image)."""
+    total_angle = estimate_document_angle(document)
+    with span("image_rotate"):
+        rotated_image = document.rotate(total_angle, resample=Image.BICUBIC, expand=True, fillcolor=(255,255,255))
+
+    if rotated_image.mode == "RGBA":
+        rotated_image = rotated_image.convert("RGB")
+
+    save_debug_image(rotated_image, "rotated_image.jpg")
+    return total_angle, rotated_image
+
+# Default redaction of masked fields: black, blur or pixelate. Requests can pass mask_mode.
+MASK_MODE = os.environ.get("MASK_MODE", "black")
+
+def detected_fields(regions, labels):
+    """The field_info list of a session: text, label, index and bbox_2d of every region."""
+    return [{
+        'text': region['text_content'],
+        'label': labels[idx],
+        'index': idx,
+        'bbox_2d': region['bbox_2d']
+    } for idx, region in enumerate(regions)]
+
+def store_detection(session_id, hr_im, field_info, bbox_orig, total_angle, cropped_size, rotated_size):
+    """Keeps what masking needs until the user answers. Returns the session id, a new one if none was given."""
+    if not session_id:
+        session_id = str(uuid.uuid4())
+    detection_cache.purge_expired()
+    detection_cache.set(session_id, {
+        'hr_im': hr_im,
+        'field_info': field_info,
+        'bbox_orig': bbox_orig,
+        'crop_x': bbox_orig[0],
+        'crop_y': bbox_orig[1],
+        'total_angle': total_angle,
+        'cropped_size': cropped_size,
+        'rotated_size': rotated_size
+    })
+    return session_id
+
+def detect_private_endpoint(params):
+    """
+    Answers to the masking dialog are short and interactive, so they are admitted apart from
+    new pipelines. An answer to a session that expired runs the whole pipeline and is admitted as one.
+    """
+    session_id = params.get("session_id")
+    if session_id and params.get("user_response") is not None and session_id in detection_cache:
+        return "detect_private_answer"
+    return "detect_private"
+
+def detect_private_events(params, request_photo):
+    """Yields the SSE events of the privacy pipeline: detection and classification on the first call, masking once the user has answered."""
+    try:
+        user_response = params.get("user_response", None)
+        custom_fields = params.get("custom_fields", None)
+        session_id = params.get("session_id", None)
+        mask_mode = params.get("mask_mode") or MASK_MODE
+        if mask_mode not in REDACTION_MODES:
+            mask_mode = MASK_MODE
+        
+        cached_data = detection_cache.get(session_id) if session_id else None
+        if cached_data:
+            print(f"Using cached data for session {session_id}")
+        
+        if cached_data and user_response is not None:
+            print("Skipping detection, using cached results")
+            hr_im = cached_data['hr_im']
+            field_info = cached_data['field_info']
+            bbox_orig = cached_data['bbox_orig']
+            crop_x = cached_data['crop_x']
+            crop_y = cached_data['crop_y']
+            total_angle = cached_data['total_angle']
+            cropped_size = cached_data['cropped_size']
+            rotated_size = cached_data['rotated_size']
             
-            cached_data = None
-            if session_id and session_id in detection_cache:
-                cached_data = detection_cache[session_id]
-                print(f"Using cached data for session {session_id}")
+            fields_to_mask_indices = []
             
-            if cached_data and user_response is not None:
-                print("Skipping detection, using cached results")
-                image = cached_data['image']
-                hr_im = cached_data['hr_im']
-                field_info = cached_data['field_info']
-                bbox_orig = cached_data['bbox_orig']
-                crop_x = cached_data['crop_x']
-                crop_y = cached_data['crop_y']
-                total_angle = cached_data['total_angle']
-                cropped_image_tmp = cached_data['cropped_image_tmp']
-                rotated_image_v1 = cached_data['rotated_image_v1']
-                
-                fields_to_mask_indices = []
-                
-                if 'yes' in user_response.lower():
-                    fields_to_mask_indices = [f['index'] for f in field_info if f['label'] not in ['none', 'other']]
-                    try:
-                        audio = text_to_audio_base64("Proceeding with regular masking of all sensitive fields")
-                        yield f"data: {json.dumps({'audio': audio, 'text': 'Masking all sensitive fields', 'stage': 'masking'})}\n\n"
-                    except Exception as e:
-                        print(f"Audio error: {e}")
-                else:
-                    if custom_fields is None:
-                        sensitive_fields = [f for f in field_info if f['label'] not in ['none', 'other']]
-                        try:
-                            field_names = ', '.join([f['label'] for f in sensitive_fields])
-                            audio = text_to_audio_base64(f"I found these sensitive fields: {field_names}. Which fields do you want to mask? Please name them.")
-                            yield f"data: {json.dumps({'audio': audio, 'text': 'Awaiting custom fields', 'stage': 'awaiting_custom_fields', 'request_custom_fields': True})}\n\n"
-                        except Exception as e:
-                            print(f"Audio error: {e}")
-                        return
-                    
-                    try:
-                        audio = text_to_audio_base64("Masking specified fields")
-                        yield f"data: {json.dumps({'audio': audio, 'text': 'Masking custom fields', 'stage': 'masking'})}\n\n"
-                    except Exception as e:
-                        print(f"Audio error: {e}")
-                    
-                    for field in field_info:
-                        if field['label'] not in ['none', 'other']:
-                            if (field['label'].lower() in custom_fields.lower() or 
-                                field['text'].lower() in custom_fields.lower()):
-                                fields_to_mask_indices.append(field['index'])
-                
-                hr_im_copy = hr_im.copy()
-                masked_count = 0
-                for field in field_info:
-                    if field['index'] in fields_to_mask_indices:
-                        bbox_rotated = field['bbox_2d']
-                        
-                        poly_orig = rotated_bbox_polygon(bbox_rotated, -total_angle, cropped_image_tmp.size, rotated_image_v1.size)
-                        
-                        final_poly = []
-                        for (x, y) in poly_orig:
-                            final_poly.append((crop_x + x, crop_y + y))
-                        
-                        draw_orig = ImageDraw.Draw(hr_im_copy)
-                        draw_orig.polygon(final_poly, fill="black")
-                        masked_count += 1
-                
-                if masked_count > 0:
-                    try:
-                        audio = text_to_audio_base64(f"Masked {masked_count} sensitive text region{'s' if masked_count != 1 else ''}. Processing complete.")
-                        yield f"data: {json.dumps({'audio': audio, 'text': f'Masked {masked_count} sensitive regions', 'stage': 'complete'})}\n\n"
-                    except Exception as e:
-                        print(f"Audio error: {e}")
-                else:
+            if 'yes' in user_response.lower():
+                fields_to_mask_indices = [f['index'] for f in field_info if f['label'] not in ['none', 'other']]
+                try:
+                    audio = text_to_audio_base64("Proceeding with regular masking of all sensitive fields")
+                    yield f"data: {json.dumps({'audio': audio, 'text': 'Masking all sensitive fields', 'stage': 'masking'})}\n\n"
+                except Exception as e:
+                    print(f"Audio error: {e}")
+            else:
+                if custom_fields is None:
+                    sensitive_fields = [f for f in field_info if f['label'] not in ['none', 'other']]
                     try:
-                        audio = text_to_audio_base64("No sensitive information was masked. Processing complete.")
-                        yield f"data: {json.dumps({'audio': audio, 'text': 'No sensitive information masked', 'stage': 'complete'})}\n\n"
+                        field_names = ', '.join([f['label'] for f in sensitive_fields])
+                        audio = text_to_audio_base64(f"I found these sensitive fields: {field_names}. Which fields do you want to mask? Please name them.")
+                        yield f"data: {json.dumps({'audio': audio, 'text': 'Awaiting custom fields', 'stage': 'awaiting_custom_fields', 'request_custom_fields': True})}\n\n"
                     except Exception as e:
                         print(f"Audio error: {e}")
+                    return
                 
-                if session_id and session_id in detection_cache:
-                    del detection_cache[session_id]
-                
-                image_base64_result = convert_to_bytes(hr_im_copy)
-                yield f"data: {json.dumps({'done': True, 'has_private_info': True, 'cropped_image': f'data:image/png;base64,{image_base64_result}'})}\n\n"
-                return
-            
-            try:
-                audio = text_to_audio_base64("Scanning for private information")
-                yield f"data: {json.dumps({'audio': audio, 'text': 'Scanning for private information', 'stage': 'start'})}\n\n"
-            except Exception as e:
-                print(f"Audio error: {e}")
-            
-            prompt = 'Locate paper document in the image, and output in JSON format.'
-            detection_result = call_qwen_vision_api(image_base64, prompt)
-            bbox_orig = extract_bbox(detection_result)
-            
-            image_data = base64.b64decode(image_base64)
-            image_bytes = BytesIO(image_data)
-            image = Image.open(image_bytes)
-
-            has_private = True
-            if bbox_orig is not None:
                 try:
-                    audio = text_to_audio_base64("Private document detected. Analyzing content.")
-                    yield f"data: {json.dumps({'audio': audio, 'text': 'Private document detected. Analyzing content.', 'stage': 'detected'})}\n\n"
+                    audio = text_to_audio_base64("Masking specified fields")
+                    yield f"data: {json.dumps({'audio': audio, 'text': 'Masking custom fields', 'stage': 'masking'})}\n\n"
                 except Exception as e:
                     print(f"Audio error: {e}")
                 
-                cropped_image = image.crop(bbox_orig)
-
-                if cropped_image.mode == "RGBA":
-                    cropped_image = cropped_image.convert("RGB")
-
-                cropped_image.save("cropped_image.jpg")
-
-                pred_mask = get_mask()
-                cropped_image_tmp = set_zero_outside_mask(pil_to_opencv(cropped_image), pred_mask)
-                cropped_image_tmp = opencv_to_pil(cropped_image_tmp)
-
-    
-                rotate_angle = 90
-                rotated_image_v1 = cropped_image_tmp.rotate(rotate_angle, resample=Image.BICUBIC, expand=True, fillcolor=(255,255,255))
-                rotated_image_v1.save("rotated_image.jpg")
-
-
-                if rotated_image_v1.mode == "RGBA":
-                    rotated_image_v1 = rotated_image_v1.convert("RGB")
-    
-                points, strs, elapse = pladdleOCR()
-    
-                angles = []
-                for pol in points[:10]:
-                    angles.append(polygon_orientation(pol))
-    
-                mean_angle  = np.mean(angles)
-                total_angle = rotate_angle
-    
-                if angles:
-                    total_angle += mean_angle
-                    rotated_image_v1 = cropped_image_tmp.rotate(total_angle, resample=Image.BICUBIC, expand=True, fillcolor=(255,255,255))
-                    rotated_image_v1.save("rotated_image.jpg")
-
-                    if rotated_image_v1.mode == "RGBA":
-                        rotated_image_v1 = rotated_image_v1.convert("RGB")
-
-                    points, strs, elapse = pladdleOCR()
-    
-                image_base64_rotated = convert_to_bytes(rotated_image_v1)            
-                prompt = "Locate all text (bbox coordinates). Include all readable and blury text and output in JSON format."
-                ocr_result = call_qwen_vision_api(image_base64_rotated, prompt)
-                data_extracted = extract_bbox_removing_incomplete(ocr_result)
-    
-                hr_im  = image.copy()
-    
-                meta_categories = ["bank statement", "letter with address", "credit or debit card", "bills or receipt", "preganancy test", "pregnancy test box", "mortage or investment report", "doctor prescription", "empty pill bottle", "condom with plastic bag", "tattoo sleeve", "transcript", "business card", "condom box", "local newspaper", "medical record document", "email", "phone", "id card",]
-    
-                prompt = f"From this list of categories: {' ,'.join(meta_categories)}, which one is related to this image. Only output the category" 
-                image_base64_full = convert_to_bytes(hr_im)
-                metacategory = call_qwen_vision_api(image_base64_full, prompt)
-
-                try:
-                    audio = text_to_audio_base64(f"I identified a {metacategory}")
-                    yield f"data: {json.dumps({'audio': audio, 'text': f'I identified a {metacategory}', 'stage': 'identified'})}\n\n"
-                except Exception as e:
-                    print(f"Audio error: {e}")
+                for field in field_info:
+                    if field['label'] not in ['none', 'other']:
+                        if (field['label'].lower() in custom_fields.lower() or 
+                            field['text'].lower() in custom_fields.lower()):
+                            fields_to_mask_indices.append(field['index'])
             
-                texts = [d['text_content'] for d in data_extracted]
-    
-                with open(f'label2item_list.json', 'r') as file:
-                    unique_categories_per_metacategory = json.load(file)
-                unique_categories = unique_categories_per_metacategory[metacategory]["contained_info"]
-                unique_categories.append("other")
-                unique_categories.append("none")
-                
-                high_risk = []
-                field_info = []
-                for idx, text in enumerate(texts):
-                    if idx == 0:
-                        try:
-                            audio = text_to_audio_base64(f"Classifying {len(texts)} text regions")
-                            yield f"data: {json.dumps({'audio': audio, 'text': f'Classifying {len(texts)} text regions', 'stage': 'classifying'})}\n\n"
-                        except Exception as e:
-                            print(f"Audio error: {e}")
-                    
-                    prompt = f"Based on the image, classify this text: '{text}' using these categories: {unique_categories}. Output only one category."
-                    label = call_qwen_vision_api(image_base64_full, prompt)
-                    
-                    high_risk.append(label)
-                    field_info.append({
-                        'text': text, 
-                        'label': label, 
-                        'index': idx,
-                        'bbox_2d': data_extracted[idx]['bbox_2d']
-                    })
-
+            # The session ends here, so its photo is redacted in place
+            detection_cache.pop(session_id)
+
+            with span("masking"):
+                fields_to_mask = [field for field in field_info if field['index'] in fields_to_mask_indices]
+                polygons = rotated_bbox_polygons(
+                    [field['bbox_2d'] for field in fields_to_mask], -total_angle, cropped_size, rotated_size, (crop_x, crop_y)
+                )
+                masked_count = redact_polygons(hr_im, polygons, mask_mode)
+            
+            if masked_count > 0:
                 try:
-                    audio = text_to_audio_base64(f"Classification complete.")
-                    yield f"data: {json.dumps({'audio': audio, 'text': f'Classifying {len(texts)} text regions', 'stage': 'classifying'})}\n\n"
+                    audio = text_to_audio_base64(f"Masked {masked_count} sensitive text region{'s' if masked_count != 1 else ''}. Processing complete.")
+                    yield f"data: {json.dumps({'audio': audio, 'text': f'Masked {masked_count} sensitive regions', 'stage': 'complete'})}\n\n"
                 except Exception as e:
                     print(f"Audio error: {e}")
-                 
-                
-                crop_x = bbox_orig[0]
-                crop_y = bbox_orig[1]
-                
-                import uuid
-                if not session_id:
-                    session_id = str(uuid.uuid4())
-                
-                detection_cache[session_id] = {
-                    'image': image,
-                    'hr_im': hr_im,
-                    'field_info': field_info,
-                    'bbox_orig': bbox_orig,
-                    'crop_x': crop_x,
-                    'crop_y': crop_y,
-                    'total_angle': total_angle,
-                    'cropped_image_tmp': cropped_image_tmp,
-                    'rotated_image_v1': rotated_image_v1
-                }
-                
-                sensitive_fields = [f for f in field_info if f['label'] not in ['none', 'other']]
-                
+            else:
                 try:
-                    audio = text_to_audio_base64("Do you want to proceed with regular masking? Say yes or no.")
-                    yield f"data: {json.dumps({'audio': audio, 'text': 'Awaiting user response', 'stage': 'awaiting_response', 'request_user_input': True, 'session_id': session_id})}\n\n"
+                    audio = text_to_audio_base64("No sensitive information was masked. Processing complete.")
+                    yield f"data: {json.dumps({'audio': audio, 'text': 'No sensitive information masked', 'stage': 'complete'})}\n\n"
                 except Exception as e:
                     print(f"Audio error: {e}")
-                return
-    
-            else:
-                has_private = False
+            
+            image_base64_result = convert_to_bytes(Image.fromarray(hr_im))
+            yield f"data: {json.dumps({'done': True, 'has_private_info': True, 'cropped_image': f'data:image/png;base64,{image_base64_result}', 'timings': request_timings()})}\n\n"
+            return
+        
+        if request_photo is None:
+            raise ValueError("No image provided")
+
+        # Stages that do not depend on each other run concurrently. One fused VLM
+        # call locates the document and names its metacategory; a second one
+        # locates and labels its text regions.
+        graph = StageGraph(pipeline_executor)
+        graph.add("scan_audio", partial(text_to_audio_base64, "Scanning for private information"))
+        graph.add("questions", partial(locate_document, request_photo))
+        graph.add("locate", lambda answers: answers[0], "questions")
+        graph.add("document", partial(crop_located_document, request_photo), "locate")
+        graph.add("deskew", deskew_document, "document")
+        # Opens the streamed text localization; regions are consumed while they are classified
+        graph.add("text_regions", lambda deskewed, answers: stream_text_regions(
+            deskewed[1], text_regions_prompt(taxonomy.categories_prompt(taxonomy.resolve(answers[1]))), max_tokens=512), "deskew", "questions")
+        # Encoded photo for the regions whose streamed label is missing or unknown
+        graph.add("full_image", partial(prepare_image, request_photo, "classify"))
+
+        bbox_orig = None
+        try:
+            try:
+                audio = graph.result("scan_audio")
+                yield f"data: {json.dumps({'audio': audio, 'text': 'Scanning for private information', 'stage': 'start'})}\n\n"
+            except Exception as e:
+                print(f"Audio error: {e}")
+            
+            bbox_orig, detection_result = graph.result("locate")
+        finally:
+            if bbox_orig is None:
+                graph.cancel()
+        
+        image = request_photo.image
+
+        has_private = True
+        if bbox_orig is not None:
+            try:
+                audio = text_to_audio_base64("Private document detected. Analyzing content.")
+                yield f"data: {json.dumps({'audio': audio, 'text': 'Private document detected. Analyzing content.', 'stage': 'detected'})}\n\n"
+            except Exception as e:
+                print(f"Audio error: {e}")
+
+            try:
+                cropped_image_tmp = graph.result("document")
+                total_angle, rotated_image_v1 = graph.result("deskew")
+                region_stream = graph.result("text_regions")
+                image_base64_full, full_mime_type, _ = graph.result("full_image")
+                metacategory_answer = graph.result("questions")[1]
+            finally:
+                graph.cancel()
+                print("detect_private stage timings: " + ", ".join(f"{name}={elapsed:.2f}s" for name, elapsed in graph.timings.items()))
+
+            # Writable pixels the masking step redacts in place
+            hr_im = np.array(image)
+
+            # Unknown answers fall back to every known field label
+            metacategory = taxonomy.resolve(metacategory_answer)
+            if metacategory is None:
+                print(f"Unknown metacategory answer: {metacategory_answer!r}")
+            metacategory_name = metacategory or metacategory_answer.strip()
+
+            try:
+                audio = text_to_audio_base64(f"I identified a {metacategory_name}")
+                yield f"data: {json.dumps({'audio': audio, 'text': f'I identified a {metacategory_name}', 'stage': 'identified'})}\n\n"
+            except Exception as e:
+                print(f"Audio error: {e}")
+        
+            # Regions arrive with their label; the ones without a valid label are
+            # classified separately as they stream in, so the total grows until the stream ends
+            field_labels = list(taxonomy.fields_for(metacategory))
+            data_extracted = []
+            labels = {}
+            unlabeled = []
+            def streamed_texts():
+                for region in region_stream:
+                    idx = len(data_extracted)
+                    data_extracted.append(region)
+                    label = region_label(region, field_labels)
+                    if label is not None:
+                        labels[idx] = label
+                        continue
+                    unlabeled.append(idx)
+                    yield region['text_content']
+
+            texts_iter = streamed_texts()
+            first_text = next(texts_iter, None)
+
+            if data_extracted:
                 try:
-                    audio = text_to_audio_base64("No private document detected in the image.")
-                    yield f"data: {json.dumps({'audio': audio, 'text': 'No private document detected', 'stage': 'none'})}\n\n"
+                    audio = text_to_audio_base64("Classifying text regions")
+                    yield f"data: {json.dumps({'audio': audio, 'text': 'Classifying text regions', 'stage': 'classifying'})}\n\n"
                 except Exception as e:
                     print(f"Audio error: {e}")
-                
-                yield f"data: {json.dumps({'done': True, 'detection': detection_result, 'has_private_info': has_private, 'cropped_image': None})}\n\n"
+
+            if first_text is not None:
+                for position, label in classify_texts(image_base64_full, itertools.chain([first_text], texts_iter), taxonomy.categories_prompt(metacategory), mime_type=full_mime_type):
+                    labels[unlabeled[position]] = label
+                    yield f"data: {json.dumps({'text': f'Classified {len(labels)} of {len(data_extracted)} text regions', 'stage': 'classifying', 'progress': len(labels) / len(data_extracted)})}\n\n"
+
+            texts = [d['text_content'] for d in data_extracted]
+            field_info = detected_fields(data_extracted, labels)
+
+            try:
+                audio = text_to_audio_base64(f"Classification complete.")
+                yield f"data: {json.dumps({'audio': audio, 'text': f'Classifying {len(texts)} text regions', 'stage': 'classifying'})}\n\n"
+            except Exception as e:
+                print(f"Audio error: {e}")
+             
+            
+            session_id = store_detection(session_id, hr_im, field_info, bbox_orig, total_angle,
+                                         cropped_image_tmp.size, rotated_image_v1.size)
+
+            try:
+                audio = text_to_audio_base64("Do you want to proceed with regular masking? Say yes or no.")
+                yield f"data: {json.dumps({'audio': audio, 'text': 'Awaiting user response', 'stage': 'awaiting_response', 'request_user_input': True, 'session_id': session_id, 'timings': request_timings()})}\n\n"
+            except Exception as e:
+                print(f"Audio error: {e}")
+            return
+
+        else:
+            has_private = False
+            try:
+                audio = text_to_audio_base64("No private document detected in the image.")
+                yield f"data: {json.dumps({'audio': audio, 'text': 'No private document detected', 'stage': 'none'})}\n\n"
+            except Exception as e:
+                print(f"Audio error: {e}")
             
-        except Exception as e:
-            print(f'Exception: {str(e)}')
-            import traceback
-            traceback.print_exc()
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
-    
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')           
+            yield f"data: {json.dumps({'done': True, 'detection': detection_result, 'has_private_info': has_private, 'cropped_image': None, 'timings': request_timings()})}\n\n"
+        
+    except Exception as e:
+        print(f'Exception: {str(e)}')
+        import traceback
+        traceback.print_exc()
+        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+
+@app.route("/detect_private", methods=["POST"])
+def detect_private():
+    """Detects and masks private information in documents using multi-stage OCR, qwen classification pipeline and SAM3. Implements interactive masking workflow with user prompts."""
+    request_photo = request_image(required=False)
+    params = request_params()
+    return admitted_response(detect_private_endpoint(params), detect_private_events(params, request_photo))
 
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=3000, debug=False)
@@ -0,0 +1,556 @@
+"""
+Asyncio (ASGI) serving mode for the accessible camera app.
+
+Run with:  uvicorn asgi:app --host 127.0.0.1 --port 3000
+
+Routes mirror app.py and reuse its pipeline functions and stores. VLM calls,
+streamed ones included, are awaited on the pooled async client, so requests
+waiting on the model hold no thread. TTS, speech recognition, OCR, SAM3 and
+image work run in executors. The SSE endpoints are async generators; only
+the masking answer of /detect_private, which makes no VLM call, reuses the
+Flask app's generator in the threadpool.
+"""
+import asyncio
+import json
+from collections import deque
+from functools import partial, wraps
+
+import numpy as np
+
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+from app import (
+    CATEGORY_QUESTION,
+    DOCUMENT_QUESTION,
+    ImageNotFound,
+    InvalidImage,
+    Overloaded,
+    admission,
+    crop_located_document,
+    deskew_document,
+    detect_private_endpoint,
+    detect_private_events,
+    detected_fields,
+    image_store,
+    pipeline_executor,
+    region_label,
+    store_detection,
+    taxonomy,
+    text_regions_prompt,
+    text_to_audio_base64,
+    transcribe_audio_data,
+    pcm_rate_param,
+    transcribe_chunk_data,
+    tts_executor,
+)
+from agents.prompts import async_ask_questions
+from agents.vlm import async_ask_vlm, async_ask_vlm_stream, async_classify_texts, async_stream_chunks, async_stream_text_regions, prepare_image, scale_bbox
+from agents.metrics import async_track_stream, observe_stage, registry, request_timings, submit_with_context, track_request
+from utils import RequestImage, save_debug_image, split_sentences
+
+
+async def read_request(request):
+    """
+    Reads the request once and returns (params, RequestImage or None). Same
+    inputs as the Flask helpers: image_id, multipart 'image', raw image/* body or JSON data URL,
+    with the other fields from the query string, a form (multipart or urlencoded) or the JSON body.
+    """
+    params = dict(request.query_params)
+    photo = None
+    files = {}
+    content_type = request.headers.get("content-type", "")
+
+    if content_type.startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+        form = await request.form()
+        for key, value in form.items():
+            if hasattr(value, "read"):
+                files[key] = await value.read()
+            else:
+                params[key] = value
+        if "image" in files:
+            photo = RequestImage(files["image"])
+    elif content_type.startswith("image/"):
+        photo = RequestImage(await request.body())
+    elif content_type.startswith("application/json"):
+        body = await request.json() or {}
+        data = body.pop("image", None)
+        params.update(body)
+        if data:
+            try:
+                photo = RequestImage.from_data_url(data)
+            except ValueError as e:
+                raise InvalidImage(f"Invalid image data: {e}")
+
+    image_id = params.get("image_id")
+    if image_id:
+        photo = image_store.get(image_id)
+        if photo is None:
+            raise ImageNotFound(f"Image {image_id} expired, please upload it again")
+
+    return params, photo, files
+
+
+async def run_tts(text):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(tts_executor, text_to_audio_base64, text)
+
+
+def in_executor(executor, fn, *args):
+    """Runs fn in executor with the caller's context (so spans reach the request timings) and returns an awaitable."""
+    return asyncio.wrap_future(submit_with_context(executor, fn, *args))
+
+
+async def audio_event(text, **fields):
+    """SSE event with the audio of text plus fields, or None when TTS fails."""
+    try:
+        audio = await run_tts(text)
+    except Exception as e:
+        print(f"Audio error: {e}")
+        return None
+    return f"data: {json.dumps({'audio': audio, **fields})}\n\n"
+
+
+async def image_not_found(request, e):
+    return JSONResponse({
+        "status": "error",
+        "message": str(e),
+        "image_expired": True
+    }, status_code=410)
+
+
+async def invalid_image(request, e):
+    return JSONResponse({
+        "status": "error",
+        "message": str(e)
+    }, status_code=400)
+
+
+async def overloaded(request, e):
+    return JSONResponse({
+        "status": "error",
+        "message": str(e),
+        "retry_after": e.retry_after
+    }, status_code=503, headers={"Retry-After": str(e.retry_after)})
+
+
+def admitted_async(endpoint):
+    """Async counterpart of admission.limited; see AdmissionController.acquire_async."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request):
+            ticket = await admission.acquire_async(endpoint)
+            try:
+                return await view(request)
+            finally:
+                ticket.release()
+        return wrapper
+    return decorator
+
+
+async def admitted_events(ticket, events):
+    """Async counterpart of app.admitted_stream."""
+    try:
+        observe_stage("queue_wait", ticket.wait)
+        yield f"data: {json.dumps({'stage': 'admitted', 'queue_wait': round(ticket.wait, 3)})}\n\n"
+        async for event in events:
+            yield event
+    finally:
+        ticket.release()
+
+
+async def admitted_response(endpoint, events):
+    """SSE response for an async generator of events admitted as endpoint; see app.admitted_response."""
+    ticket = await admission.acquire_async(endpoint)
+    return StreamingResponse(
+        async_track_stream(endpoint, admitted_events(ticket, events)),
+        media_type="text/event-stream",
+        background=BackgroundTask(ticket.release),
+    )
+
+
+def tracked_async(endpoint):
+    """Async counterpart of agents.metrics.tracked."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request):
+            with track_request(endpoint):
+                return await view(request)
+        return wrapper
+    return decorator
+
+
+async def metrics(request):
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+async def health(request):
+    return PlainTextResponse("OK")
+
+
+async def index(request):
+    return FileResponse("templates/index.html")
+
+
+@tracked_async("upload")
+async def upload(request):
+    """Stores an uploaded image so later calls can reference it by image_id."""
+    try:
+        _, photo, _ = await read_request(request)
+        if photo is None:
+            raise ValueError("No image provided")
+        image = await run_in_threadpool(lambda: photo.image)
+
+        save_debug_image(image, "photo.png")
+        # Encodings made by later requests count against IMAGE_STORE_MB
+        photo.on_resize = partial(image_store.remeasure, photo.hash)
+        image_store.set(photo.hash, photo)
+
+        return JSONResponse({
+            "status": "ok",
+            "message": "Image received successfully",
+            "image_id": photo.hash,
+            "width": image.width,
+            "height": image.height
+        })
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+
+
+@tracked_async("transcribe_audio")
+@admitted_async("transcribe_audio")
+async def transcribe_audio(request):
+    """Transcribes an uploaded audio file. Decoding and recognition run in the threadpool."""
+    try:
+        _, _, files = await read_request(request)
+        if "audio" not in files:
+            return JSONResponse({
+                "status": "error",
+                "message": "No audio file provided"
+            }, status_code=400)
+
+        result, status = await run_in_threadpool(transcribe_audio_data, files["audio"])
+        return JSONResponse(result, status_code=status)
+
+    except Exception as e:
+        return JSONResponse({
+            "status": "error",
+            "message": f"Transcription failed: {str(e)}"
+        }, status_code=500)
+
+
+@tracked_async("transcribe_audio_chunk")
+async def transcribe_audio_chunk(request):
+    """Chunked transcription while the user is still speaking; see app.transcribe_chunk_data."""
+    try:
+        params, _, files = await read_request(request)
+        final = params.get("final") in ("1", "true")
+        result, status = await run_in_threadpool(
+            transcribe_chunk_data, params.get("stream_id"), files.get("audio", b""), final
+        )
+        return JSONResponse(result, status_code=status)
+
+    except Exception as e:
+        return JSONResponse({
+            "status": "error",
+            "message": f"Transcription failed: {str(e)}"
+        }, status_code=500)
+
+
+@tracked_async("transcribe_audio_pcm")
+async def transcribe_audio_pcm(request):
+    """Raw 16-bit PCM upload; see app.transcribe_audio_pcm."""
+    try:
+        params = dict(request.query_params)
+        chunk = await request.body()
+        result, status = await run_in_threadpool(
+            transcribe_chunk_data, params.get("stream_id"), chunk, params.get("final") in ("1", "true"), pcm_rate_param(params)
+        )
+        return JSONResponse(result, status_code=status)
+
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+    except Exception as e:
+        return JSONResponse({
+            "status": "error",
+            "message": f"Transcription failed: {str(e)}"
+        }, status_code=500)
+
+
+@tracked_async("speak")
+@admitted_async("speak")
+async def speak(request):
+    """Generates complete audio description of image in one chunk."""
+    _, photo, _ = await read_request(request)
+    if photo is None:
+        raise InvalidImage("No image provided")
+    try:
+        text = await async_ask_vlm(photo, "describe this image in detail", "describe")
+        audio_base64 = await run_tts(text)
+
+        return JSONResponse({
+            "status": "success",
+            "audio": f"data:audio/mp3;base64,{audio_base64}"
+        })
+
+    except InvalidImage:
+        raise
+    except Exception as e:
+        return JSONResponse({
+            "status": "error",
+            "message": f"Speech generation failed: {str(e)}"
+        }, status_code=500)
+
+
+async def speak_stream_events(image):
+    """Async counterpart of app.speak_stream_events: tokens are awaited on the async client, each sentence is synthesized in the TTS pool."""
+    try:
+        stream = await async_ask_vlm_stream(image, "Describe this image in detail. Use short, clear sentences.", "describe")
+
+        buffer = ""
+        pending = deque()
+
+        async def completed_audio(wait=False):
+            # Emit clips in sentence order; stop at the first one still being synthesized.
+            events = []
+            while pending and (wait or pending[0][1].done()):
+                sentence, future = pending.popleft()
+                try:
+                    audio_base64 = await future
+                except Exception as audio_error:
+                    print(f"Audio generation error: {audio_error}")
+                    continue
+                events.append(f"data: {json.dumps({'audio': audio_base64, 'text': sentence})}\n\n")
+            return events
+
+        async for text_chunk in async_stream_chunks(stream):
+            sentences, buffer = split_sentences(buffer + text_chunk)
+            for sentence in sentences:
+                print(f"Generating audio for: {sentence}")
+                pending.append((sentence, in_executor(tts_executor, text_to_audio_base64, sentence)))
+            for event in await completed_audio():
+                yield event
+
+        if buffer.strip():
+            print(f"Generating audio for final: {buffer}")
+            pending.append((buffer.strip(), in_executor(tts_executor, text_to_audio_base64, buffer.strip())))
+
+        for event in await completed_audio(wait=True):
+            yield event
+
+        yield f"data: {json.dumps({'done': True, 'timings': request_timings()})}\n\n"
+
+    except Exception as e:
+        print(f'Exception: {str(e)}')
+        import traceback
+        traceback.print_exc()
+        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+
+async def speak_stream(request):
+    """Streams image description as audio chunks; see speak_stream_events."""
+    _, photo, _ = await read_request(request)
+    if photo is None:
+        raise InvalidImage("No image provided")
+    return await admitted_response("speak_stream", speak_stream_events(photo))
+
+
+@tracked_async("ask_question")
+@admitted_async("ask_question")
+async def ask_question(request):
+    """Answers a question about the image. The VLM call is awaited, TTS runs in the TTS pool."""
+    params, photo, _ = await read_request(request)
+    try:
+        question = params.get("question", "")
+
+        if not question:
+            return JSONResponse({
+                "status": "error",
+                "message": "No question provided"
+            }, status_code=400)
+
+        if question == "Error with voice question":
+            answer = "I did not understand the question. Can you repeat it"
+        else:
+            if photo is None:
+                raise InvalidImage("No image provided")
+            prompt = f"Answer this question about the image: {question}"
+            answer = await async_ask_vlm(photo, prompt, "question")
+
+        audio_base64 = await run_tts(answer)
+
+        return JSONResponse({
+            "status": "success",
+            "audio": f"data:audio/mp3;base64,{audio_base64}",
+            "answer": answer
+        })
+
+    except InvalidImage:
+        raise
+    except Exception as e:
+        return JSONResponse({
+            "status": "error",
+            "message": f"Question processing failed: {str(e)}"
+        }, status_code=500)
+
+
+async def locate_document(photo):
+    """Async counterpart of app.locate_document."""
+    answers, scale, raw = await async_ask_questions(photo, [DOCUMENT_QUESTION, CATEGORY_QUESTION], "locate")
+    bbox = answers["document"]
+    return (scale_bbox(bbox, scale) if bbox is not None else None, raw), answers["category"]
+
+
+async def prepare_document(photo, located, metacategory):
+    """
+    Crop, segmentation and deskew of the located document in the pipeline pool, then opens
+    the streamed text localization on it. Returns (cropped, total_angle, rotated, region_stream).
+    """
+    cropped = await in_executor(pipeline_executor, crop_located_document, photo, located)
+    total_angle, rotated = await in_executor(pipeline_executor, deskew_document, cropped)
+    region_stream = await async_stream_text_regions(
+        rotated, text_regions_prompt(taxonomy.categories_prompt(metacategory)), max_tokens=512)
+    return cropped, total_angle, rotated, region_stream
+
+
+async def detection_events(photo, session_id):
+    """
+    Detection and classification of app.detect_private_events as an async generator.
+    VLM calls, the streamed text regions included, are awaited; CPU stages run in the pipeline pool.
+    """
+    if photo is None:
+        raise ValueError("No image provided")
+
+    scan_audio = asyncio.ensure_future(audio_event("Scanning for private information", text='Scanning for private information', stage='start'))
+    questions = asyncio.ensure_future(locate_document(photo))
+    # Encoded photo for the regions whose streamed label is missing or unknown
+    full_image = in_executor(pipeline_executor, prepare_image, photo, "classify")
+    tasks = [scan_audio, questions, full_image]
+    try:
+        event = await scan_audio
+        if event:
+            yield event
+        (bbox_orig, detection_result), metacategory_answer = await questions
+
+        if bbox_orig is None:
+            event = await audio_event("No private document detected in the image.", text='No private document detected', stage='none')
+            if event:
+                yield event
+            yield f"data: {json.dumps({'done': True, 'detection': detection_result, 'has_private_info': False, 'cropped_image': None, 'timings': request_timings()})}\n\n"
+            return
+
+        # Unknown answers fall back to every known field label
+        metacategory = taxonomy.resolve(metacategory_answer)
+        if metacategory is None:
+            print(f"Unknown metacategory answer: {metacategory_answer!r}")
+        metacategory_name = metacategory or metacategory_answer.strip()
+
+        document = asyncio.ensure_future(prepare_document(photo, (bbox_orig, detection_result), metacategory))
+        tasks.append(document)
+        event = await audio_event("Private document detected. Analyzing content.", text='Private document detected. Analyzing content.', stage='detected')
+        if event:
+            yield event
+
+        cropped_image, total_angle, rotated_image, region_stream = await document
+        image_base64_full, full_mime_type, _ = await full_image
+        hr_im = await in_executor(pipeline_executor, lambda: np.array(photo.image))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    event = await audio_event(f"I identified a {metacategory_name}", text=f'I identified a {metacategory_name}', stage='identified')
+    if event:
+        yield event
+
+    # Regions arrive with their label; the ones without a valid label are
+    # classified separately as they stream in, so the total grows until the stream ends
+    field_labels = list(taxonomy.fields_for(metacategory))
+    data_extracted = []
+    labels = {}
+    unlabeled = []
+
+    async def streamed_texts():
+        async for region in region_stream:
+            idx = len(data_extracted)
+            data_extracted.append(region)
+            label = region_label(region, field_labels)
+            if label is not None:
+                labels[idx] = label
+                continue
+            unlabeled.append(idx)
+            yield region['text_content']
+
+    texts_iter = streamed_texts()
+    first_text = await anext(texts_iter, None)
+
+    if data_extracted:
+        event = await audio_event("Classifying text regions", text='Classifying text regions', stage='classifying')
+        if event:
+            yield event
+
+    if first_text is not None:
+        async def remaining_texts():
+            yield first_text
+            async for text in texts_iter:
+                yield text
+
+        async for position, label in async_classify_texts(image_base64_full, remaining_texts(), taxonomy.categories_prompt(metacategory), mime_type=full_mime_type):
+            labels[unlabeled[position]] = label
+            yield f"data: {json.dumps({'text': f'Classified {len(labels)} of {len(data_extracted)} text regions', 'stage': 'classifying', 'progress': len(labels) / len(data_extracted)})}\n\n"
+
+    field_info = detected_fields(data_extracted, labels)
+    event = await audio_event("Classification complete.", text=f'Classifying {len(data_extracted)} text regions', stage='classifying')
+    if event:
+        yield event
+
+    session_id = store_detection(session_id, hr_im, field_info, bbox_orig, total_angle, cropped_image.size, rotated_image.size)
+
+    event = await audio_event("Do you want to proceed with regular masking? Say yes or no.", text='Awaiting user response', stage='awaiting_response',
+                              request_user_input=True, session_id=session_id, timings=request_timings())
+    if event:
+        yield event
+
+
+async def detect_private_events_async(params, photo):
+    """Async counterpart of app.detect_private_events."""
+    try:
+        if detect_private_endpoint(params) == "detect_private_answer":
+            # Masking only redraws the stored photo and speaks; it reuses the Flask generator in the threadpool
+            async for event in iterate_in_threadpool(detect_private_events(params, photo)):
+                yield event
+            return
+        async for event in detection_events(photo, params.get("session_id")):
+            yield event
+    except Exception as e:
+        print(f'Exception: {str(e)}')
+        import traceback
+        traceback.print_exc()
+        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+
+async def detect_private(request):
+    """Runs the privacy pipeline; VLM calls are awaited and blocking stages advance in executors while the loop serves other sessions."""
+    params, photo, _ = await read_request(request)
+    return await admitted_response(detect_private_endpoint(params), detect_private_events_async(params, photo))
+
+
+routes = [
+    Route("/", index),
+    Route("/health", health),
+    Route("/metrics", metrics),
+    Route("/upload", upload, methods=["POST"]),
+    Route("/transcribe_audio", transcribe_audio, methods=["POST"]),
+    Route("/transcribe_audio/chunk", transcribe_audio_chunk, methods=["POST"]),
+    Route("/transcribe_audio/pcm", transcribe_audio_pcm, methods=["POST"]),
+    Route("/speak", speak, methods=["POST"]),
+    Route("/speak_stream", speak_stream, methods=["POST"]),
+    Route("/ask_question", ask_question, methods=["POST"]),
+    Route("/detect_private", detect_private, methods=["POST"]),
+    Mount("/static", StaticFiles(directory="static"), name="static"),
+]
+
+app = Starlette(routes=routes, exception_handlers={ImageNotFound: image_not_found, InvalidImage: invalid_image, Overloaded: overloaded})
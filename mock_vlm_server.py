@@ -0,0 +1,166 @@
+"""
+Local stand-in for the Hugging Face chat completions endpoint, for measuring
+VLM tail latency offline.
+
+    python mock_vlm_server.py serve --port 8089 --slow-rate 0.05
+    VLM_BASE_URL=http://127.0.0.1:8089 python app.py
+
+    python mock_vlm_server.py bench --requests 400 --hedge-percentile 95
+
+Each request sleeps for a log-normal latency (median --latency); a fraction
+--slow-rate of them takes --slow-factor times longer and a fraction
+--error-rate answers 503. Streaming requests get an SSE response.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_ANSWER = '```json\n[\n  {"bbox_2d": [10, 20, 110, 60], "text_content": "mock"}\n]\n```'
+
+
+class MockBehaviour():
+    """Latency and failure profile of the mock endpoint."""
+
+    def __init__(self, latency=0.2, sigma=0.3, slow_rate=0.05, slow_factor=10.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.sigma = sigma
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        """Returns (seconds to wait, whether to fail)."""
+        with self.lock:
+            delay = self.random.lognormvariate(0, self.sigma) * self.latency
+            if self.random.random() < self.slow_rate:
+                delay *= self.slow_factor
+            return delay, self.random.random() < self.error_rate
+
+
+def make_handler(behaviour):
+    class MockVLMHandler(BaseHTTPRequestHandler):
+        # Keep-alive, so the client's connection pool is exercised
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.path.rstrip("/").endswith("chat/completions"):
+                self._send(404, b'{"error": "not found"}')
+                return
+            delay, fail = behaviour.sample()
+            time.sleep(delay)
+            if fail:
+                self._send(503, b'{"error": "mock overload"}')
+                return
+
+            model = request.get("model", "mock")
+            created = int(time.time())
+            if request.get("stream"):
+                events = []
+                for piece in (MOCK_ANSWER[i:i + 12] for i in range(0, len(MOCK_ANSWER), 12)):
+                    chunk = {"id": "mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                             "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}]}
+                    events.append(f"data: {json.dumps(chunk)}\n\n")
+                events.append("data: [DONE]\n\n")
+                self._send(200, "".join(events).encode(), "text/event-stream")
+                return
+
+            body = {
+                "id": "mock", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": MOCK_ANSWER}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+            self._send(200, json.dumps(body).encode())
+
+    return MockVLMHandler
+
+
+def start_server(behaviour, host="127.0.0.1", port=8089):
+    """Starts the mock server on a daemon thread and returns it (port 0 picks a free one)."""
+    server = ThreadingHTTPServer((host, port), make_handler(behaviour))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    ordered = sorted(samples)
+    return {p: ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] for p in points}
+
+
+def run_bench(base_url, requests_count, concurrency, hedge_percentile, retries):
+    from agents.transport import CircuitBreaker, VLMTransport
+
+    transport = VLMTransport(api_key="mock", base_url=base_url, default_timeout=30.0, retries=retries,
+                             hedge_percentile=hedge_percentile, breaker=CircuitBreaker(failure_threshold=10 ** 6),
+                             max_workers=concurrency)
+    messages = [{"role": "user", "content": "benchmark"}]
+    failures = []
+
+    def one(_):
+        start = time.monotonic()
+        try:
+            transport.chat(messages, 64, "mock")
+        except Exception as e:
+            failures.append(e)
+        return time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, range(requests_count)))
+    return percentiles(latencies), len(failures), transport.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["serve", "bench"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.2, help="median latency in seconds")
+    parser.add_argument("--sigma", type=float, default=0.3, help="log-normal spread of the latency")
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-factor", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--requests", type=int, default=200, help="bench: requests per run")
+    parser.add_argument("--concurrency", type=int, default=8, help="bench: concurrent callers")
+    parser.add_argument("--hedge-percentile", type=float, default=95.0, help="bench: hedging threshold of the second run")
+    parser.add_argument("--retries", type=int, default=2, help="bench: transport retries")
+    args = parser.parse_args()
+
+    behaviour = MockBehaviour(args.latency, args.sigma, args.slow_rate, args.slow_factor, args.error_rate, args.seed)
+    if args.command == "serve":
+        server = start_server(behaviour, args.host, args.port)
+        print(f"Mock VLM listening on http://{args.host}:{server.server_address[1]}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    server = start_server(behaviour, args.host, 0)
+    base_url = f"http://{args.host}:{server.server_address[1]}"
+    for label, hedge in (("no hedging", None), (f"hedged at p{args.hedge_percentile:g}", args.hedge_percentile)):
+        points, failed, stats = run_bench(base_url, args.requests, args.concurrency, hedge, args.retries)
+        summary = "  ".join(f"p{p}={seconds * 1000:.0f}ms" for p, seconds in points.items())
+        print(f"{label:>16}: {summary}  failed={failed}  retried={stats['retried']}  hedged={stats['hedged']}  hedge_wins={stats['hedge_wins']}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,80 @@
 /**
  * sightAI - Accessible Camera Application for Visually Impaired Users
  */
+
+// Voice capture: 16 kHz mono PCM, trimmed by an energy VAD before upload
+const PCM_SAMPLE_RATE = 16000;
+const VAD_MIN_RMS = 0.01;
+const VAD_PREROLL_MS = 250;
+const VAD_END_SILENCE_MS = 1200;
+const PCM_UPLOAD_MS = 500;
+
+/**
+ * Downsamples a Float32 block to PCM_SAMPLE_RATE by averaging and returns 16-bit samples.
+ */
+function toPcm16(block, inputRate) {
+    const ratio = inputRate / PCM_SAMPLE_RATE;
+    const length = Math.floor(block.length / ratio);
+    const pcm = new Int16Array(length);
+    for (let i = 0; i < length; i++) {
+        const start = Math.floor(i * ratio);
+        const end = Math.max(start + 1, Math.floor((i + 1) * ratio));
+        let sum = 0;
+        for (let j = start; j < end; j++) {
+            sum += block[j];
+        }
+        const sample = Math.max(-1, Math.min(1, sum / (end - start)));
+        pcm[i] = sample < 0 ? sample * 0x8000 : sample * 0x7fff;
+    }
+    return pcm;
+}
+
+/**
+ * Root-mean-square energy of a 16-bit block, scaled to [0, 1].
+ */
+function pcmRms(pcm) {
+    let sum = 0;
+    for (let i = 0; i < pcm.length; i++) {
+        sum += (pcm[i] / 32768) ** 2;
+    }
+    return Math.sqrt(sum / Math.max(1, pcm.length));
+}
+
+/**
+ * Concatenates 16-bit blocks into one Int16Array.
+ */
+function concatPcm(blocks) {
+    const pcm = new Int16Array(blocks.reduce((total, block) => total + block.length, 0));
+    let offset = 0;
+    for (const block of blocks) {
+        pcm.set(block, offset);
+        offset += block.length;
+    }
+    return pcm;
+}
+
+/**
+ * Wraps 16-bit mono PCM in a WAV container so it can go through /transcribe_audio.
+ */
+function pcmToWav(pcm) {
+    const view = new DataView(new ArrayBuffer(44));
+    const writeString = (offset, text) => [...text].forEach((c, i) => view.setUint8(offset + i, c.charCodeAt(0)));
+    writeString(0, 'RIFF');
+    view.setUint32(4, 36 + pcm.byteLength, true);
+    writeString(8, 'WAVE');
+    writeString(12, 'fmt ');
+    view.setUint32(16, 16, true);
+    view.setUint16(20, 1, true);
+    view.setUint16(22, 1, true);
+    view.setUint32(24, PCM_SAMPLE_RATE, true);
+    view.setUint32(28, PCM_SAMPLE_RATE * 2, true);
+    view.setUint16(32, 2, true);
+    view.setUint16(34, 16, true);
+    writeString(36, 'data');
+    view.setUint32(40, pcm.byteLength, true);
+    return new Blob([view, pcm], { type: 'audio/wav' });
+}
+
 class sightAI{
     constructor() {
         this.video = document.getElementById("video");
@@ -13,6 +87,8 @@ class sightAI{
         this.askQuestionBtn = document.getElementById("askQuestion");
 
         this.currentImageData = null;
+        this.currentImageBlob = null;
+        this.currentImageId = null;
         this.audioQueue = [];
         this.isPlayingAudio = false;
         this.currentAudio = null;
@@ -21,6 +97,10 @@ class sightAI{
         this.audioChunks = [];
         this.isRecording = false;
         this.recordingStream = null;
+        this.transcriptionStreamId = null;
+        this.chunkUploads = null;
+        this.pendingTranscription = null;
+        this.stopPcmCapture = null;
 
         this.initializeEvents();
         this.startCamera();
@@ -81,12 +161,89 @@ class sightAI{
             this.canvas.style.display = "block";
             this.video.style.display = "none";
 
-            this.currentImageData = imageData;
-            this.enableActionButtons();
+            fetch(imageData)
+                .then(response => response.blob())
+                .then(blob => {
+                    this.currentImageData = imageData;
+                    this.currentImageBlob = blob;
+                    this.currentImageId = null;
+                    this.enableActionButtons();
+                    this.uploadCurrentImage();
+                });
         };
         img.src = imageData;
     }
 
+    /**
+     * Uploads the current image once so follow-up requests can reference it by id instead of re-sending it.
+     */
+    async uploadCurrentImage() {
+        const blob = this.currentImageBlob;
+        const formData = new FormData();
+        formData.append('image', blob, 'image');
+
+        try {
+            const response = await fetch('/upload', {
+                method: 'POST',
+                body: formData
+            });
+            const result = await response.json();
+            if (result.status === 'ok' && this.currentImageBlob === blob) {
+                this.currentImageId = result.image_id;
+            }
+        } catch (error) {
+            console.error('Image upload failed, requests will carry the image:', error);
+        }
+    }
+
+    /**
+     * Builds a multipart body with the current image id (or the image itself) plus the given fields. Null fields are left out.
+     */
+    buildImageForm(fields = {}) {
+        const formData = new FormData();
+        if (this.currentImageId) {
+            formData.append('image_id', this.currentImageId);
+        } else {
+            formData.append('image', this.currentImageBlob, 'image');
+        }
+        for (const [key, value] of Object.entries(fields)) {
+            if (value !== null && value !== undefined) {
+                formData.append(key, value);
+            }
+        }
+        return formData;
+    }
+
+    /**
+     * Posts the image form to an endpoint. Re-sends the image itself if the server no longer holds the uploaded id.
+     */
+    async postImageForm(url, fields = {}) {
+        let response = await fetch(url, {
+            method: 'POST',
+            body: this.buildImageForm(fields)
+        });
+
+        // Server busy: wait as long as it asks (up to 10 s) and try once more
+        if (response.status === 503) {
+            const retryAfter = Math.min(parseInt(response.headers.get('Retry-After'), 10) || 1, 10);
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+            response = await fetch(url, {
+                method: 'POST',
+                body: this.buildImageForm(fields)
+            });
+        }
+
+        if (response.status === 410 && this.currentImageId) {
+            this.currentImageId = null;
+            response = await fetch(url, {
+                method: 'POST',
+                body: this.buildImageForm(fields)
+            });
+            this.uploadCurrentImage();
+        }
+        return response;
+    }
+
     /**
      * Captures photo from video stream and displays it. Takes snapshot of current video frame.
      */
@@ -120,6 +277,14 @@ class sightAI{
      * Records audio using MediaRecorder API with configurable duration. Returns promise that resolves with audio blob.
      */	
     async recordAudio(maxDuration = 10000) {
+        if (window.AudioWorkletNode) {
+            try {
+                return await this.recordPcmAudio(maxDuration);
+            } catch (error) {
+                console.log('PCM capture unavailable, using MediaRecorder:', error);
+            }
+        }
+
         return new Promise(async (resolve, reject) => {
             try {
                 this.recordingStream = await navigator.mediaDevices.getUserMedia({ 
@@ -131,6 +296,9 @@ class sightAI{
                 });
 
                 this.audioChunks = [];
+                this.transcriptionStreamId = null;
+                this.chunkUploads = Promise.resolve();
+                this.pendingTranscription = null;
                 
                 let mimeType = 'audio/webm';
                 if (MediaRecorder.isTypeSupported('audio/webm;codecs=opus')) {
@@ -148,11 +316,13 @@ class sightAI{
                 this.mediaRecorder.ondataavailable = (event) => {
                     if (event.data.size > 0) {
                         this.audioChunks.push(event.data);
+                        this.sendAudioChunk(event.data, false);
                     }
                 };
 
                 this.mediaRecorder.onstop = () => {
                     const audioBlob = new Blob(this.audioChunks, { type: mimeType });
+                    this.pendingTranscription = this.sendAudioChunk(null, true);
                     
                     // Stop all tracks
                     if (this.recordingStream) {
@@ -171,7 +341,8 @@ class sightAI{
                     reject(new Error('Recording failed: ' + event.error));
                 };
 
-                this.mediaRecorder.start();
+                // Emit a chunk every second so the server can transcribe while the user speaks
+                this.mediaRecorder.start(1000);
                 this.isRecording = true;
 
                 setTimeout(() => {
@@ -186,10 +357,173 @@ class sightAI{
         });
     }
 
+    /**
+     * Records 16 kHz PCM through an AudioWorklet. Silence before the first word is never sent,
+     * trailing silence is dropped and recording stops on its own once the speaker has finished.
+     * Resolves with a WAV blob of the kept audio.
+     */
+    async recordPcmAudio(maxDuration = 10000) {
+        this.recordingStream = await navigator.mediaDevices.getUserMedia({
+            audio: {
+                echoCancellation: true,
+                noiseSuppression: true,
+                autoGainControl: true
+            }
+        });
+
+        const context = new AudioContext();
+        let source = null;
+        let node = null;
+        try {
+            await context.audioWorklet.addModule('/static/pcm-worklet.js');
+            source = context.createMediaStreamSource(this.recordingStream);
+            node = new AudioWorkletNode(context, 'pcm-capture');
+        } catch (error) {
+            this.recordingStream.getTracks().forEach(track => track.stop());
+            this.recordingStream = null;
+            context.close();
+            throw error;
+        }
+
+        this.transcriptionStreamId = null;
+        this.chunkUploads = Promise.resolve();
+        this.pendingTranscription = null;
+
+        return new Promise((resolve) => {
+            const kept = [];           // speech sent so far
+            let preroll = [];          // recent blocks before the first word
+            let silence = [];          // blocks since the last word, sent only if speech resumes
+            let unsent = [];
+            let unsentSamples = 0;
+            let noiseFloor = null;
+            let speaking = false;
+            let silentMs = 0;
+
+            const enqueue = (blocks) => {
+                for (const block of blocks) {
+                    kept.push(block);
+                    unsent.push(block);
+                    unsentSamples += block.length;
+                }
+                if (unsentSamples >= PCM_SAMPLE_RATE * PCM_UPLOAD_MS / 1000) {
+                    this.sendAudioChunk(concatPcm(unsent), false, true);
+                    unsent = [];
+                    unsentSamples = 0;
+                }
+            };
+
+            node.port.onmessage = (event) => {
+                const block = toPcm16(event.data, context.sampleRate);
+                const blockMs = block.length * 1000 / PCM_SAMPLE_RATE;
+                const rms = pcmRms(block);
+                // Tracks the quietest recent block and rises slowly so it adapts to the room
+                noiseFloor = noiseFloor === null ? rms : Math.min(rms, noiseFloor * 1.02);
+                const isSpeech = rms > Math.max(VAD_MIN_RMS, noiseFloor * 3);
+
+                if (isSpeech) {
+                    enqueue(speaking ? silence : preroll);
+                    enqueue([block]);
+                    speaking = true;
+                    preroll = [];
+                    silence = [];
+                    silentMs = 0;
+                } else if (speaking) {
+                    silence.push(block);
+                    silentMs += blockMs;
+                    if (silentMs >= VAD_END_SILENCE_MS) {
+                        finish();
+                    }
+                } else {
+                    preroll.push(block);
+                    while (preroll.length * blockMs > VAD_PREROLL_MS) {
+                        preroll.shift();
+                    }
+                }
+            };
+
+            const finish = () => {
+                if (!this.stopPcmCapture) {
+                    return;
+                }
+                this.stopPcmCapture = null;
+                this.isRecording = false;
+                clearTimeout(timeout);
+                node.port.onmessage = null;
+                source.disconnect();
+                node.disconnect();
+                context.close();
+                if (this.recordingStream) {
+                    this.recordingStream.getTracks().forEach(track => track.stop());
+                    this.recordingStream = null;
+                }
+
+                this.pendingTranscription = this.sendAudioChunk(concatPcm(unsent), true, true);
+                resolve(pcmToWav(concatPcm(kept)));
+            };
+
+            const timeout = setTimeout(finish, maxDuration);
+            this.stopPcmCapture = finish;
+            this.isRecording = true;
+            source.connect(node);
+        });
+    }
+
+    /**
+     * Uploads one recorded chunk to /transcribe_audio/chunk (or raw PCM to /transcribe_audio/pcm), in order.
+     * The final call resolves with the transcription.
+     */
+    sendAudioChunk(chunk, final, pcm = false) {
+        const upload = this.chunkUploads.then(async () => {
+            let response;
+            if (pcm) {
+                const query = new URLSearchParams({ rate: PCM_SAMPLE_RATE });
+                if (this.transcriptionStreamId) {
+                    query.append('stream_id', this.transcriptionStreamId);
+                }
+                if (final) {
+                    query.append('final', '1');
+                }
+                response = await fetch(`/transcribe_audio/pcm?${query}`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'audio/l16' },
+                    body: chunk
+                });
+            } else {
+                const formData = new FormData();
+                if (this.transcriptionStreamId) {
+                    formData.append('stream_id', this.transcriptionStreamId);
+                }
+                if (chunk) {
+                    formData.append('audio', chunk, 'chunk.webm');
+                }
+                if (final) {
+                    formData.append('final', '1');
+                }
+                response = await fetch('/transcribe_audio/chunk', {
+                    method: 'POST',
+                    body: formData
+                });
+            }
+            const result = await response.json();
+            if (!response.ok) {
+                throw new Error(result.message || `Transcription failed: ${response.status}`);
+            }
+            this.transcriptionStreamId = result.stream_id;
+            return result;
+        });
+        // A failed chunk must not hold back the later ones, least of all the final call that ends the stream
+        this.chunkUploads = upload.catch((error) => console.log(`Audio chunk upload failed: ${error.message}`));
+        return upload;
+    }
+
     /**
      * Stops the current audio recording. Sets recording flag to false and stops MediaRecorder.
      */	
     stopRecording() {
+        if (this.stopPcmCapture) {
+            this.stopPcmCapture();
+            return;
+        }
         if (this.mediaRecorder && this.mediaRecorder.state === 'recording') {
             this.isRecording = false;
             this.mediaRecorder.stop();
@@ -328,6 +662,19 @@ class sightAI{
             }
         }
 
+        const pending = this.pendingTranscription;
+        this.pendingTranscription = null;
+        if (pending) {
+            try {
+                const result = await pending;
+                if (result.status === 'success') {
+                    return result.text;
+                }
+            } catch (e) {
+                console.log('Chunked transcription failed, uploading the whole recording');
+            }
+        }
+
         return await this.transcribeAudioBackend(audioBlob);
     }
 
@@ -407,16 +754,9 @@ class sightAI{
      * Sends question to backend and plays audio answer. Posts question and image to /ask_question endpoint.
      */
     async processQuestion(question) {
-        const finalData = {
+        const response = await this.postImageForm('/ask_question', {
             completedAt: new Date().toISOString(),
-            image: this.currentImageData,
             question: question
-        };
-
-        const response = await fetch('/ask_question', {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify(finalData)
         });
 
         if (!response.ok) {
@@ -483,18 +823,11 @@ class sightAI{
      */
     async callDetectPrivate(userResponse, customFields, sessionId) {
         try {
-            const finalData = {
+            const response = await this.postImageForm('/detect_private', {
                 completedAt: new Date().toISOString(),
-                image: this.currentImageData,
                 user_response: userResponse,
                 custom_fields: customFields,
                 session_id: sessionId
-            };
-    
-            const response = await fetch('/detect_private', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify(finalData)
             });
     
             if (!response.ok) {
@@ -699,15 +1032,8 @@ class sightAI{
             this.audioQueue = [];
             this.isPlayingAudio = false;
 
-            const finalData = {
-                completedAt: new Date().toISOString(),
-                image: this.currentImageData
-            };
-
-            const response = await fetch('/speak_stream', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify(finalData)
+            const response = await this.postImageForm('/speak_stream', {
+                completedAt: new Date().toISOString()
             });
 
             if (!response.ok) {
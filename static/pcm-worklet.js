@@ -0,0 +1,32 @@
+/**
+ * AudioWorklet processor that forwards the microphone's first channel to the
+ * main thread in blocks of 2048 samples (instead of one message per 128-sample quantum).
+ */
+class PcmCaptureProcessor extends AudioWorkletProcessor {
+    constructor() {
+        super();
+        this.block = new Float32Array(2048);
+        this.length = 0;
+    }
+
+    process(inputs) {
+        const channel = inputs[0] && inputs[0][0];
+        if (channel) {
+            let offset = 0;
+            while (offset < channel.length) {
+                const count = Math.min(channel.length - offset, this.block.length - this.length);
+                this.block.set(channel.subarray(offset, offset + count), this.length);
+                this.length += count;
+                offset += count;
+                if (this.length === this.block.length) {
+                    this.port.postMessage(this.block);
+                    this.block = new Float32Array(2048);
+                    this.length = 0;
+                }
+            }
+        }
+        return true;
+    }
+}
+
+registerProcessor('pcm-capture', PcmCaptureProcessor);
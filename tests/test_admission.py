@@ -0,0 +1,91 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.admission import AdmissionController, EndpointLimit, Overloaded
+
+
+def controller(capacity=1, timeout=5.0):
+    return AdmissionController(capacity, {
+        "ask": EndpointLimit(max_concurrent=4, max_queue=4, priority=0, timeout=timeout),
+        "pipeline": EndpointLimit(max_concurrent=4, max_queue=4, priority=2, timeout=timeout),
+    })
+
+
+def wait_queued(admission, endpoint, count):
+    deadline = time.monotonic() + 2
+    while admission.stats()[endpoint]['queued'] < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_higher_priority_is_admitted_first():
+    admission = controller()
+    holder = admission.acquire("pipeline")
+    order = []
+
+    def waiter(endpoint):
+        ticket = admission.acquire(endpoint)
+        order.append(endpoint)
+        ticket.release()
+
+    threads = [threading.Thread(target=waiter, args=("pipeline",))]
+    threads[0].start()
+    wait_queued(admission, "pipeline", 1)
+    threads.append(threading.Thread(target=waiter, args=("ask",)))
+    threads[1].start()
+    wait_queued(admission, "ask", 1)
+
+    holder.release()
+    for thread in threads:
+        thread.join()
+    assert order == ["ask", "pipeline"]
+
+
+def test_queue_timeout_and_full_queue_are_rejected():
+    admission = AdmissionController(1, {"pipeline": EndpointLimit(max_concurrent=1, max_queue=1, timeout=0.1)})
+    holder = admission.acquire("pipeline")
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        queued = pool.submit(admission.acquire, "pipeline")
+        wait_queued(admission, "pipeline", 1)
+        with pytest.raises(Overloaded, match="queue full"):
+            admission.acquire("pipeline")
+        with pytest.raises(Overloaded, match="queue timeout"):
+            queued.result()
+
+    assert admission.stats()["pipeline"]['rejected'] == 2
+    holder.release()
+    assert admission.stats()['active'] == 0
+
+
+def test_async_waits_leave_the_default_executor_free():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
+        admission = controller()
+        holder = admission.acquire("pipeline")
+        waiters = [asyncio.ensure_future(admission.acquire_async("pipeline")) for _ in range(3)]
+        await loop.run_in_executor(None, wait_queued, admission, "pipeline", 3)
+
+        # A running request still gets a worker thread while three requests are queued
+        start = time.monotonic()
+        await asyncio.wait_for(loop.run_in_executor(None, time.sleep, 0), 1)
+        assert time.monotonic() - start < 0.5
+
+        waiters[0].cancel()
+        holder.release()
+        for waiter in waiters[1:]:
+            (await waiter).release()
+        await loop.run_in_executor(None, time.sleep, 0.05)
+        # The cancelled waiter's slot was handed back
+        assert admission.stats()['active'] == 0
+
+    asyncio.run(scenario())
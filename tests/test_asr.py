@@ -0,0 +1,108 @@
+import io
+import os
+import sys
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.asr import SAMPLE_RATE, TranscriptionStream, decode_audio, float_to_pcm16
+from agents.cache import LRUCache
+
+
+def tone(seconds, amplitude=0.5, rate=SAMPLE_RATE):
+    t = np.arange(int(seconds * rate)) / rate
+    return (amplitude * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+
+
+def wav_bytes(frames, width, channels=1, rate=SAMPLE_RATE):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(width)
+        wav.setframerate(rate)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+def test_24bit_wav_matches_16bit():
+    samples = tone(0.2)
+    ints = (samples * 8388607).astype('<i4')
+    frames = np.stack([ints & 0xff, ints >> 8 & 0xff, ints >> 16 & 0xff], axis=1).astype(np.uint8).tobytes()
+
+    decoded = decode_audio(wav_bytes(frames, 3))
+    reference = decode_audio(wav_bytes(float_to_pcm16(samples), 2))
+    assert len(decoded) == len(samples)
+    assert np.abs(decoded - reference).max() < 1e-3
+    assert decoded.min() < -0.49
+
+
+class CountingRecognizer():
+    name = "counting"
+
+    def __init__(self):
+        self.lengths = []
+
+    def recognize(self, audio):
+        self.lengths.append(len(audio.get_raw_data()) // 2)
+        return f"phrase{len(self.lengths)}"
+
+
+def test_stream_transcribes_each_phrase_once():
+    recognizer = CountingRecognizer()
+    stream = TranscriptionStream(recognizer, pcm_rate=SAMPLE_RATE)
+    recording = float_to_pcm16(np.concatenate([tone(1.0), np.zeros(SAMPLE_RATE, dtype=np.float32), tone(1.0)]))
+
+    # Odd chunk sizes split samples across chunks
+    for start in range(0, len(recording), 3001):
+        stream.append(recording[start:start + 3001])
+        stream.advance()
+    assert stream.text == "phrase1"
+
+    assert stream.finish() == "phrase1 phrase2"
+    # The first phrase was not sent again with the second one
+    assert all(length < 1.6 * SAMPLE_RATE for length in recognizer.lengths)
+
+
+def fake_ffmpeg(tmp_path, monkeypatch):
+    # Stands in for ffmpeg by passing the "container" through as raw PCM
+    script = tmp_path / "ffmpeg"
+    script.write_text("#!/bin/sh\nexec cat\n")
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_container_stream_is_decoded_as_it_arrives(tmp_path, monkeypatch):
+    fake_ffmpeg(tmp_path, monkeypatch)
+    stream = TranscriptionStream(CountingRecognizer())
+    recording = float_to_pcm16(np.concatenate([tone(1.0), np.zeros(SAMPLE_RATE, dtype=np.float32), tone(1.0)]))
+    for start in range(0, len(recording), 4001):
+        stream.append(recording[start:start + 4001])
+
+    assert stream.finish() == "phrase1"
+    # Every chunk went through the one decoder, with nothing decoded twice
+    assert stream.length == len(recording) // 2
+    assert stream.decoder.returncode == 0 and not stream.reader.is_alive()
+
+
+def test_closing_an_unfinished_stream_stops_its_decoder(tmp_path, monkeypatch):
+    fake_ffmpeg(tmp_path, monkeypatch)
+    stream = TranscriptionStream(CountingRecognizer())
+    stream.append(float_to_pcm16(tone(0.5)))
+    decoder = stream.decoder
+
+    stream.close()
+    assert decoder.poll() is not None
+    assert not stream.reader.is_alive()
+    # Chunks that arrive after the stream was dropped start nothing
+    stream.append(b"\0\0")
+    assert stream.decoder is decoder
+
+
+def test_evicted_streams_are_closed():
+    streams = LRUCache(max_entries=1, on_evict=TranscriptionStream.close)
+    first = TranscriptionStream(CountingRecognizer(), pcm_rate=SAMPLE_RATE)
+    streams.set("a", first)
+    streams.set("b", TranscriptionStream(CountingRecognizer(), pcm_rate=SAMPLE_RATE))
+    assert first.closed
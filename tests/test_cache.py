@@ -0,0 +1,56 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agents.cache as cache
+from agents.cache import SqliteCache
+
+
+def test_sqlite_cache_keeps_newest_entries(tmp_path):
+    store = SqliteCache(str(tmp_path / "cache.db"), max_entries=3)
+    for i in range(5):
+        store.set(f"k{i}", f"v{i}")
+
+    assert store.stats()['entries'] == 3
+    assert store.stats()['evictions'] == 2
+    assert store.get("k0") is None
+    assert store.get("k4") == "v4"
+
+
+def test_sqlite_cache_drops_expired_rows_on_set(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    store = SqliteCache(str(tmp_path / "cache.db"), ttl=60)
+    store.set("old", "value")
+    now[0] += 61
+    store.set("new", "value")
+
+    assert store.stats()['entries'] == 1
+    assert store.get("new") == "value"
+
+
+def test_sqlite_cache_membership_respects_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    store = SqliteCache(str(tmp_path / "cache.db"), ttl=60)
+    store.set("session", "value")
+
+    assert "session" in store and "other" not in store
+    now[0] += 61
+    assert "session" not in store
+
+
+def test_lru_cache_reports_dropped_values():
+    dropped = []
+    store = cache.LRUCache(max_entries=2, on_evict=dropped.append)
+    store.set("a", "1")
+    store.set("b", "2")
+    store.set("c", "3")
+    assert dropped == ["1"]
+
+    # Values handed back by pop are the caller's to dispose of
+    assert store.pop("b") == "2"
+    store.set("c", "4")
+    store.clear()
+    assert dropped == ["1", "3", "4"]
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agents.vlm as vlm
+from agents.cache import LRUCache
+
+
+def test_unlabelled_regions_are_retried_once(monkeypatch):
+    calls = []
+
+    def empty_answer(img_b64, prompt, max_tokens=256, mime_type="image/jpeg", kind=None):
+        calls.append(prompt)
+        return None
+
+    monkeypatch.setattr(vlm, "call_qwen_vision_api", empty_answer)
+    labels = dict(vlm.classify_texts("img", ["name", "street", "total"], "['name', 'other']", batch_size=3))
+
+    assert labels == {0: "other", 1: "other", 2: "other"}
+    # One batched prompt, then one solo prompt per region
+    assert len(calls) == 4
+
+
+def test_batch_labels_are_used(monkeypatch):
+    def answer(img_b64, prompt, max_tokens=256, mime_type="image/jpeg", kind=None):
+        return '{"0": "name", "1": "address"}'
+
+    monkeypatch.setattr(vlm, "call_qwen_vision_api", answer)
+    assert dict(vlm.classify_texts("img", iter(["Ann", "Main St"]), "['name', 'address']", batch_size=2)) == {0: "name", 1: "address"}
+
+
+def test_async_classification_follows_streamed_texts(monkeypatch):
+    calls = []
+
+    async def answer(img_b64, prompt, max_tokens=256, mime_type="image/jpeg", kind=None):
+        calls.append(prompt)
+        # The batch leaves its second text unlabelled, so it is asked again on its own
+        return '{"0": "name"}' if "Ann" in prompt and "Main St" in prompt else "address"
+
+    async def texts():
+        for text in ["Ann", "Main St", "Paris"]:
+            await asyncio.sleep(0)
+            yield text
+
+    async def classify():
+        return dict([pair async for pair in vlm.async_classify_texts("img", texts(), "['name', 'address']", batch_size=2)])
+
+    monkeypatch.setattr(vlm, "async_call_qwen_vision_api", answer)
+    assert asyncio.run(classify()) == {0: "name", 1: "address", 2: "address"}
+    assert len(calls) == 3
+
+
+def test_async_text_regions_are_parsed_as_they_stream(monkeypatch):
+    answer = '```json\n[{"bbox_2d": [10, 20, 30, 40], "text_content": "Ann"}, {"bbox_2d": [0, 0, 5, 5], "text_content": "Main St"}]\n```'
+    parts = [answer[start:start + 7] for start in range(0, len(answer), 7)]
+    seen = []
+
+    async def stream(img_b64, prompt, max_tokens=512, mime_type="image/jpeg", kind=None):
+        async def chunks():
+            for part in parts:
+                seen.append(part)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=part))])
+        return chunks()
+
+    async def regions():
+        found = []
+        async for region in await vlm.async_stream_text_regions(Image.new("RGB", (100, 100)), "regions"):
+            # The first region is complete before the stream ends
+            found.append((region["text_content"], len(seen) < len(parts)))
+        return found
+
+    monkeypatch.setattr(vlm, "async_call_qwen_vision_api_stream", stream)
+    monkeypatch.setattr(vlm, "vlm_cache", LRUCache())
+    assert asyncio.run(regions()) == [("Ann", True), ("Main St", True)]
@@ -0,0 +1,153 @@
+import asyncio
+import base64
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.cache import LRUCache
+from agents.local_vlm import LocalVLMBackend
+
+
+class WordTokenizer():
+    def decode(self, tokens, skip_special_tokens=True):
+        return " ".join(tokens)
+
+
+class ScriptedBackend(LocalVLMBackend):
+    """Answers every prompt with its own words, one token per word, without loading a model."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.generated = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def _generate(self, batch):
+        self.started.set()
+        self.release.wait()
+        self.generated.append(sorted(request.prompt for request in batch))
+        for request in batch:
+            for word in request.prompt.split():
+                request.push(word, WordTokenizer())
+            request.finish(" ".join(request.tokens))
+
+
+def message(text):
+    return [{"role": "user", "content": text}]
+
+
+def image_message(text):
+    buffer = BytesIO()
+    Image.new("RGB", (8, 8)).save(buffer, "PNG")
+    url = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+    return [{"role": "user", "content": [{"type": "text", "text": text}, {"type": "image_url", "image_url": {"url": url}}]}]
+
+
+def test_prompts_queued_during_a_batch_form_the_next_one():
+    backend = ScriptedBackend(max_batch=4, batch_wait=0.05)
+    backend.release.clear()
+    first = backend.submit(message("first"), max_tokens=8)
+    assert backend.started.wait(5)
+
+    # Queued while the first batch runs; the cancelled one is dropped, and
+    # prompts with and without an image are generated separately
+    queued = [backend.submit(message("a b"), max_tokens=8), backend.submit(image_message("c"), max_tokens=8),
+              backend.submit(message("d"), max_tokens=8)]
+    cancelled = backend.submit(message("gone"), max_tokens=8)
+    cancelled.future.cancel()
+    backend.release.set()
+
+    assert [request.future.result(timeout=5) for request in [first] + queued] == ["first", "a b", "c", "d"]
+    assert backend.generated == [["first"], ["c"], ["a b", "d"]]
+
+
+def test_async_stream_waits_on_the_loop():
+    async def collect(stream):
+        return [chunk.choices[0].delta.content async for chunk in stream]
+
+    async def scenario():
+        backend = ScriptedBackend()
+        backend.release.clear()
+        stream = await backend.achat(message("one two three"), max_tokens=16, stream=True)
+        reader = asyncio.ensure_future(collect(stream))
+        await asyncio.sleep(0.05)
+        # Nothing generated yet: the reader is parked on the loop, which keeps running
+        assert not reader.done()
+        backend.release.set()
+        return await asyncio.wait_for(reader, 5)
+
+    assert asyncio.run(scenario()) == ["one", " two", " three"]
+
+
+def build_tiny_qwen(path):
+    """Saves a randomly initialised, few-layer Qwen2.5-VL with a small BPE tokenizer to path."""
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import (Qwen2_5_VLConfig, Qwen2_5_VLForConditionalGeneration, Qwen2_5_VLProcessor,
+                              Qwen2TokenizerFast, Qwen2VLImageProcessor)
+
+    specials = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<|vision_start|>", "<|vision_end|>", "<|image_pad|>", "<|video_pad|>"]
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    bpe.train_from_iterator(["user assistant describe this image locate all text name address"] * 20,
+                            trainers.BpeTrainer(vocab_size=300, special_tokens=specials, initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    tokenizer = Qwen2TokenizerFast(tokenizer_object=bpe, eos_token="<|im_end|>", pad_token="<|endoftext|>", unk_token=None, bos_token=None)
+    template = ("{% for message in messages %}<|im_start|>{{ message['role'] }}\n{% for c in message['content'] %}"
+                "{% if c['type'] == 'image' %}<|vision_start|><|image_pad|><|vision_end|>{% else %}{{ c['text'] }}{% endif %}"
+                "{% endfor %}<|im_end|>\n{% endfor %}{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}")
+    Qwen2_5_VLProcessor(image_processor=Qwen2VLImageProcessor(min_pixels=56 * 56, max_pixels=28 * 28 * 16),
+                        tokenizer=tokenizer, chat_template=template).save_pretrained(path)
+
+    ids = {token: tokenizer.convert_tokens_to_ids(token) for token in specials}
+    config = Qwen2_5_VLConfig(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+        num_key_value_heads=2, rope_scaling={"type": "mrope", "mrope_section": [2, 3, 3]},
+        vision_config=dict(depth=2, hidden_size=32, intermediate_size=64, num_heads=2, out_hidden_size=64, fullatt_block_indexes=[1]),
+        image_token_id=ids["<|image_pad|>"], video_token_id=ids["<|video_pad|>"], vision_start_token_id=ids["<|vision_start|>"],
+        vision_end_token_id=ids["<|vision_end|>"], eos_token_id=ids["<|im_end|>"], pad_token_id=ids["<|endoftext|>"],
+        bos_token_id=ids["<|endoftext|>"], tie_word_embeddings=True, initializer_range=0.5)
+    torch.manual_seed(0)
+    model = Qwen2_5_VLForConditionalGeneration(config)
+    model.generation_config.eos_token_id = ids["<|im_end|>"]
+    model.generation_config.pad_token_id = ids["<|endoftext|>"]
+    model.save_pretrained(path)
+
+
+def noise_message(seed, size, text):
+    pixels = np.random.default_rng(seed).integers(0, 255, size + (3,), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, "PNG")
+    url = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+    return [{"role": "user", "content": [{"type": "text", "text": text}, {"type": "image_url", "image_url": {"url": url}}]}]
+
+
+def test_cached_image_prefixes_give_the_same_answers(tmp_path):
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    build_tiny_qwen(tmp_path)
+    prompts = [noise_message(0, (120, 160), "describe this image"), noise_message(0, (120, 160), "name"),
+               noise_message(1, (60, 330), "locate all text"), noise_message(1, (60, 330), "address")]
+
+    plain = LocalVLMBackend(str(tmp_path), batch_wait=0.2)
+    expected = [plain.chat(messages, 12).choices[0].message.content for messages in prompts]
+
+    cached = LocalVLMBackend(str(tmp_path), batch_wait=0.2, prefix_cache=LRUCache(max_entries=4))
+    assert [cached.chat(messages, 12).choices[0].message.content for messages in prompts] == expected
+    # The second prompt about each image skipped the vision encoder
+    assert cached.stats()['prefix_cache']['hits'] == 2
+
+    # Concurrent prompts are batched with prefixes of different lengths
+    with ThreadPoolExecutor(max_workers=len(prompts)) as pool:
+        answers = list(pool.map(lambda messages: cached.chat(messages, 12).choices[0].message.content, prompts))
+    assert answers == expected
+    assert cached.stats()['batched_requests'] > 0
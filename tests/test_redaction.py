@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import REDACTION_MODES, redact_polygons
+
+POLYGON = [[(20, 20), (80, 20), (80, 50), (20, 50)]]
+
+
+def rgba_capture():
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (100, 100, 4), dtype=np.uint8)
+    pixels[..., 3] = 255
+    return pixels
+
+
+@pytest.mark.parametrize("mode", REDACTION_MODES)
+def test_rgba_redaction_stays_opaque(mode):
+    pixels = rgba_capture()
+    original = pixels.copy()
+    assert redact_polygons(pixels, POLYGON, mode) == 1
+
+    inside = pixels[21:50, 21:80]
+    assert (pixels[..., 3] == 255).all()
+    assert not np.array_equal(inside[..., :3], original[21:50, 21:80, :3])
+    # Pixels outside the polygon are untouched
+    assert np.array_equal(pixels[:15], original[:15])
+
+
+def test_rgba_black_is_opaque_black():
+    pixels = rgba_capture()
+    redact_polygons(pixels, POLYGON, "black")
+    assert (pixels[20:51, 20:81] == [0, 0, 0, 255]).all()
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        redact_polygons(rgba_capture(), POLYGON, "erase")
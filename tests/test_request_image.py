@@ -0,0 +1,47 @@
+import os
+import sys
+from functools import partial
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.cache import LRUCache
+from utils import InvalidImage, RequestImage
+
+
+def test_undecodable_bytes_are_an_invalid_image():
+    with pytest.raises(InvalidImage, match="Invalid image data"):
+        RequestImage(b"not an image").image
+
+
+def jpeg_bytes(size=(64, 48)):
+    buffer = BytesIO()
+    Image.new("RGB", size, (200, 30, 30)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def test_store_counts_encodings_added_after_upload():
+    store = LRUCache(max_entries=4)
+    photo = RequestImage(jpeg_bytes())
+    photo.image
+    store.set(photo.hash, photo)
+    photo.on_resize = partial(store.remeasure, photo.hash)
+    uploaded = store.stats()['bytes']
+
+    photo.encoded(max_side=32)
+    assert store.stats()['bytes'] == photo.nbytes > uploaded
+
+
+def test_store_evicts_when_encodings_outgrow_it():
+    photo = RequestImage(jpeg_bytes())
+    photo.image
+    store = LRUCache(max_bytes=photo.nbytes + 10)
+    store.set(photo.hash, photo)
+    photo.on_resize = partial(store.remeasure, photo.hash)
+
+    photo.encoded(format="PNG")
+    assert photo.hash not in store
+    assert store.stats()['bytes'] == 0
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.segmentation import SegmentationService
+
+
+class FakeBackend():
+    def __init__(self, name, result):
+        self.name = name
+        self.result = result
+        self.calls = 0
+
+    def segment(self, image):
+        self.calls += 1
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def half_mask(image):
+    mask = np.zeros((image.height, image.width), dtype=bool)
+    mask[:, :image.width // 2] = True
+    return mask
+
+
+def test_no_document_keeps_the_whole_image():
+    image = Image.new("RGB", (40, 30), "white")
+    fallback = FakeBackend("opencv", half_mask(image))
+    service = SegmentationService([FakeBackend("sam3", None), fallback])
+
+    mask = service.get_mask(image)
+    assert mask.shape == (30, 40) and mask.all()
+    assert fallback.calls == 0
+
+
+def test_failed_backend_hands_over_to_the_next():
+    image = Image.new("RGB", (40, 30), "white")
+    service = SegmentationService([FakeBackend("sam3", RuntimeError("Space down")), FakeBackend("opencv", half_mask(image))])
+
+    mask = service.get_mask(image)
+    assert mask[:, :20].all() and not mask[:, 20:].any()
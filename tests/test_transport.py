@@ -0,0 +1,76 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.transport import CircuitBreaker, CircuitOpen, VLMTransport, VLMUnavailable
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.response = SimpleNamespace(status_code=status)
+
+
+def fake_client(outcomes):
+    """Client whose create() raises or returns the next outcome."""
+    def create(**request):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def transport_with(outcomes):
+    transport = VLMTransport(api_key="test", retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_after=0.0))
+    client = fake_client(outcomes)
+    transport.client = lambda timeout: client
+    return transport
+
+
+def test_non_retryable_probe_does_not_wedge_breaker():
+    transport = transport_with([HTTPError(503), HTTPError(400), "ok"])
+    with pytest.raises(VLMUnavailable):
+        transport.chat([], 16, "model")
+    assert transport.breaker.state == "half_open"
+
+    # The half-open probe gets a client error, which is not an upstream outage
+    with pytest.raises(HTTPError):
+        transport.chat([], 16, "model")
+    assert not transport.breaker.probing
+    assert transport.chat([], 16, "model") == "ok"
+    assert transport.breaker.state == "closed"
+
+
+def test_open_breaker_rejects_calls():
+    transport = transport_with([HTTPError(503)])
+    transport.breaker.reset_after = 60.0
+    with pytest.raises(VLMUnavailable):
+        transport.chat([], 16, "model")
+    with pytest.raises(CircuitOpen):
+        transport.chat([], 16, "model")
+
+
+def test_cancelled_async_probe_releases_breaker():
+    transport = VLMTransport(api_key="test", retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_after=0.0))
+    transport.breaker.record_failure()
+
+    async def hang(request, deadline):
+        await asyncio.sleep(10)
+
+    transport._async_attempt = hang
+
+    async def cancel_probe():
+        task = asyncio.ensure_future(transport.achat([], 16, "model"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_probe())
+    assert not transport.breaker.probing
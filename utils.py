@@ -6,6 +6,11 @@ import cv2
 import re
 import json
 import math
+import base64
+import hashlib
+from io import BytesIO
+
+from agents.metrics import span
 
 def pil_to_opencv(pil_img):
     """
@@ -58,15 +63,15 @@ def opencv_to_pil(cv_img):
     # Fallback: Convert to RGB
     return Image.fromarray(cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB))
 
-def set_zero_outside_mask(image, mask):
-    """Sets pixel values outside the mask to 0."""
+def set_zero_outside_mask(image, mask, copy=True):
+    """Sets pixel values outside the mask to 0. Pass copy=False to modify image in place."""
 
     # Ensure image and mask have compatible shapes
     if image.shape[:2] != mask.shape:
         raise ValueError("Image and mask must have the same height and width.")
 
     # Create a copy of the image to avoid modifying the original
-    masked_image = image.copy()
+    masked_image = image.copy() if copy else image
 
     # Set values outside mask to 0
     masked_image[~mask] = 255
@@ -74,6 +79,143 @@ def set_zero_outside_mask(image, mask):
     return masked_image
 
 
+class InvalidImage(ValueError):
+    """Raised when a request carries no image or one that cannot be read."""
+
+
+class RequestImage():
+    """
+    Encoded image received with a request. The bytes are decoded into a PIL
+    Image at most once, and base64 is only produced when an external API asks for it.
+    on_resize, if set, is called whenever a cached copy is added, so a store
+    holding the image can account for its new nbytes.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._image = None
+        self._base64 = None
+        self._hash = None
+        self._encoded = {}
+        self.on_resize = None
+
+    def _resized(self):
+        if self.on_resize is not None:
+            self.on_resize()
+
+    @classmethod
+    def from_data_url(cls, data_url):
+        """Builds a RequestImage from a 'data:image/...;base64,' URL (or bare base64)."""
+        return cls(base64.b64decode(data_url.split(",")[-1]))
+
+    @property
+    def image(self):
+        if self._image is None:
+            try:
+                image = Image.open(BytesIO(self.data))
+                image.load()
+            except OSError as e:
+                # UnidentifiedImageError and truncated files alike
+                raise InvalidImage(f"Invalid image data: {e}")
+            self._image = image
+            self._resized()
+        return self._image
+
+    @property
+    def base64(self):
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.data).decode('utf-8')
+            self._resized()
+        return self._base64
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.data).hexdigest()
+        return self._hash
+
+    def encoded(self, max_side=None, max_pixels=None, format="JPEG", quality=85):
+        """Returns encode_image(...) of this photo, cached per set of arguments."""
+        key = (max_side, max_pixels, format, quality)
+        result = self._encoded.get(key)
+        if result is None:
+            result = encode_image(self.image, max_side, max_pixels, format, quality)
+            self._encoded[key] = result
+            self._resized()
+        return result
+
+    @property
+    def nbytes(self):
+        """Approximate memory held: encoded bytes plus any decoded pixels, base64 text and re-encoded copies."""
+        total = len(self.data)
+        if self._image is not None:
+            total += self._image.width * self._image.height * len(self._image.getbands())
+        if self._base64 is not None:
+            total += len(self._base64)
+        # Copied, since other requests may add encodings meanwhile
+        for encoded, _ in list(self._encoded.values()):
+            total += len(encoded)
+        return total
+
+
+DEBUG_IMAGE_DIR = os.environ.get("DEBUG_IMAGE_DIR")
+
+def save_debug_image(image, name):
+    """
+    Writes an intermediate pipeline image to DEBUG_IMAGE_DIR when it is set.
+    Does nothing otherwise, so stages hand images to each other in memory.
+    """
+    if not DEBUG_IMAGE_DIR:
+        return
+    os.makedirs(DEBUG_IMAGE_DIR, exist_ok=True)
+    if isinstance(image, np.ndarray):
+        cv2.imwrite(os.path.join(DEBUG_IMAGE_DIR, name), image)
+    else:
+        image.save(os.path.join(DEBUG_IMAGE_DIR, name))
+
+
+def downscale_max_side(image, max_side):
+    """Returns a PIL image whose longest side is at most max_side. Returns the input when it is already small enough."""
+    if max(image.size) <= max_side:
+        return image
+    scale = max_side / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.BILINEAR)
+
+
+def fit_size(size, max_side=None, max_pixels=None):
+    """Largest (width, height) with the same aspect ratio that fits max_side and max_pixels. Never upscales."""
+    w, h = size
+    scale = 1.0
+    if max_side:
+        scale = min(scale, max_side / max(w, h))
+    if max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (w * h)))
+    if scale >= 1.0:
+        return size
+    return (max(1, int(w * scale)), max(1, int(h * scale)))
+
+
+def encode_image(image, max_side=None, max_pixels=None, format="JPEG", quality=85):
+    """
+    Downscales a PIL image to fit max_side / max_pixels and encodes it (JPEG, WEBP or PNG).
+    Returns (base64 string, (width, height) of the encoded image).
+    """
+    with span("image_encode"):
+        size = fit_size(image.size, max_side, max_pixels)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        if format in ("JPEG", "WEBP") and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        buffered = BytesIO()
+        if format == "PNG":
+            image.save(buffered, format=format)
+        else:
+            image.save(buffered, format=format, quality=quality)
+        return base64.b64encode(buffered.getvalue()).decode('utf-8'), size
+
+
 def polygon_orientation(points):
     """
     Computes the orientation (in degrees) of a polygon via PCA on its vertices.
@@ -108,103 +250,203 @@ def polygon_orientation(points):
 
     return angle_deg
 
-def extract_bbox_removing_incomplete(text):
-    """
-    Parse truncated JSON that looks like an array of objects,
-    discard any incomplete final object, and extract bbox_2d arrays.
-    """
-
-    # 1) Strip away the initial ```json plus everything before it
-    #    and any trailing backticks or text.
-    #    This regex grabs everything after ```json until the end,
-    #    then removes any trailing ``` if present.
-    match = re.search(r'```json\s*(.*)', text, re.DOTALL)
-    if not match:
-        return None
-    json_str = match.group(1)
-    # Remove any trailing triple backticks and beyond
-    json_str = re.sub(r'```.*$', '', json_str, flags=re.DOTALL).strip()
-
-    # 2) If the entire thing is wrapped in [...] at the top level, remove them.
-    #    We'll parse object by object ourselves.
-    #    - We'll do this only if it starts with '[' and ends with ']'.
-    if json_str.startswith('[') and json_str.endswith(']'):
-        # remove the first '[' and the last ']'
-        json_str = json_str[1:-1].strip()
-
-    # 3) Collect each *complete* top-level `{ ... }` object
-    #    ignoring any trailing incomplete object.
-    objects = []
-    brace_stack = 0
-    start_idx = None
-    for i, ch in enumerate(json_str):
-        if ch == '{':
-            if brace_stack == 0:
-                # Potential start of a new object
-                start_idx = i
-            brace_stack += 1
-        elif ch == '}':
-            brace_stack -= 1
-            if brace_stack == 0 and start_idx is not None:
-                # We found a complete object from start_idx to i
-                obj_str = json_str[start_idx:i+1]
-                objects.append(obj_str)
-                start_idx = None
-
-    # Now `objects` holds each fully closed `{...}`
-
-    # 4) Build a valid JSON array from these objects
-    #    For example: [{...},{...},...]
-    if not objects:
-        return None  # No complete objects found
-    array_str = "[" + ",".join(objects) + "]"
-
-    # 5) Parse the array
-    try:
-        data_list = json.loads(array_str)
-    except json.JSONDecodeError:
-        return None  # Something else is malformed
-
-    return data_list
-
-def rotated_bbox_polygon(bbox_rot, angle, orig_size, rot_size):
-    """
-    Convert a bounding box from rotated image coordinates to the original image coordinates as a polygon.
+class JSONObjectStream():
+    """
+    Incremental parser for model output that holds a ```json fenced array of
+    objects (or a single object). feed() takes the next chunk of text and
+    returns every top-level object completed by it, so callers can act on the
+    first objects while the rest is still being generated. Braces inside
+    strings are ignored, an object that fails to parse is skipped, and
+    anything after the closing fence is ignored.
+    """
+
+    OPEN_FENCE = "```json"
+    _STRUCTURE = re.compile(r'[{}"`]')
+    _STRING = re.compile(r'["\\]')
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.started = False
+        self.done = False
+        self.depth = 0
+        self.in_string = False
+        self.start = None
+
+    def feed(self, chunk):
+        if self.done or not chunk:
+            return []
+        self.text += chunk
+        if not self.started:
+            fence = self.text.find(self.OPEN_FENCE)
+            if fence < 0:
+                # Keep only what could be the start of a split fence
+                self.text = self.text[-len(self.OPEN_FENCE):]
+                return []
+            self.started = True
+            self.text = self.text[fence + len(self.OPEN_FENCE):]
+
+        objects = []
+        text = self.text
+        pos = self.pos
+        while True:
+            if self.in_string:
+                match = self._STRING.search(text, pos)
+                if match is None:
+                    pos = len(text)
+                    break
+                if match.group() == '\\':
+                    if match.end() >= len(text):
+                        pos = match.start()  # wait for the escaped character
+                        break
+                    pos = match.end() + 1
+                    continue
+                self.in_string = False
+                pos = match.end()
+                continue
+
+            match = self._STRUCTURE.search(text, pos)
+            if match is None:
+                pos = len(text)
+                break
+            ch, i = match.group(), match.start()
+            if ch == '"':
+                self.in_string = self.depth > 0
+                pos = i + 1
+            elif ch == '{':
+                if self.depth == 0:
+                    self.start = i
+                self.depth += 1
+                pos = i + 1
+            elif ch == '}':
+                if self.depth > 0:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        try:
+                            objects.append(json.loads(text[self.start:i + 1]))
+                        except json.JSONDecodeError:
+                            pass
+                        self.start = None
+                pos = i + 1
+            else:  # backtick
+                if self.depth > 0:
+                    pos = i + 1
+                elif len(text) - i < 3:
+                    pos = i  # may be a split closing fence
+                    break
+                elif text.startswith("```", i):
+                    self.done = True
+                    break
+                else:
+                    pos = i + 1
+
+        # Drop text that no open object refers to
+        keep = self.start if self.start is not None else pos
+        self.text = text[keep:]
+        self.pos = pos - keep
+        if self.start is not None:
+            self.start = 0
+        return objects
+
+
+SENTENCE_ENDINGS = re.compile(r'[.!?]+')
+
+def split_sentences(buffer):
+    """
+    Splits streamed text into its finished sentences, each ending with its first
+    end mark, and the unfinished rest. Returns (sentences, rest).
+    """
+    parts = SENTENCE_ENDINGS.split(buffer)
+    sentences = []
+    for part in parts[:-1]:
+        sentence = part.strip()
+        if sentence:
+            sentences.append(sentence + buffer[buffer.find(sentence) + len(sentence)])
+    return sentences, parts[-1] if parts else ""
+
+def rotated_bbox_polygons(bboxes_rot, angle, orig_size, rot_size, offset=(0, 0)):
+    """
+    Converts boxes from rotated image coordinates to polygons in the original
+    image. Maps every box with one affine matrix and shifts the result by
+    offset (e.g. the crop origin in the full photo).
 
     Parameters:
-    - bbox_rot: tuple (x1, y1, x2, y2) representing the bounding box on the rotated image.
+    - bboxes_rot: N x 4 array of (x1, y1, x2, y2) boxes on the rotated image.
     - angle: rotation angle in degrees (same as used in Image.rotate).
     - orig_size: (width, height) of the original image.
     - rot_size: (width, height) of the rotated image.
+    - offset: (x, y) added to every transformed point.
 
     Returns:
-    - A list of four (x, y) tuples corresponding to the transformed corners in the original image.
+    - N x 4 x 2 numpy array of polygons in the original image.
     """
-    # Convert angle to radians
     angle_rad = math.radians(angle)
+    cos_a, sin_a = math.cos(angle_rad), math.sin(angle_rad)
+    cx, cy = orig_size[0] / 2 + offset[0], orig_size[1] / 2 + offset[1]
+    new_cx, new_cy = rot_size[0] / 2, rot_size[1] / 2
+    matrix = np.array([
+        [cos_a, sin_a, cx - cos_a * new_cx - sin_a * new_cy],
+        [-sin_a, cos_a, cy + sin_a * new_cx - cos_a * new_cy],
+    ])
 
-    # Original image center
-    w, h = orig_size
-    cx, cy = w / 2, h / 2
+    boxes = np.asarray(bboxes_rot, dtype=np.float64).reshape(-1, 4)
+    corners = boxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
+    return corners @ matrix[:, :2].T + matrix[:, 2]
 
-    # Rotated image center
-    new_w, new_h = rot_size
-    new_cx, new_cy = new_w / 2, new_h / 2
 
-    # Unpack bounding box in rotated image
-    x1, y1, x2, y2 = bbox_rot
-    # Define the four corners of the bounding box
-    corners = [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
-    transformed_corners = []
+REDACTION_MODES = ("black", "blur", "pixelate")
 
-    for (x_r, y_r) in corners:
-        # Shift the point so the rotated image's center is at the origin
-        x_dash = x_r - new_cx
-        y_dash = y_r - new_cy
 
-        # Apply the inverse rotation (rotating back by the same angle)
-        x_orig = x_dash * math.cos(angle_rad) + y_dash * math.sin(angle_rad) + cx
-        y_orig = -x_dash * math.sin(angle_rad) + y_dash * math.cos(angle_rad) + cy
-        transformed_corners.append((x_orig, y_orig))
+def redact_polygons(pixels, polygons, mode="black"):
+    """
+    Redacts polygons from an H x W x C uint8 array in place. All polygons are
+    rasterized in a single cv2.fillPoly call; blur and pixelate only process
+    the region bounding the polygons and are scaled to the median box height.
+
+    Parameters:
+    - pixels: writable uint8 image array.
+    - polygons: N x K x 2 array of points.
+    - mode: one of REDACTION_MODES.
 
-    return transformed_corners
+    Returns:
+    - The number of polygons redacted.
+    """
+    if mode not in REDACTION_MODES:
+        raise ValueError(f"Unknown redaction mode '{mode}', expected one of {REDACTION_MODES}")
+    polygons = np.rint(np.asarray(polygons, dtype=np.float64)).astype(np.int32)
+    if len(polygons) == 0:
+        return 0
+
+    if mode == "black":
+        # Opaque black on RGBA captures, so redacted regions are not made transparent
+        color = 0 if pixels.ndim == 2 else (0, 0, 0, 255) if pixels.shape[2] == 4 else (0,) * pixels.shape[2]
+        cv2.fillPoly(pixels, list(polygons), color)
+        return len(polygons)
+
+    h, w = pixels.shape[:2]
+    x0, y0 = np.clip(polygons.min(axis=(0, 1)), 0, [w, h])
+    x1, y1 = np.clip(polygons.max(axis=(0, 1)) + 1, 0, [w, h])
+    if x1 <= x0 or y1 <= y0:
+        return len(polygons)
+
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    cv2.fillPoly(mask, list(polygons - [x0, y0]), 255)
+
+    # Shortest side of each polygon, i.e. roughly the text height
+    sides = np.linalg.norm(np.diff(polygons, axis=1, append=polygons[:, :1]), axis=2)
+    size = max(4, int(np.median(sides.min(axis=1))))
+
+    region = pixels[y0:y1, x0:x1]
+    if mode == "blur":
+        k = size | 1
+        redacted = cv2.GaussianBlur(region, (k, k), 0)
+    else:
+        block = max(2, size // 2)
+        small = cv2.resize(region, (max(1, region.shape[1] // block), max(1, region.shape[0] // block)), interpolation=cv2.INTER_AREA)
+        redacted = cv2.resize(small, (region.shape[1], region.shape[0]), interpolation=cv2.INTER_NEAREST)
+    if redacted.ndim == 3 and redacted.shape[2] == 4:
+        # Only the color is redacted; transparency is left as captured
+        redacted[..., 3] = region[..., 3]
+    where = mask.astype(bool)
+    region[where] = redacted[where]
+    return len(polygons)